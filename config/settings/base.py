@@ -43,6 +43,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # removed from the stack unless PROFILING_DIR is set
+    'core.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -74,6 +76,20 @@ DATABASE_URL = getenv(
 )
 DATABASES = {'default': dj_database_url.parse(DATABASE_URL, conn_max_age=600)}
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # state of `manage.py runbot` that survives restarts, holds a few keys and is never culled
+    'bot_state': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'bot_state_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 2 ** 31 - 1,
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -146,8 +162,91 @@ LOGGING = {
 }
 
 TELEGRAM_BOT_TOKEN = getenv('TELEGRAM_BOT_TOKEN')
+# bot username for login widget, fetched from telegram in background if not set
+TELEGRAM_BOT_USERNAME = getenv('TELEGRAM_BOT_USERNAME')
+TELEGRAM_API_URL = getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+# bot api transport: connections are kept alive in pool and reused
+TELEGRAM_CON_POOL_SIZE = int(getenv('TELEGRAM_CON_POOL_SIZE', '8'))
+TELEGRAM_CONNECT_TIMEOUT = float(getenv('TELEGRAM_CONNECT_TIMEOUT', '5'))
+TELEGRAM_READ_TIMEOUT = float(getenv('TELEGRAM_READ_TIMEOUT', '5'))
 if APP_URL:
     WEBHOOK_URL = '/'.join([APP_URL, 'webhook', TELEGRAM_BOT_TOKEN])
 else:
     WEBHOOK_URL = None
 CHECK_SIGNATURE = getenv('CHECK_SIGNATURE', '1') == '1'
+# telegram flood limits: messages per second overall and in single chat,
+# enforced per process, so with N workers divide global rate by N
+TELEGRAM_GLOBAL_RATE = float(getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(getenv('TELEGRAM_CHAT_RATE', '1'))
+# longest pause before sending, longer flood waits are raised as RetryAfter (503 to travis);
+# without outbox the pause blocks webhook request, enable OUTBOX_ENABLED for bursty chats
+TELEGRAM_MAX_SEND_WAIT = float(getenv('TELEGRAM_MAX_SEND_WAIT', '10'))
+TELEGRAM_SEND_RETRIES = int(getenv('TELEGRAM_SEND_RETRIES', '2'))
+
+TRAVIS_CONFIG_URLS = [
+    'https://api.travis-ci.org/config',
+    'https://api.travis-ci.com/config',
+]
+TRAVIS_KEY_TIMEOUT = float(getenv('TRAVIS_KEY_TIMEOUT', '10'))
+# seconds to keep fetched public keys, refresh starts REFRESH_AHEAD seconds before expiry
+TRAVIS_KEY_TTL = int(getenv('TRAVIS_KEY_TTL', '3600'))
+TRAVIS_KEY_REFRESH_AHEAD = int(getenv('TRAVIS_KEY_REFRESH_AHEAD', '300'))
+TRAVIS_KEY_RETRY_DELAY = int(getenv('TRAVIS_KEY_RETRY_DELAY', '60'))
+
+# deliver reports from background worker (`manage.py runoutbox`) instead of request handler
+OUTBOX_ENABLED = getenv('OUTBOX_ENABLED', '0') == '1'
+OUTBOX_BATCH_SIZE = int(getenv('OUTBOX_BATCH_SIZE', '20'))
+OUTBOX_POLL_INTERVAL = float(getenv('OUTBOX_POLL_INTERVAL', '1'))
+OUTBOX_LOCK_TIMEOUT = int(getenv('OUTBOX_LOCK_TIMEOUT', '60'))
+OUTBOX_MAX_ATTEMPTS = int(getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_BACKOFF_BASE = float(getenv('OUTBOX_BACKOFF_BASE', '2'))
+OUTBOX_BACKOFF_MAX = float(getenv('OUTBOX_BACKOFF_MAX', '600'))
+# merge reports to the same chat arriving within window (seconds) into one digest, needs outbox
+REPORT_COALESCE_WINDOW = float(getenv('REPORT_COALESCE_WINDOW', '0'))
+REPORT_COALESCE_MAX = int(getenv('REPORT_COALESCE_MAX', '10'))
+# ignore repeated deliveries of the same build state to the same chat for DEDUP_TTL seconds
+DEDUP_TTL = int(getenv('DEDUP_TTL', '3600'))
+# threads delivering notification of group webhook
+FANOUT_WORKERS = int(getenv('FANOUT_WORKERS', '8'))
+# edit message of the build on later notifications about it, index entries live BUILD_MESSAGE_TTL seconds
+BUILD_MESSAGE_TTL = int(getenv('BUILD_MESSAGE_TTL', '86400'))
+# threads processing bot updates after webhook is acknowledged, 0 processes them in request
+BOT_UPDATE_WORKERS = int(getenv('BOT_UPDATE_WORKERS', '4'))
+BOT_UPDATE_QUEUE_SIZE = int(getenv('BOT_UPDATE_QUEUE_SIZE', '100'))
+# long polling (`manage.py runbot`): seconds of single getUpdates request and cache of last offset
+BOT_POLL_TIMEOUT = int(getenv('BOT_POLL_TIMEOUT', '25'))
+BOT_OFFSET_CACHE = 'bot_state'
+# answer simple commands in response to webhook request instead of separate api call
+BOT_INLINE_REPLIES = getenv('BOT_INLINE_REPLIES', '0') == '1'
+# accept webhooks only for chats that used /webhook command or logged in
+STRICT_CHATS = getenv('STRICT_CHATS', '0') == '1'
+# seconds between reloads of known chats from database
+KNOWN_CHATS_REFRESH = int(getenv('KNOWN_CHATS_REFRESH', '60'))
+# at most HOOK_RATE_LIMIT webhooks per chat within HOOK_RATE_WINDOW seconds, 0 disables limit
+HOOK_RATE_LIMIT = int(getenv('HOOK_RATE_LIMIT', '60'))
+HOOK_RATE_WINDOW = float(getenv('HOOK_RATE_WINDOW', '60'))
+# seconds to keep compiled filter rules of chat, changes made by other processes apply after it
+FILTER_CACHE_TTL = int(getenv('FILTER_CACHE_TTL', '60'))
+FILTER_MAX_RULES = int(getenv('FILTER_MAX_RULES', '20'))
+# report only builds that change status of branch (broken or fixed), other builds are skipped
+REPORT_TRANSITIONS_ONLY = getenv('REPORT_TRANSITIONS_ONLY', '0') == '1'
+# threads and queue for side effects of requests, e.g. login confirmation message
+BACKGROUND_WORKERS = int(getenv('BACKGROUND_WORKERS', '2'))
+BACKGROUND_QUEUE_SIZE = int(getenv('BACKGROUND_QUEUE_SIZE', '100'))
+# `/metrics` in prometheus format is served only with `Authorization: Bearer <METRICS_TOKEN>`
+METRICS_TOKEN = getenv('METRICS_TOKEN')
+# directory where every process (e.g. gunicorn worker) dumps its metrics to be summed up
+METRICS_DIR = getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(getenv('METRICS_FLUSH_INTERVAL', '5'))
+# profile requests with `X-Profile` header signed by PROFILING_SECRET or sampled with PROFILING_SAMPLE_RATE,
+# profiles are written to PROFILING_DIR and inspected with `manage.py profiles`
+PROFILING_DIR = getenv('PROFILING_DIR')
+PROFILING_SECRET = getenv('PROFILING_SECRET')
+PROFILING_SAMPLE_RATE = float(getenv('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_KEEP = int(getenv('PROFILING_KEEP', '50'))
+PROFILING_TOP = int(getenv('PROFILING_TOP', '20'))
+PROFILING_VIEWS = ['core:hook', 'core:group_hook', 'core:webhook']
+# json library for travis payloads the lean scanner can't handle: auto, orjson, ujson or json
+JSON_BACKEND = getenv('JSON_BACKEND', 'auto')
+# build report renderer: python, compiled (report.html compiled once) or template
+REPORT_RENDERER = getenv('REPORT_RENDERER', 'python')
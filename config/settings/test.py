@@ -4,3 +4,7 @@ from .base import *
 SECRET_KEY = 'secret'
 TELEGRAM_BOT_TOKEN = '000000:0000000000'
 APP_URL = 'https://example.com'
+TELEGRAM_BOT_USERNAME = 'test_bot'
+# don't throttle unit tests
+TELEGRAM_GLOBAL_RATE = 1000.0
+TELEGRAM_CHAT_RATE = 1000.0
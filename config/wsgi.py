@@ -5,3 +5,10 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings.prod')
 
 application = get_wsgi_application()
+
+# fetch bot info and render readme before first request
+from core.bot import warm_up  # noqa: E402
+from core.utils import readme  # noqa: E402
+
+warm_up()
+readme.get()
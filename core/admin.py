@@ -1,9 +1,42 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
-from .models import User
+from .models import BuildStatus, ChatGroup, FilterRule, KnownChat, OutboxMessage, User
 
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
     pass
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'chat_id', 'status', 'attempts', 'next_attempt_at', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('chat_id',)
+
+
+@admin.register(ChatGroup)
+class ChatGroupAdmin(admin.ModelAdmin):
+    list_display = ('name', 'chat_ids')
+    search_fields = ('name', 'chat_ids')
+
+
+@admin.register(KnownChat)
+class KnownChatAdmin(admin.ModelAdmin):
+    list_display = ('chat_id', 'created_at')
+    search_fields = ('chat_id',)
+
+
+@admin.register(FilterRule)
+class FilterRuleAdmin(admin.ModelAdmin):
+    list_display = ('chat_id', 'field', 'pattern', 'created_at')
+    list_filter = ('field',)
+    search_fields = ('chat_id', 'pattern')
+
+
+@admin.register(BuildStatus)
+class BuildStatusAdmin(admin.ModelAdmin):
+    list_display = ('chat_id', 'repository_id', 'branch', 'passed', 'build_number', 'finished_at')
+    list_filter = ('passed',)
+    search_fields = ('chat_id', 'branch')
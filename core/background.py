@@ -0,0 +1,62 @@
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundTasks:
+    """
+    Runs side effects of requests (like confirmation messages) in a few threads after response.
+    At most `queue_size` tasks wait for a thread, new ones are dropped, so slow telegram
+    can't pile up work in the web process.
+    """
+
+    def __init__(self, workers: int = None, queue_size: int = None):
+        self.workers = workers or settings.BACKGROUND_WORKERS
+        self.queue_size = settings.BACKGROUND_QUEUE_SIZE if queue_size is None else queue_size
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs) -> bool:
+        """
+        Schedule `func` call, False if the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            logger.warning(f"background queue is full, dropped {getattr(func, '__name__', func)}")
+            return False
+        try:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='background')
+                future = self._executor.submit(self._run, func, args, kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return True
+
+    @staticmethod
+    def _run(func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception(f"background task {getattr(func, '__name__', func)} failed")
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting tasks into current executor and run all queued ones.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=wait)
+
+
+background = BackgroundTasks()
+# drain queue when worker process exits
+atexit.register(background.shutdown)
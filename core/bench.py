@@ -0,0 +1,332 @@
+import base64
+import itertools
+import json
+import math
+import platform
+import random
+import resource
+import subprocess
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from OpenSSL.crypto import FILETYPE_PEM, TYPE_RSA, PKey, dump_publickey, sign
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from core.bot import bot, scheduler
+from core.buildindex import build_messages
+from core.chats import known_chats
+from core.dedup import deduplicator
+from core.filters import chat_filters
+from core.metrics import stage_latency, telegram_latency
+from core.models import ChatGroup
+from core.profiling import QueryLog
+from core.stubs import BotApiServer, ConfigServer, serve
+from core.transitions import build_statuses
+from core.utils import public_key_cache
+from core.views import hook_limiter
+
+VIEWS = ('hook', 'group_hook', 'webhook')
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def summarize(values: list) -> dict:
+    """
+    Latency summary in milliseconds.
+    """
+    values = sorted(value * 1000 for value in values)
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None,
+    }
+
+
+def load_corpus(path: str) -> list:
+    """
+    Read JSONL corpus, every line is one request:
+    `{"view": "hook", "chat_id": ..., "payload": {...}}`,
+    `{"view": "group_hook", "name": ..., "chat_ids": [...], "payload": {...}}` or
+    `{"view": "webhook", "update": {...}}`.
+    """
+    corpus = []
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry.get('view') not in VIEWS:
+                raise ValueError(f"line {number}: view must be one of {', '.join(VIEWS)}")
+            corpus.append(entry)
+    return corpus
+
+
+def create_payload(build_id: int, rnd: random.Random) -> dict:
+    status = rnd.choice([0, 0, 0, 1])
+    pull_request = rnd.random() < 0.2
+    repository_id = rnd.randrange(1, 6)
+    finished_at = datetime(2019, 8, 4, tzinfo=timezone.utc) + timedelta(minutes=build_id)
+    duration = rnd.randrange(30, 1200)
+    message = ' '.join(rnd.choice(['fix', 'add', 'update', 'docs', 'tests', '`code`', '*bold*'])
+                       for _ in range(rnd.randrange(2, 40)))
+    return {
+        'id': build_id,
+        'number': str(build_id),
+        'type': 'pull_request' if pull_request else 'push',
+        'state': 'passed' if status == 0 else 'failed',
+        'status': status,
+        'status_message': 'Passed' if status == 0 else 'Broken',
+        'started_at': (finished_at - timedelta(seconds=duration)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'finished_at': finished_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'duration': duration,
+        'build_url': f'https://travis-ci.org/owner/repo{repository_id}/builds/{build_id}',
+        'branch': rnd.choice(['master', 'master', 'dev', 'release/1.0']),
+        'message': message,
+        'compare_url': f'https://github.com/owner/repo{repository_id}/compare/a...b',
+        'committed_at': finished_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'author_name': rnd.choice(['alice', 'bob', 'carol']),
+        'pull_request': pull_request,
+        'pull_request_number': build_id if pull_request else None,
+        'pull_request_title': 'pull request' if pull_request else None,
+        'repository': {
+            'id': repository_id,
+            'name': f'repo{repository_id}',
+            'owner_name': 'owner',
+            'url': None,
+        },
+    }
+
+
+def create_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 1565092779,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+        },
+    }
+
+
+def generate_corpus(count: int, seed=0) -> list:
+    """
+    Synthetic corpus: mostly single chat webhooks, some group webhooks and bot commands.
+    """
+    rnd = random.Random(seed)
+    corpus = []
+    for i in range(1, count + 1):
+        kind = rnd.choices(VIEWS, weights=[7, 1, 2])[0]
+        chat_id = rnd.randrange(1, 21)
+        if kind == 'hook':
+            corpus.append({'view': kind, 'chat_id': str(chat_id), 'payload': create_payload(i, rnd)})
+        elif kind == 'group_hook':
+            corpus.append({
+                'view': kind,
+                'name': 'team',
+                'chat_ids': [str(c) for c in range(1, 6)],
+                'payload': create_payload(i, rnd),
+            })
+        else:
+            text = rnd.choice(['/start', '/webhook', '/filter'])
+            corpus.append({'view': kind, 'update': create_update(i, chat_id, text)})
+    return corpus
+
+
+def get_commit():
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=5,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.decode().strip() or None
+
+
+def reset_state():
+    """
+    Forget everything previous replay wrote, so the corpus is replayed from scratch.
+    """
+    call_command('flush', interactive=False, verbosity=0)
+    for cache in (deduplicator, build_messages, known_chats, chat_filters, build_statuses, hook_limiter):
+        cache.clear()
+    scheduler.reset()
+
+
+class Replay:
+    """
+    Replays corpus through webhook views with test client. Travis payloads are signed
+    with generated key served by stub travis config api, telegram is replaced with stub bot api.
+    Database must be ready to use, `bench` command creates test database for it.
+    """
+
+    def __init__(self, corpus: list, repeat=1, warmup=0, trace_memory=False):
+        self.corpus = corpus
+        self.repeat = repeat
+        self.warmup = warmup
+        self.trace_memory = trace_memory
+        self.client = Client()
+        self.key = PKey()
+        self.key.generate_key(TYPE_RSA, 2048)
+        self.requests = [self.prepare(entry) for entry in corpus]
+
+    def prepare(self, entry: dict):
+        """
+        Return view name and test client call for corpus entry.
+        """
+        view = entry['view']
+        if view == 'webhook':
+            data = json.dumps(entry['update'])
+            return view, lambda: self.client.post(reverse('core:webhook'), data, 'application/json')
+        payload = entry['payload']
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+        signature = base64.b64encode(sign(self.key, payload, 'sha1'))
+        if view == 'hook':
+            url = reverse('core:hook', kwargs={'chat_id': entry['chat_id']})
+        else:
+            url = reverse('core:group_hook', kwargs={'name': entry['name']})
+        return view, lambda: self.client.post(url, {'payload': payload}, HTTP_SIGNATURE=signature)
+
+    def create_groups(self):
+        groups = {
+            entry['name']: ' '.join(entry['chat_ids'])
+            for entry in self.corpus
+            if entry['view'] == 'group_hook'
+        }
+        ChatGroup.objects.bulk_create([
+            ChatGroup(name=name, chat_ids=chat_ids) for name, chat_ids in groups.items()
+        ])
+
+    def run(self) -> dict:
+        with ExitStack() as stack:
+            config_server = stack.enter_context(serve(ConfigServer()))
+            config_server.keys['bench'] = dump_publickey(FILETYPE_PEM, self.key).decode()
+            bot_api_server = stack.enter_context(serve(BotApiServer()))
+            message_ids = itertools.count(1)
+            bot_api_server.results['sendMessage'] = lambda params: {
+                'message_id': next(message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(params['chat_id']), 'type': 'private'},
+            }
+            bot_api_server.results['editMessageText'] = bot_api_server.results['sendMessage']
+            bot_api_server.results['getMe'] = {
+                'id': 1,
+                'is_bot': True,
+                'first_name': 'bench',
+                'username': settings.TELEGRAM_BOT_USERNAME or 'bench_bot',
+            }
+
+            stack.enter_context(override_settings(
+                ALLOWED_HOSTS=['testserver'],
+                CHECK_SIGNATURE=True,
+                BOT_UPDATE_WORKERS=0,
+                OUTBOX_ENABLED=False,
+            ))
+            stack.enter_context(patch.object(public_key_cache, 'urls', [config_server.url('bench')]))
+            stack.callback(public_key_cache.clear)
+            stack.enter_context(patch.object(bot, 'base_url', f'{bot_api_server.url}{bot.token}'))
+            # user of the bot is fetched from stub
+            stack.enter_context(patch.object(bot, 'bot', None))
+            # measure the code, not telegram flood limits
+            stack.enter_context(patch.object(scheduler, 'global_rate', 1e9))
+            stack.enter_context(patch.object(scheduler, 'chat_rate', 1e9))
+            stack.callback(scheduler.reset)
+            stack.enter_context(patch.object(hook_limiter, 'limit', 0))
+            for family in (stage_latency, telegram_latency):
+                stack.enter_context(patch.object(family, 'keep_samples', True))
+                family.reset()
+                stack.callback(family.reset)
+            public_key_cache.clear()
+            return self.measure()
+
+    def measure(self) -> dict:
+        reset_state()
+        self.create_groups()
+        for view, call in self.requests[:self.warmup]:
+            call()
+        stage_latency.reset()
+        telegram_latency.reset()
+
+        latencies = {view: [] for view in VIEWS}
+        queries = {view: [] for view in VIEWS}
+        status_codes = {view: Counter() for view in VIEWS}
+        elapsed = 0.0
+        if self.trace_memory:
+            tracemalloc.start()
+        try:
+            for _ in range(self.repeat):
+                reset_state()
+                self.create_groups()
+                for view, call in self.requests:
+                    query_log = QueryLog()
+                    with connection.execute_wrapper(query_log):
+                        start = time.perf_counter()
+                        response = call()
+                        duration = time.perf_counter() - start
+                    elapsed += duration
+                    latencies[view].append(duration)
+                    queries[view].append(len(query_log.queries))
+                    status_codes[view][str(response.status_code)] += 1
+            peak_traced = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+
+        total = sum(len(values) for values in latencies.values())
+        return {
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'renderer': settings.REPORT_RENDERER,
+            'json_backend': settings.JSON_BACKEND,
+            'corpus': len(self.corpus),
+            'repeat': self.repeat,
+            'requests': total,
+            'elapsed': elapsed,
+            'throughput': total / elapsed if elapsed else None,
+            'views': {
+                view: {
+                    'latency_ms': summarize(latencies[view]),
+                    'queries': {
+                        'total': sum(queries[view]),
+                        'mean': sum(queries[view]) / len(queries[view]),
+                        'max': max(queries[view]),
+                    },
+                    'status_codes': dict(status_codes[view]),
+                }
+                for view in VIEWS
+                if latencies[view]
+            },
+            'stages': {stage: summarize(values) for stage, values in stage_latency.samples().items()},
+            'telegram': {method: summarize(values) for method, values in telegram_latency.samples().items()},
+            'memory': {
+                # kilobytes on linux
+                'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'peak_traced_kib': peak_traced / 1024 if peak_traced is not None else None,
+            },
+        }
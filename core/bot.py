@@ -1,46 +1,239 @@
+import atexit
 import logging
+import threading
 
 from django.conf import settings
+from django.db import close_old_connections
 from django.urls import reverse
-from telegram import Bot, Update
+from telegram import Bot, ParseMode, TelegramError, Update
 from telegram.ext import Dispatcher, CallbackContext, CommandHandler
+from telegram.utils.request import Request
+
+from core.background import BackgroundTasks
+from core.chats import known_chats
+from core.models import FilterRule
+from core.metrics import telegram_latency
+from core.ratelimit import SendScheduler
 
 logger = logging.getLogger(__name__)
 
 
+class InstrumentedRequest(Request):
+    """
+    Bot api transport that records latency of every api method.
+    """
+
+    def get(self, url, timeout=None):
+        with telegram_latency.time(url.rsplit('/', 1)[-1]):
+            return super().get(url, timeout=timeout)
+
+    def post(self, url, data, timeout=None):
+        with telegram_latency.time(url.rsplit('/', 1)[-1]):
+            return super().post(url, data, timeout=timeout)
+
+
+def get_bot_username():
+    """
+    Return bot username without calling telegram api on request path.
+    None if it is not known yet, it will be fetched in background.
+    """
+    if settings.TELEGRAM_BOT_USERNAME:
+        return settings.TELEGRAM_BOT_USERNAME
+    if bot.bot:
+        return bot.bot.username
+    warm_up()
+    return None
+
+
+_warm_up_lock = threading.Lock()
+_warm_up_thread = None
+
+
+def warm_up():
+    """
+    Fetch bot info in background thread.
+    """
+    global _warm_up_thread
+
+    def target():
+        try:
+            bot.get_me()
+        except TelegramError as e:
+            logger.warning(f"failed to get bot info: {e}")
+
+    with _warm_up_lock:
+        if bot.bot or (_warm_up_thread and _warm_up_thread.is_alive()):
+            return
+        _warm_up_thread = threading.Thread(target=target, name='bot-warm-up', daemon=True)
+        _warm_up_thread.start()
+
+
 def handle_error(update: Update, context: CallbackContext):
     logger.error(f"📑\n{update}")
     logger.exception(context.error)
 
 
-def command_start(update: Update, _: CallbackContext):
-    bot.send_message(
-        update.effective_message.chat_id,
-        "This bot can notify about Travis CI build results. "
-        "Just specify appropriate webhook in notifications settings in .travis.yml.\n\n"
-        "Details: https://travis-tg.herokuapp.com/\n"
-        "Github: https://github.com/vanyakosmos/travis-tg-notifier\n\n"
-        "/start /help - show this message\n"
-        "/webhook /hook - show webhook url for current chat",
+def get_start_message(chat_id) -> dict:
+    return dict(
+        chat_id=chat_id,
+        text=(
+            "This bot can notify about Travis CI build results. "
+            "Just specify appropriate webhook in notifications settings in .travis.yml.\n\n"
+            "Details: https://travis-tg.herokuapp.com/\n"
+            "Github: https://github.com/vanyakosmos/travis-tg-notifier\n\n"
+            "/start /help - show this message\n"
+            "/webhook /hook - show webhook url for current chat\n"
+            "/filter - show or change notification filters of current chat"
+        ),
         disable_web_page_preview=True,
     )
 
 
-def command_webhook(update: Update, _: CallbackContext):
-    url = reverse('core:hook', kwargs={'chat_id': update.effective_message.chat_id})
+def get_webhook_message(chat_id) -> dict:
+    known_chats.register(chat_id)
+    url = reverse('core:hook', kwargs={'chat_id': chat_id})
     url = settings.APP_URL + url
-    update.message.reply_markdown(
-        f"`{url}`\n\n"
-        f"copy-n-paste it into *notifications.webhooks* section in *.travis.yml*"
+    return dict(
+        chat_id=chat_id,
+        text=(
+            f"`{url}`\n\n"
+            f"copy-n-paste it into *notifications.webhooks* section in *.travis.yml*"
+        ),
+        parse_mode=ParseMode.MARKDOWN,
+    )
+
+
+def command_start(update: Update, _: CallbackContext):
+    scheduler.send_message(**get_start_message(update.effective_message.chat_id))
+
+
+def command_webhook(update: Update, _: CallbackContext):
+    scheduler.send_message(**get_webhook_message(update.effective_message.chat_id))
+
+
+FILTER_USAGE = (
+    "/filter - list filters\n"
+    "/filter add <field> <pattern> - notify only about builds with matching field\n"
+    "/filter del <number> - remove filter\n"
+    "/filter clear - remove all filters\n\n"
+    "Fields: status, branch, repo, event, author. "
+    "Patterns are globs, e.g. `release/*`, status also accepts `success` and `failure`, "
+    "event is `push` or `pr`. Build must match one filter of every field."
+)
+
+
+def get_filter_list(chat_id) -> str:
+    rules = FilterRule.objects.filter(chat_id=chat_id)
+    if not rules:
+        return "No filters, all builds are reported.\n\n" + FILTER_USAGE
+    return '\n'.join(f"{i}. {rule.field} `{rule.pattern}`" for i, rule in enumerate(rules, start=1))
+
+
+def update_filters(chat_id, args: list) -> str:
+    """
+    Apply `/filter` subcommand and return answer for chat.
+    """
+    action = args[0].lower() if args else 'list'
+    if action == 'list':
+        return get_filter_list(chat_id)
+    if action == 'add' and len(args) >= 3:
+        field, pattern = args[1].lower(), ' '.join(args[2:])
+        if field not in dict(FilterRule.FIELD_CHOICES):
+            return f"Unknown field `{field}`.\n\n" + FILTER_USAGE
+        if FilterRule.objects.filter(chat_id=chat_id).count() >= settings.FILTER_MAX_RULES:
+            return f"Chat can't have more than {settings.FILTER_MAX_RULES} filters."
+        FilterRule.objects.create(chat_id=chat_id, field=field, pattern=pattern)
+        return get_filter_list(chat_id)
+    if action == 'del' and len(args) == 2 and args[1].isdigit():
+        rules = list(FilterRule.objects.filter(chat_id=chat_id))
+        index = int(args[1]) - 1
+        if not 0 <= index < len(rules):
+            return f"No filter with number {args[1]}."
+        rules[index].delete()
+        return get_filter_list(chat_id)
+    if action == 'clear':
+        # delete one by one to invalidate cached filter
+        for rule in FilterRule.objects.filter(chat_id=chat_id):
+            rule.delete()
+        return get_filter_list(chat_id)
+    return FILTER_USAGE
+
+
+def command_filter(update: Update, context: CallbackContext):
+    chat_id = update.effective_message.chat_id
+    scheduler.send_message(
+        chat_id,
+        update_filters(str(chat_id), context.args or []),
+        parse_mode=ParseMode.MARKDOWN,
     )
 
 
+# commands whose answer can be sent in response to webhook request
+INLINE_COMMANDS = {
+    'start': get_start_message,
+    'help': get_start_message,
+    'webhook': get_webhook_message,
+    'hook': get_webhook_message,
+}
+
+
+def get_inline_reply(update: Update):
+    """
+    Return `sendMessage` call answering simple command of the update, None for other updates.
+    """
+    message = update.message
+    if not message or not message.text or not message.text.startswith('/'):
+        return None
+    text = message.text[1:]
+    if not text or text[0].isspace():
+        # lone slash is not a command
+        return None
+    command, _, username = text.split(None, 1)[0].partition('@')
+    if username and username.lower() != (get_bot_username() or '').lower():
+        return None
+    get_message = INLINE_COMMANDS.get(command.lower())
+    if get_message is None:
+        return None
+    return {'method': 'sendMessage', **get_message(message.chat_id)}
+
+
+def process_update(update: Update):
+    """
+    Process update in worker thread.
+    """
+    try:
+        dispatcher.process_update(update)
+    finally:
+        close_old_connections()
+
+
+def handle_update(update: Update):
+    """
+    Queue update for worker threads, process it in place if they are disabled or busy.
+    """
+    if settings.BOT_UPDATE_WORKERS and update_workers.submit(process_update, update):
+        return
+    dispatcher.process_update(update)
+
+
 def setup_dispatcher(dp: Dispatcher):
     dp.add_handler(CommandHandler(('help', 'start'), command_start))
     dp.add_handler(CommandHandler(('webhook', 'hook'), command_webhook))
+    dp.add_handler(CommandHandler('filter', command_filter))
     dp.add_error_handler(handle_error)
 
 
-bot = Bot(settings.TELEGRAM_BOT_TOKEN)
+bot = Bot(
+    settings.TELEGRAM_BOT_TOKEN,
+    base_url=settings.TELEGRAM_API_URL,
+    request=InstrumentedRequest(
+        con_pool_size=settings.TELEGRAM_CON_POOL_SIZE,
+        connect_timeout=settings.TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=settings.TELEGRAM_READ_TIMEOUT,
+    ),
+)
+scheduler = SendScheduler(bot)
 dispatcher = Dispatcher(bot, update_queue=None, use_context=True)
 setup_dispatcher(dispatcher)
+update_workers = BackgroundTasks(settings.BOT_UPDATE_WORKERS or 1, settings.BOT_UPDATE_QUEUE_SIZE)
+atexit.register(update_workers.shutdown)
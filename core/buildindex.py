@@ -0,0 +1,63 @@
+import itertools
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from core.cache import LRUCache
+from core.models import BuildMessage
+
+
+class BuildMessageIndex:
+    """
+    Maps (chat_id, repository id, build id) to id of telegram message with report.
+    Recently used entries are kept in memory, rows older than ttl are deleted
+    from time to time on write.
+    """
+
+    def __init__(self, ttl=None, maxsize=10000, expire_every=100):
+        self.ttl = settings.BUILD_MESSAGE_TTL if ttl is None else ttl
+        self.local = LRUCache(maxsize=maxsize, ttl=self.ttl or None)
+        self.expire_every = expire_every
+        self._writes = itertools.count(1)
+
+    @property
+    def enabled(self):
+        return bool(self.ttl)
+
+    def get(self, chat_id, repository_id, build_id):
+        key = (str(chat_id), repository_id, build_id)
+        message_id = self.local.get(key)
+        if message_id is None:
+            message_id = BuildMessage.objects.filter(
+                chat_id=key[0],
+                repository_id=repository_id,
+                build_id=build_id,
+                updated_at__gte=timezone.now() - timedelta(seconds=self.ttl),
+            ).values_list('message_id', flat=True).first()
+            if message_id is not None:
+                self.local.set(key, message_id)
+        return message_id
+
+    def set(self, chat_id, repository_id, build_id, message_id):
+        key = (str(chat_id), repository_id, build_id)
+        self.local.set(key, message_id)
+        BuildMessage.objects.update_or_create(
+            chat_id=key[0],
+            repository_id=repository_id,
+            build_id=build_id,
+            defaults={'message_id': message_id},
+        )
+        if next(self._writes) % self.expire_every == 0:
+            self.expire()
+
+    def expire(self):
+        BuildMessage.objects.filter(
+            updated_at__lt=timezone.now() - timedelta(seconds=self.ttl),
+        ).delete()
+
+    def clear(self):
+        self.local.clear()
+
+
+build_messages = BuildMessageIndex()
@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe mapping with bounded size and optional time to live of entries.
+    Least recently used entries are evicted first.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._data[key]
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key, factory):
+        """
+        Return value of key, store and return result of factory() if there is no such key.
+        Factory is called under the lock, so it must be cheap, e.g. creation of empty container.
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (item[1] is not None and item[1] <= now):
+                value = factory()
+                expires_at = None if self.ttl is None else now + self.ttl
+                self._data[key] = (value, expires_at)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+            else:
+                value = item[0]
+            self._data.move_to_end(key)
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._data.pop(key, None)
+        return default if value is None else value[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self):
+        return len(self._data)
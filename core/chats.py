@@ -0,0 +1,65 @@
+import threading
+import time
+
+from django.conf import settings
+
+from core.cache import LRUCache
+from core.models import KnownChat
+
+
+class ChatRegistry:
+    """
+    In-memory snapshot of known chats, reloaded from database every `refresh` seconds.
+    Chats registered by other processes since last reload are looked up in database
+    once and cached until next reload. Unknown chats are cached only for `miss_ttl` seconds,
+    so flood of random chat ids can't push known ones out of the cache.
+    """
+
+    def __init__(self, refresh=None, maxsize=10000, miss_ttl=5):
+        self.refresh = settings.KNOWN_CHATS_REFRESH if refresh is None else refresh
+        self.lookups = LRUCache(maxsize=maxsize, ttl=self.refresh or None)
+        self.misses = LRUCache(maxsize=maxsize, ttl=miss_ttl)
+        self.chats = frozenset()
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            self.chats = frozenset(KnownChat.objects.values_list('chat_id', flat=True))
+            self.loaded_at = time.monotonic()
+            self.lookups.clear()
+            self.misses.clear()
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at >= self.refresh
+
+    def is_known(self, chat_id) -> bool:
+        chat_id = str(chat_id)
+        if self.is_stale():
+            self.load()
+        if chat_id in self.chats or chat_id in self.lookups:
+            return True
+        if chat_id in self.misses:
+            return False
+        # not under cache lock, concurrent lookups of other chats don't wait for database
+        known = KnownChat.objects.filter(chat_id=chat_id).exists()
+        (self.lookups if known else self.misses).set(chat_id, True)
+        return known
+
+    def register(self, chat_id):
+        chat_id = str(chat_id)
+        if chat_id in self.chats or self.lookups.get(chat_id):
+            return
+        KnownChat.objects.get_or_create(chat_id=chat_id)
+        self.lookups.set(chat_id, True)
+        self.misses.pop(chat_id)
+
+    def clear(self):
+        with self._lock:
+            self.chats = frozenset()
+            self.loaded_at = None
+            self.lookups.clear()
+            self.misses.clear()
+
+
+known_chats = ChatRegistry()
@@ -1,12 +1,16 @@
+import itertools
 import json
 import uuid
+from datetime import datetime
 from typing import Callable
 
-from telegram import User as TGUser, Bot
+from telegram import User as TGUser, Bot, Chat, Message
 import pytest
 from _pytest.fixtures import FixtureRequest
 from django.contrib.auth import get_user_model
 
+from core.stubs import BotApiServer, ConfigServer, serve
+
 User = get_user_model()
 
 
@@ -40,8 +44,50 @@ def mock_bot(mocker):
         self.bot = TGUser(id='1234', first_name='bot_name', username='test_bot', is_bot=True)
         return self.bot
 
+    def send_message(chat_id, *args, **kwargs):
+        return Message(next(message_ids), None, datetime.now(), Chat(chat_id, 'private'))
+
+    message_ids = itertools.count(1)
     mocker.patch.object(Bot, 'get_me', get_me)
-    mocker.patch.object(Bot, 'send_message')
+    mocker.patch.object(Bot, 'send_message', side_effect=send_message)
+    mocker.patch.object(Bot, 'edit_message_text')
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    from core.background import background
+    from core.bot import update_workers
+    from core.buildindex import build_messages
+    from core.chats import known_chats
+    from core.dedup import deduplicator
+    from core.filters import chat_filters
+    from core.transitions import build_statuses
+    from core.utils import public_key_cache, signing_keys
+    from core.views import hook_limiter
+    public_key_cache.clear()
+    signing_keys.clear()
+    deduplicator.clear()
+    build_messages.clear()
+    known_chats.clear()
+    chat_filters.clear()
+    build_statuses.clear()
+    hook_limiter.clear()
+    yield
+    # finish tasks while mocks of the test are active
+    background.shutdown()
+    update_workers.shutdown()
+
+
+@pytest.fixture
+def config_server():
+    with serve(ConfigServer()) as server:
+        yield server
+
+
+@pytest.fixture
+def bot_api_server():
+    with serve(BotApiServer()) as server:
+        yield server
 
 
 @pytest.fixture(autouse=True)
@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+
+from core.cache import LRUCache
+from core.models import DedupClaim
+from core.payload import BuildEvent
+
+
+class Deduplicator:
+    """
+    Remembers delivered notifications by (chat_id, build id, state).
+
+    Local LRU answers repeated deliveries to the same process for free. Claims stored
+    in database make claim atomic across processes, so only one of concurrent duplicates is sent.
+    Expired claims are purged at most once per `purge_interval` seconds by every process.
+    """
+
+    def __init__(self, ttl=None, maxsize=10000, purge_interval=600):
+        self.ttl = settings.DEDUP_TTL if ttl is None else ttl
+        self.local = LRUCache(maxsize=maxsize, ttl=self.ttl or None)
+        self.purge_interval = purge_interval
+        self.purged_at = None
+
+    @property
+    def enabled(self):
+        return bool(self.ttl)
+
+    @staticmethod
+    def get_key(chat_id, build: BuildEvent):
+        if build.id is None:
+            return None
+        state = build.state or build.status_message
+        return f'dedup:{chat_id}:{build.id}:{state}'
+
+    def seen(self, key) -> bool:
+        return key in self.local
+
+    def claim(self, key) -> bool:
+        """
+        Mark notification as delivered. False if it was already claimed by any process.
+        """
+        self.local.set(key, True)
+        now = time.monotonic()
+        if self.purged_at is None or now - self.purged_at >= self.purge_interval:
+            self.purged_at = now
+            DedupClaim.objects.purge()
+        return DedupClaim.objects.claim(key, self.ttl)
+
+    def release(self, key):
+        """
+        Forget notification that wasn't delivered, so travis retry gets through.
+        """
+        self.local.pop(key)
+        DedupClaim.objects.filter(key=key).delete()
+
+    def clear(self):
+        self.local.clear()
+
+
+deduplicator = Deduplicator()
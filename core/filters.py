@@ -0,0 +1,106 @@
+import re
+from fnmatch import translate
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+
+from core.cache import LRUCache
+from core.models import FilterRule
+from core.payload import BuildEvent
+
+# rule patterns that are not globs of field value
+STATUS_ALIASES = {
+    'success': lambda build: build.status == 0,
+    'failure': lambda build: build.status != 0,
+}
+EVENT_ALIASES = {
+    'pr': 'pull_request',
+}
+
+
+def get_field_value(build: BuildEvent, field: str):
+    if field == FilterRule.STATUS:
+        return build.status_message
+    if field == FilterRule.BRANCH:
+        return build.branch
+    if field == FilterRule.REPO:
+        return build.repository.slug
+    if field == FilterRule.EVENT:
+        return build.type or ('pull_request' if build.pull_request else 'push')
+    if field == FilterRule.AUTHOR:
+        return build.author_name
+    raise ValueError(f"unknown filter field: {field}")
+
+
+def compile_pattern(field: str, pattern: str):
+    """
+    Return predicate of build for single rule.
+    """
+    if field == FilterRule.STATUS and pattern.lower() in STATUS_ALIASES:
+        return STATUS_ALIASES[pattern.lower()]
+    if field == FilterRule.EVENT:
+        pattern = EVENT_ALIASES.get(pattern.lower(), pattern)
+    # branches are case sensitive in git, names and statuses are not
+    flags = 0 if field == FilterRule.BRANCH else re.IGNORECASE
+    regex = re.compile(translate(pattern), flags)
+    return lambda build: regex.match(str(get_field_value(build, field))) is not None
+
+
+class ChatFilter:
+    """
+    Compiled filter rules of a chat. Build passes if it matches any rule of every field.
+    """
+
+    def __init__(self, rules):
+        self.fields = {}
+        for rule in rules:
+            self.fields.setdefault(rule.field, []).append(compile_pattern(rule.field, rule.pattern))
+
+    def __bool__(self):
+        return bool(self.fields)
+
+    def matches(self, build: BuildEvent) -> bool:
+        return all(
+            any(predicate(build) for predicate in predicates)
+            for predicates in self.fields.values()
+        )
+
+
+class ChatFilters:
+    """
+    Compiled filters of recently notified chats. Entries are dropped when rules of the chat
+    are saved or deleted in this process and expire after `ttl` for changes in other processes.
+    """
+
+    def __init__(self, ttl=None, maxsize=10000):
+        self.ttl = settings.FILTER_CACHE_TTL if ttl is None else ttl
+        self.local = LRUCache(maxsize=maxsize, ttl=self.ttl or None)
+
+    def get(self, chat_id) -> ChatFilter:
+        chat_id = str(chat_id)
+        chat_filter = self.local.get(chat_id)
+        if chat_filter is None:
+            chat_filter = ChatFilter(FilterRule.objects.filter(chat_id=chat_id))
+            self.local.set(chat_id, chat_filter)
+        return chat_filter
+
+    def matches(self, chat_id, build: BuildEvent) -> bool:
+        chat_filter = self.get(chat_id)
+        return not chat_filter or chat_filter.matches(build)
+
+    def invalidate(self, chat_id):
+        self.local.pop(str(chat_id))
+
+    def clear(self):
+        self.local.clear()
+
+
+chat_filters = ChatFilters()
+
+
+def invalidate_chat_filter(sender, instance: FilterRule, **kwargs):
+    chat_filters.invalidate(instance.chat_id)
+
+
+post_save.connect(invalidate_chat_filter, sender=FilterRule)
+post_delete.connect(invalidate_chat_filter, sender=FilterRule)
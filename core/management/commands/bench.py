@@ -0,0 +1,57 @@
+import json
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from core.bench import Replay, generate_corpus, load_corpus
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay JSONL corpus of webhook requests against stub telegram and travis apis '
+        'in test database and print latency, throughput, query and memory stats as json.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus', nargs='?', help="JSONL corpus, synthetic corpus is used if omitted.")
+        parser.add_argument('--generate', action='store_true', help="Write synthetic corpus to CORPUS and exit.")
+        parser.add_argument('--size', type=int, default=200, help="Requests in synthetic corpus.")
+        parser.add_argument('--seed', type=int, default=0, help="Seed of synthetic corpus.")
+        parser.add_argument('--repeat', type=int, default=3, help="Replays of the corpus.")
+        parser.add_argument('--warmup', type=int, default=20, help="Requests replayed before measurement.")
+        parser.add_argument('--trace-memory', action='store_true', help="Trace python allocations, slows requests.")
+        parser.add_argument('--output', help="Write results to file instead of stdout.")
+
+    def handle(self, *args, **options):
+        if options['generate']:
+            if not options['corpus']:
+                raise CommandError("Path of corpus to generate is required.")
+            with open(options['corpus'], 'w') as f:
+                for entry in generate_corpus(options['size'], options['seed']):
+                    f.write(json.dumps(entry) + '\n')
+            return
+
+        if options['corpus']:
+            try:
+                corpus = load_corpus(options['corpus'])
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Bad corpus: {e}")
+        else:
+            corpus = generate_corpus(options['size'], options['seed'])
+        if not corpus:
+            raise CommandError("Corpus is empty.")
+
+        replay = Replay(corpus, options['repeat'], options['warmup'], options['trace_memory'])
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = replay.run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        text = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + '\n')
+        else:
+            self.stdout.write(text)
@@ -0,0 +1,72 @@
+import io
+import os
+import pstats
+from collections import Counter
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from core.profiling import list_profiles, sign_profile_request
+
+
+class Command(BaseCommand):
+    help = 'List and summarise request profiles captured by profiling middleware.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('profile_id', nargs='?', help="Show summary of the profile.")
+        parser.add_argument('--dir', default=settings.PROFILING_DIR, help="Profiles directory.")
+        parser.add_argument('--limit', type=int, default=20, help="Lines in every section of summary.")
+        parser.add_argument('--sort', default='cumulative', help="Sort key of profiler stats.")
+        parser.add_argument('--sign', action='store_true', help="Print value of X-Profile header.")
+
+    def handle(self, *args, **options):
+        if options['sign']:
+            if not settings.PROFILING_SECRET:
+                raise CommandError("PROFILING_SECRET is not set.")
+            self.stdout.write(sign_profile_request())
+            return
+        if not options['dir']:
+            raise CommandError("PROFILING_DIR is not set.")
+        if options['profile_id']:
+            self.show(options['dir'], options['profile_id'], options['limit'], options['sort'])
+        else:
+            self.list(options['dir'])
+
+    def list(self, directory: str):
+        profiles = list_profiles(directory)
+        if not profiles:
+            self.stdout.write("No profiles.")
+            return
+        self.stdout.write(f"{'id':<24} {'view':<16} {'status':>6} {'ms':>8} {'queries':>7} {'peak KiB':>9}  path")
+        for profile in profiles:
+            self.stdout.write(
+                f"{profile['id']:<24} {profile['view']:<16} {profile['status']:>6} "
+                f"{profile['duration'] * 1000:>8.1f} {len(profile['queries']):>7} "
+                f"{profile['peak_memory'] / 1024:>9.1f}  {profile['method']} {profile['path']}"
+            )
+
+    def show(self, directory: str, profile_id: str, limit: int, sort: str):
+        profile = next((p for p in list_profiles(directory) if p['id'] == profile_id), None)
+        if profile is None:
+            raise CommandError(f"No profile {profile_id}.")
+        self.stdout.write(self.style.SUCCESS(
+            f"{profile['method']} {profile['path']} ({profile['view']}) -> {profile['status']} "
+            f"in {profile['duration'] * 1000:.1f} ms, peak memory {profile['peak_memory'] / 1024:.1f} KiB"
+        ))
+
+        stream = io.StringIO()
+        stats = pstats.Stats(os.path.join(directory, f'{profile_id}.prof'), stream=stream)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        self.stdout.write(stream.getvalue())
+
+        self.stdout.write(self.style.SUCCESS("Top allocations:"))
+        for allocation in profile['allocations'][:limit]:
+            self.stdout.write(
+                f"{allocation['size'] / 1024:>9.1f} KiB {allocation['count']:>7}  {allocation['location']}"
+            )
+
+        queries = profile['queries']
+        total = sum(query['time'] for query in queries) * 1000
+        self.stdout.write(self.style.SUCCESS(f"\n{len(queries)} queries in {total:.1f} ms:"))
+        for sql, count in Counter(query['sql'] for query in queries).most_common(limit):
+            self.stdout.write(f"{count:>4}x  {sql}")
@@ -0,0 +1,66 @@
+import signal
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import BaseCommand
+from telegram.error import TelegramError
+
+from core.background import BackgroundTasks
+from core.bot import bot, process_update
+
+OFFSET_KEY = 'bot:offset'
+
+
+class Command(BaseCommand):
+    help = 'Receive bot updates with long polling instead of webhook.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Process pending updates and exit.")
+        parser.add_argument('--workers', type=int, default=settings.BOT_UPDATE_WORKERS or 1)
+        parser.add_argument('--timeout', type=int, default=settings.BOT_POLL_TIMEOUT,
+                            help="Seconds to wait for updates in single request.")
+        parser.add_argument('--retry-delay', type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        self.running = True
+        handlers = {sig: signal.signal(sig, self.stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+        cache = caches[settings.BOT_OFFSET_CACHE]
+        workers = BackgroundTasks(options['workers'], queue_size=options['workers'] * 10)
+
+        # updates can't be polled while webhook is set
+        bot.delete_webhook()
+        offset = cache.get(OFFSET_KEY)
+        self.stdout.write(self.style.SUCCESS(f"Polling updates from offset {offset}."))
+        try:
+            while self.running:
+                try:
+                    updates = bot.get_updates(
+                        offset=offset,
+                        timeout=options['timeout'],
+                        allowed_updates=['message'],
+                    )
+                except TelegramError as e:
+                    self.stderr.write(f"Failed to get updates: {e}")
+                    if options['once']:
+                        break
+                    time.sleep(options['retry_delay'])
+                    continue
+                for update in updates:
+                    # process in place when workers are busy
+                    if not workers.submit(process_update, update):
+                        process_update(update)
+                if updates:
+                    offset = updates[-1].update_id + 1
+                    cache.set(OFFSET_KEY, offset, timeout=None)
+                if options['once']:
+                    break
+        finally:
+            workers.shutdown()
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+        self.stdout.write(self.style.WARNING(f"Polling stopped at offset {offset}."))
+
+    def stop(self, *args):
+        # finish current request and queued updates and exit
+        self.running = False
@@ -0,0 +1,49 @@
+import signal
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import close_old_connections
+
+from core.outbox import process_batch
+
+
+class Command(BaseCommand):
+    help = 'Deliver reports from outbox to telegram.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Process due messages and exit.")
+        parser.add_argument('--batch-size', type=int, default=settings.OUTBOX_BATCH_SIZE)
+        parser.add_argument('--poll-interval', type=float, default=settings.OUTBOX_POLL_INTERVAL)
+
+    def handle(self, *args, **options):
+        self.running = True
+        handlers = {sig: signal.signal(sig, self.stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+        worker_id = uuid.uuid4().hex
+        self.stdout.write(self.style.SUCCESS(f"Outbox worker {worker_id} started."))
+        try:
+            while self.running:
+                try:
+                    processed = process_batch(options['batch_size'], worker_id)
+                except Exception as e:
+                    # e.g. lost database connection, claimed messages are reclaimed after lock timeout
+                    self.stderr.write(f"Failed to process batch: {e}")
+                    close_old_connections()
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                if options['once'] and processed < options['batch_size']:
+                    break
+                if not processed:
+                    time.sleep(options['poll_interval'])
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+        self.stdout.write(self.style.WARNING(f"Outbox worker {worker_id} stopped."))
+
+    def stop(self, *args):
+        # finish current batch and exit
+        self.running = False
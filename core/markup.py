@@ -0,0 +1,61 @@
+"""
+Local checks of telegram (legacy) markdown, so reports are not rejected by telegram.
+"""
+
+MAX_MESSAGE_LENGTH = 4096
+ESCAPABLE = '_*`['
+
+
+def strip_entity(text: str, char: str = '*'):
+    """
+    Remove chars that would close entity early. Escaping doesn't work inside of entities.
+    """
+    return text.replace(char, '')
+
+
+def check_markdown(text: str) -> bool:
+    """
+    Check that every entity in text is closed the way telegram's markdown parser expects.
+    """
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == '\\' and i + 1 < n and text[i + 1] in ESCAPABLE:
+            i += 2
+            continue
+        if c in '*_':
+            end = text.find(c, i + 1)
+            if end == -1:
+                return False
+            i = end + 1
+        elif c == '`':
+            if text.startswith('```', i):
+                end = text.find('```', i + 3)
+                if end == -1:
+                    return False
+                i = end + 3
+            else:
+                end = text.find('`', i + 1)
+                if end == -1:
+                    return False
+                i = end + 1
+        elif c == '[':
+            end = text.find(']', i + 1)
+            if end == -1 or not text.startswith('(', end + 1):
+                return False
+            close = text.find(')', end + 2)
+            if close == -1:
+                return False
+            i = close + 1
+        else:
+            i += 1
+    return True
+
+
+def truncate(text: str, length: int):
+    if len(text) <= length:
+        return text
+    if length <= 0:
+        return ''
+    return text[:length - 1] + '…'
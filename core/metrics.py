@@ -0,0 +1,332 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """
+    Thread-safe monotonic counter.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def reset(self):
+        with self._lock:
+            self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Thread-safe cumulative histogram of observed values.
+    With `keep_samples` observed values are kept as well, e.g. for percentiles in benchmark.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, keep_samples=False):
+        self.buckets = tuple(buckets)
+        self.keep_samples = keep_samples
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.samples = [] if self.keep_samples else None
+
+    def observe(self, value: float):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if self.samples is not None:
+                self.samples.append(value)
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'buckets': dict(zip(self.buckets + (float('inf'),), self.counts)),
+                'count': self.count,
+                'sum': self.sum,
+            }
+
+
+class MetricFamily:
+    """
+    Metrics of the same kind split by value of single label.
+    """
+    kind = None
+
+    def __init__(self, label='label', on_change=None):
+        self.label = label
+        self.on_change = on_change
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def create(self):
+        raise NotImplementedError
+
+    def labels(self, value):
+        if self.on_change:
+            self.on_change()
+        metric = self._metrics.get(value)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(value, self.create())
+        return metric
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {value: metric.snapshot() for value, metric in metrics.items()}
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+class CounterFamily(MetricFamily):
+    kind = 'counter'
+
+    def create(self):
+        return Counter()
+
+    def inc(self, value, amount=1):
+        self.labels(value).inc(amount)
+
+
+class HistogramFamily(MetricFamily):
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, label='label', on_change=None):
+        super().__init__(label, on_change)
+        self.buckets = buckets
+        self.keep_samples = False
+
+    def create(self):
+        return Histogram(self.buckets, self.keep_samples)
+
+    def time(self, value):
+        return self.labels(value).time()
+
+    def samples(self) -> dict:
+        """
+        Observed values by label, only of histograms created with `keep_samples` set.
+        """
+        with self._lock:
+            histograms = dict(self._metrics)
+        return {
+            value: list(histogram.samples)
+            for value, histogram in histograms.items()
+            if histogram.samples is not None
+        }
+
+
+def merge_samples(kind: str, samples: list) -> dict:
+    """
+    Sum dumps of the same metric family made by several processes.
+    """
+    merged = {}
+    for sample in samples:
+        for value, data in sample.items():
+            if kind == 'counter':
+                merged[value] = merged.get(value, 0) + data
+                continue
+            total = merged.setdefault(value, {'counts': [0] * len(data['counts']), 'sum': 0.0})
+            if len(total['counts']) != len(data['counts']):
+                # buckets changed between deploys
+                continue
+            total['counts'] = [a + b for a, b in zip(total['counts'], data['counts'])]
+            total['sum'] += data['sum']
+    return merged
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(**labels) -> str:
+    pairs = ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+    return '{' + pairs + '}' if pairs else ''
+
+
+def format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class MetricsRegistry:
+    """
+    Named metric families of the process rendered in prometheus text format.
+    With `directory` every process dumps its metrics there every `flush_interval` seconds
+    and on exit, so any process can render totals of all processes, including finished ones.
+    """
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.families = {}
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+
+    def register(self, name: str, documentation: str, family: MetricFamily) -> MetricFamily:
+        family.on_change = self.start_flusher
+        self.families[name] = (documentation, family)
+        return family
+
+    def counter(self, name: str, documentation: str, label='label') -> CounterFamily:
+        return self.register(name, documentation, CounterFamily(label))
+
+    def histogram(self, name: str, documentation: str, label='label', buckets=DEFAULT_BUCKETS):
+        return self.register(name, documentation, HistogramFamily(buckets, label))
+
+    def dump(self) -> dict:
+        """
+        Json friendly metrics of this process.
+        """
+        data = {}
+        for name, (_, family) in self.families.items():
+            sample = family.snapshot()
+            if family.kind == 'histogram':
+                sample = {
+                    value: {'counts': list(snapshot['buckets'].values()), 'sum': snapshot['sum']}
+                    for value, snapshot in sample.items()
+                }
+            data[name] = sample
+        return data
+
+    def get_path(self, pid=None) -> str:
+        return os.path.join(self.directory, f'metrics_{pid or os.getpid()}.json')
+
+    def flush(self):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.get_path()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.dump(), f)
+        # readers never see partially written file
+        os.replace(tmp_path, path)
+
+    def start_flusher(self):
+        """
+        Start background flushing in this process, after fork in every worker.
+        """
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            if self._flusher_pid is None:
+                atexit.register(self.flush)
+            self._flusher_pid = os.getpid()
+            thread = threading.Thread(target=self._flush_loop, name='metrics-flusher', daemon=True)
+            thread.start()
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._flusher_pid == pid:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning(f"failed to flush metrics: {e}")
+
+    def collect(self) -> dict:
+        """
+        Metrics of all processes: dumps of other processes and live metrics of this one.
+        """
+        dumps = [self.dump()]
+        if self.directory:
+            own_path = self.get_path()
+            for path in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+                if path == own_path:
+                    continue
+                try:
+                    with open(path) as f:
+                        dumps.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    logger.warning(f"failed to read metrics from {path}: {e}")
+        return {
+            name: merge_samples(family.kind, [dump.get(name, {}) for dump in dumps])
+            for name, (_, family) in self.families.items()
+        }
+
+    def render(self) -> str:
+        data = self.collect()
+        lines = []
+        for name, (documentation, family) in self.families.items():
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {family.kind}')
+            for value, sample in sorted(data[name].items()):
+                labels = {family.label: value}
+                if family.kind == 'counter':
+                    lines.append(f'{name}{format_labels(**labels)} {sample}')
+                    continue
+                total = 0
+                for bound, count in zip(family.buckets + (float('inf'),), sample['counts']):
+                    total += count
+                    lines.append(f'{name}_bucket{format_labels(**labels, le=format_bound(bound))} {total}')
+                lines.append(f'{name}_sum{format_labels(**labels)} {sample["sum"]}')
+                lines.append(f'{name}_count{format_labels(**labels)} {total}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(settings.METRICS_DIR, settings.METRICS_FLUSH_INTERVAL)
+# latency of telegram bot api calls by api method
+telegram_latency = metrics.histogram(
+    'telegram_api_seconds',
+    "Latency of telegram bot api calls.",
+    label='method',
+)
+# time spent in every step of webhook processing
+stage_latency = metrics.histogram(
+    'webhook_stage_seconds',
+    "Latency of webhook processing stages: parse, key_fetch, verify, render, send.",
+    label='stage',
+)
+webhook_requests = metrics.counter(
+    'webhook_requests_total',
+    "Travis webhook requests by response status code.",
+    label='code',
+)
+# fallbacks count reports that were not sent as is: rejected by telegram or by local markdown check
+report_outcomes = metrics.counter(
+    'report_outcomes_total',
+    "Report deliveries: sent, fallback (telegram rejected report), local_fallback "
+    "(report failed local check), bad_request (both reports rejected) and failed.",
+    label='outcome',
+)
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-17 21:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='summary',
+            field=models.TextField(blank=True),
+        ),
+    ]
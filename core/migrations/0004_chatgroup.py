@@ -0,0 +1,21 @@
+# Generated by Django 2.2.13 on 2026-10-17 21:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_outboxmessage_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.SlugField(unique=True)),
+                ('chat_ids', models.TextField(help_text='Chat ids separated by spaces, commas or new lines.')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.13 on 2026-10-17 21:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_chatgroup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.CharField(max_length=64)),
+                ('repository_id', models.BigIntegerField()),
+                ('build_id', models.BigIntegerField()),
+                ('message_id', models.BigIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+            options={
+                'unique_together': {('chat_id', 'repository_id', 'build_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.13 on 2026-10-17 21:36
+
+from django.db import migrations, models
+
+
+def register_users(apps, schema_editor):
+    # users that logged in before registry existed
+    User = apps.get_model('core', 'User')
+    KnownChat = apps.get_model('core', 'KnownChat')
+    usernames = User.objects.filter(is_active=True).values_list('username', flat=True)
+    KnownChat.objects.bulk_create([KnownChat(chat_id=username) for username in usernames])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_user_manager'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KnownChat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunPython(register_users, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.13 on 2026-10-17 21:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_knownchat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilterRule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.CharField(db_index=True, max_length=64)),
+                ('field', models.CharField(choices=[('status', 'status'), ('branch', 'branch'), ('repo', 'repo'), ('event', 'event'), ('author', 'author')], max_length=16)),
+                ('pattern', models.CharField(help_text='Glob pattern, e.g. master, release/*, *fail*.', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.13 on 2026-10-17 21:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_filterrule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildStatus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.CharField(max_length=64)),
+                ('repository_id', models.BigIntegerField()),
+                ('branch', models.CharField(max_length=255)),
+                ('passed', models.BooleanField()),
+                ('build_number', models.BigIntegerField()),
+                ('finished_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'build statuses',
+                'unique_together': {('chat_id', 'repository_id', 'branch')},
+            },
+        ),
+    ]
@@ -1,7 +1,350 @@
-from django.contrib.auth.models import AbstractUser
-from django.db import models
+import json
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import AbstractUser, UserManager as BaseUserManager
+from django.db import IntegrityError, connections, models, transaction
+from django.utils import timezone
+
+
+class UserManager(BaseUserManager):
+    def upsert(self, username, **fields):
+        """
+        Create user with unusable password or write changed `fields` of existing one.
+        Single query on postgres, elsewhere existing user takes one query plus one if it changed.
+        """
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            user = self._upsert_returning(connection, username, fields)
+            if user is not None:
+                return user
+        user, created = self.get_or_create(
+            username=username,
+            defaults={**fields, 'password': make_password(None)},
+        )
+        if not created:
+            changed = [key for key, value in fields.items() if getattr(user, key) != value]
+            for key in changed:
+                setattr(user, key, fields[key])
+            if changed:
+                user.save(update_fields=changed)
+        return user
+
+    def _upsert_returning(self, connection, username, fields: dict):
+        """
+        INSERT ... ON CONFLICT that updates row only if some of `fields` differ
+        and returns the row in both cases. None if the row was created concurrently.
+        """
+        qn = connection.ops.quote_name
+        user = self.model(username=username, **fields)
+        user.set_unusable_password()
+        opts = self.model._meta
+        insert_fields = [field for field in opts.concrete_fields if not field.primary_key]
+        values = [field.get_db_prep_save(field.pre_save(user, True), connection) for field in insert_fields]
+        update_columns = [qn(opts.get_field(key).column) for key in fields]
+        table = qn(opts.db_table)
+        username_column = qn(opts.get_field('username').column)
+        sql = (
+            f"WITH upsert AS ("
+            f"INSERT INTO {table} ({', '.join(qn(field.column) for field in insert_fields)}) "
+            f"VALUES ({', '.join(['%s'] * len(values))}) "
+            f"ON CONFLICT ({username_column}) DO UPDATE SET "
+            f"{', '.join(f'{column} = EXCLUDED.{column}' for column in update_columns)} "
+            f"WHERE {' OR '.join(f'{table}.{column} IS DISTINCT FROM EXCLUDED.{column}' for column in update_columns)} "
+            f"RETURNING *) "
+            f"SELECT * FROM upsert UNION ALL "
+            f"SELECT * FROM {table} WHERE {username_column} = %s AND NOT EXISTS (SELECT 1 FROM upsert)"
+        )
+        users = list(self.raw(sql, [*values, username]))
+        return users[0] if users else None
 
 
 class User(AbstractUser):
     photo_url = models.TextField(null=True, blank=True)
     auth_date = models.DateTimeField(null=True)
+
+    objects = UserManager()
+
+
+class ChatGroup(models.Model):
+    """
+    Named set of chats notified through single webhook url.
+    """
+    name = models.SlugField(unique=True)
+    chat_ids = models.TextField(help_text="Chat ids separated by spaces, commas or new lines.")
+
+    def __str__(self):
+        return self.name
+
+    def get_chat_ids(self):
+        return list(dict.fromkeys(filter(None, re.split(r'[\s,]+', self.chat_ids))))
+
+
+class OutboxMessageManager(models.Manager):
+    def enqueue(self, chat_id, **fields):
+        """
+        Create pending message. With coalescing window it is delayed until the end of window
+        that was opened by the first waiting message of the chat, so the worker can send
+        them together. Full window is flushed immediately.
+        """
+        window = settings.REPORT_COALESCE_WINDOW
+        if not window:
+            return self.create(chat_id=chat_id, **fields)
+
+        now = timezone.now()
+        with transaction.atomic():
+            waiting = self.filter(
+                chat_id=chat_id,
+                status=OutboxMessage.PENDING,
+                attempts=0,
+                next_attempt_at__gt=now,
+            )
+            first = waiting.order_by('next_attempt_at').first()
+            flush_at = first.next_attempt_at if first else now + timedelta(seconds=window)
+            message = self.create(chat_id=chat_id, next_attempt_at=flush_at, **fields)
+            if waiting.count() >= settings.REPORT_COALESCE_MAX:
+                waiting.update(next_attempt_at=now)
+        return message
+
+
+class OutboxMessage(models.Model):
+    """
+    Report accepted from travis and waiting to be delivered to telegram by outbox worker.
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    SENT = 'sent'
+    DEAD = 'dead'
+    STATUS_CHOICES = (
+        (PENDING, 'pending'),
+        (PROCESSING, 'processing'),
+        (SENT, 'sent'),
+        (DEAD, 'dead'),
+    )
+
+    chat_id = models.CharField(max_length=64)
+    text = models.TextField()
+    simple_text = models.TextField()
+    build_url = models.TextField(blank=True)
+    compare_url = models.TextField(blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    claimed_by = models.CharField(max_length=64, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    # json with short description of build for digests
+    summary = models.TextField(blank=True)
+
+    objects = OutboxMessageManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.chat_id} [{self.status}]"
+
+    def get_summary(self):
+        return json.loads(self.summary) if self.summary else None
+
+
+class BuildMessage(models.Model):
+    """
+    Telegram message with report about build, later reports of the build edit it.
+    """
+    chat_id = models.CharField(max_length=64)
+    repository_id = models.BigIntegerField()
+    build_id = models.BigIntegerField()
+    message_id = models.BigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        unique_together = ('chat_id', 'repository_id', 'build_id')
+
+    def __str__(self):
+        return f"{self.chat_id}/{self.repository_id}/{self.build_id}"
+
+
+class BuildStatusManager(models.Manager):
+    def advance(self, chat_id, repository_id, branch, passed: bool, build_number: int, finished_at):
+        """
+        Store status of build unless newer build of the branch is already stored.
+        Return whether it was stored and previously stored status, None for the first build.
+        Single query on postgres, elsewhere row is locked in transaction.
+        """
+        fields = dict(passed=passed, build_number=build_number, finished_at=finished_at)
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            return self._advance_returning(connection, chat_id, repository_id, branch, fields)
+        with transaction.atomic(using=self.db):
+            status, created = self.select_for_update().get_or_create(
+                chat_id=chat_id,
+                repository_id=repository_id,
+                branch=branch,
+                defaults=fields,
+            )
+            if created:
+                return True, None
+            previous = status.passed
+            if (build_number, finished_at) <= (status.build_number, status.finished_at):
+                return False, previous
+            for key, value in fields.items():
+                setattr(status, key, value)
+            status.save()
+            return True, previous
+
+    def _advance_returning(self, connection, chat_id, repository_id, branch, fields: dict):
+        """
+        INSERT ... ON CONFLICT that updates row only if stored build is older,
+        previous status is read from the snapshot taken before the insert.
+        """
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        status = self.model(chat_id=chat_id, repository_id=repository_id, branch=branch, **fields)
+        insert_fields = [field for field in opts.concrete_fields if not field.primary_key]
+        values = [field.get_db_prep_save(field.pre_save(status, True), connection) for field in insert_fields]
+        table = qn(opts.db_table)
+        key_columns = [qn(opts.get_field(key).column) for key in ('chat_id', 'repository_id', 'branch')]
+        update_columns = [qn(opts.get_field(key).column) for key in [*fields, 'updated_at']]
+        number = qn(opts.get_field('build_number').column)
+        finished_at = qn(opts.get_field('finished_at').column)
+        passed = qn(opts.get_field('passed').column)
+        sql = (
+            f"WITH old AS ("
+            f"SELECT {passed} FROM {table} WHERE {' AND '.join(f'{column} = %s' for column in key_columns)}), "
+            f"upsert AS ("
+            f"INSERT INTO {table} ({', '.join(qn(field.column) for field in insert_fields)}) "
+            f"VALUES ({', '.join(['%s'] * len(values))}) "
+            f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET "
+            f"{', '.join(f'{column} = EXCLUDED.{column}' for column in update_columns)} "
+            f"WHERE ({table}.{number}, {table}.{finished_at}) < (EXCLUDED.{number}, EXCLUDED.{finished_at}) "
+            f"RETURNING 1) "
+            f"SELECT EXISTS (SELECT 1 FROM upsert), (SELECT {passed} FROM old)"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [chat_id, repository_id, branch, *values])
+            applied, previous = cursor.fetchone()
+        return applied, previous
+
+
+class BuildStatus(models.Model):
+    """
+    Status of the latest finished build of repository branch reported to chat.
+    """
+    chat_id = models.CharField(max_length=64)
+    repository_id = models.BigIntegerField()
+    branch = models.CharField(max_length=255)
+    passed = models.BooleanField()
+    build_number = models.BigIntegerField()
+    finished_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = BuildStatusManager()
+
+    class Meta:
+        unique_together = ('chat_id', 'repository_id', 'branch')
+        verbose_name_plural = 'build statuses'
+
+    def __str__(self):
+        return f"{self.chat_id}/{self.repository_id}/{self.branch}"
+
+
+class DedupClaimManager(models.Manager):
+    def claim(self, key: str, ttl: float) -> bool:
+        """
+        Create claim of the key or take over expired one. False if the key is already claimed.
+        Single query on postgres, elsewhere insert in savepoint plus update of expired claim on conflict.
+        """
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=ttl)
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            return self._claim_returning(connection, key, now, expires_at)
+        try:
+            with transaction.atomic(using=self.db):
+                self.create(key=key, expires_at=expires_at)
+        except IntegrityError:
+            return bool(self.filter(key=key, expires_at__lte=now).update(expires_at=expires_at))
+        return True
+
+    def _claim_returning(self, connection, key, now, expires_at) -> bool:
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        key_column = qn(opts.get_field('key').column)
+        expires_column = qn(opts.get_field('expires_at').column)
+        sql = (
+            f"INSERT INTO {table} ({key_column}, {expires_column}) VALUES (%s, %s) "
+            f"ON CONFLICT ({key_column}) DO UPDATE SET {expires_column} = EXCLUDED.{expires_column} "
+            f"WHERE {table}.{expires_column} <= %s "
+            f"RETURNING 1"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [key, expires_at, now])
+            return cursor.fetchone() is not None
+
+    def purge(self) -> int:
+        """
+        Delete expired claims.
+        """
+        deleted, _ = self.filter(expires_at__lte=timezone.now()).delete()
+        return deleted
+
+
+class DedupClaim(models.Model):
+    """
+    Notification delivered to chat, repeated deliveries are ignored until claim expires.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = DedupClaimManager()
+
+    def __str__(self):
+        return self.key
+
+
+class KnownChat(models.Model):
+    """
+    Chat that asked bot for webhook url or whose user logged in on the site.
+    """
+    chat_id = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.chat_id
+
+
+class FilterRule(models.Model):
+    """
+    Chat gets notification only if it matches at least one rule of every field that chat has rules for.
+    """
+    STATUS = 'status'
+    BRANCH = 'branch'
+    REPO = 'repo'
+    EVENT = 'event'
+    AUTHOR = 'author'
+    FIELD_CHOICES = (
+        (STATUS, 'status'),
+        (BRANCH, 'branch'),
+        (REPO, 'repo'),
+        (EVENT, 'event'),
+        (AUTHOR, 'author'),
+    )
+
+    chat_id = models.CharField(max_length=64, db_index=True)
+    field = models.CharField(max_length=16, choices=FIELD_CHOICES)
+    pattern = models.CharField(max_length=255, help_text="Glob pattern, e.g. master, release/*, *fail*.")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __str__(self):
+        return f"{self.field} {self.pattern}"
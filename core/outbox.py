@@ -0,0 +1,152 @@
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from telegram.error import BadRequest, RetryAfter, TelegramError, Unauthorized
+
+from core.models import OutboxMessage
+from core.buildindex import build_messages
+from core.utils import deliver_report, format_digest, format_simple_digest, get_build_key
+
+logger = logging.getLogger(__name__)
+
+
+def get_backoff(attempts: int) -> float:
+    return min(settings.OUTBOX_BACKOFF_BASE ** attempts, settings.OUTBOX_BACKOFF_MAX)
+
+
+def claim_batch(batch_size=None, worker_id=None) -> list:
+    """
+    Mark batch of due messages as processing by current worker and return them.
+    Messages of crashed workers are reclaimed after lock timeout.
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    worker_id = worker_id or uuid.uuid4().hex
+    now = timezone.now()
+    due = OutboxMessage.objects.filter(
+        Q(status=OutboxMessage.PENDING, next_attempt_at__lte=now) |
+        Q(status=OutboxMessage.PROCESSING, locked_until__lte=now)
+    )
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = due.select_for_update(skip_locked=True)
+        else:
+            # sqlite: no row locks, conditional update below makes claim exclusive
+            candidates = due
+        ids = list(candidates.order_by('next_attempt_at').values_list('id', flat=True)[:batch_size])
+        due.filter(id__in=ids).update(
+            status=OutboxMessage.PROCESSING,
+            locked_until=now + timedelta(seconds=settings.OUTBOX_LOCK_TIMEOUT),
+            claimed_by=worker_id,
+        )
+    return list(OutboxMessage.objects.filter(
+        id__in=ids,
+        status=OutboxMessage.PROCESSING,
+        claimed_by=worker_id,
+    ))
+
+
+def deliver_messages(messages: list):
+    if len(messages) == 1:
+        message = messages[0]
+        summary = message.get_summary() or {}
+        build_key = get_build_key(summary.get('repository_id'), summary.get('build_id'))
+        message_id = build_messages.get(message.chat_id, *build_key) if build_key else None
+        _, message_id = deliver_report(
+            message.chat_id,
+            message.text,
+            lambda: message.simple_text,
+            message.build_url,
+            message.compare_url,
+            message_id,
+        )
+        if build_key and message_id is not None:
+            build_messages.set(message.chat_id, *build_key, message_id)
+    else:
+        summaries = [message.get_summary() for message in messages]
+        deliver_report(
+            messages[0].chat_id,
+            format_digest(summaries),
+            lambda: format_simple_digest(summaries),
+            '',
+            '',
+        )
+
+
+def process_messages(messages: list):
+    """
+    Send messages of a single chat as one report or digest and update their state.
+    """
+    for message in messages:
+        message.attempts += 1
+    try:
+        deliver_messages(messages)
+    except (BadRequest, Unauthorized) as e:
+        # won't succeed on retry
+        for message in messages:
+            mark_dead(message, e)
+    except RetryAfter as e:
+        for message in messages:
+            mark_retry(message, e, delay=e.retry_after)
+    except TelegramError as e:
+        for message in messages:
+            mark_retry(message, e)
+    except Exception as e:
+        # bug or database error must not leave messages in processing state until lock expires
+        logger.exception(f"failed to deliver outbox messages of chat {messages[0].chat_id}")
+        for message in messages:
+            mark_retry(message, e)
+    else:
+        for message in messages:
+            message.status = OutboxMessage.SENT
+            message.sent_at = timezone.now()
+            message.locked_until = None
+            message.save(update_fields=['status', 'attempts', 'sent_at', 'locked_until'])
+
+
+def group_messages(messages: list):
+    """
+    Group messages with summaries by chat when coalescing is enabled, others are sent one by one.
+    """
+    groups = {}
+    for message in messages:
+        if message.summary and settings.REPORT_COALESCE_WINDOW:
+            groups.setdefault(message.chat_id, []).append(message)
+        else:
+            yield [message]
+    for group in groups.values():
+        for i in range(0, len(group), settings.REPORT_COALESCE_MAX):
+            yield group[i:i + settings.REPORT_COALESCE_MAX]
+
+
+def mark_retry(message: OutboxMessage, error: Exception, delay: float = None):
+    if message.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        mark_dead(message, error)
+        return
+    if delay is None:
+        delay = get_backoff(message.attempts)
+    logger.debug(f"outbox message {message.id} will be retried in {delay}s: {error}")
+    message.status = OutboxMessage.PENDING
+    message.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+    message.locked_until = None
+    message.last_error = str(error)
+    message.save(update_fields=['status', 'attempts', 'next_attempt_at', 'locked_until', 'last_error'])
+
+
+def mark_dead(message: OutboxMessage, error: Exception):
+    logger.warning(f"outbox message {message.id} is dead: {error}")
+    message.status = OutboxMessage.DEAD
+    message.locked_until = None
+    message.last_error = str(error)
+    message.save(update_fields=['status', 'attempts', 'locked_until', 'last_error'])
+
+
+def process_batch(batch_size=None, worker_id=None) -> int:
+    messages = claim_batch(batch_size, worker_id)
+    for group in group_messages(messages):
+        process_messages(group)
+    return len(messages)
@@ -0,0 +1,230 @@
+"""
+Extraction of the fields we use from travis notification payload.
+
+Most of the payload is `config` and `matrix` (config of every job), which we never read.
+Top level fields are decoded one by one and decoding stops as soon as all needed fields
+are found. Travis puts `matrix` last, so it is never decoded.
+Payloads the scanner can't handle, malformed or with `matrix` before needed fields,
+are decoded whole by the json backend (JSON_BACKEND).
+"""
+import importlib
+import json
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from json.decoder import scanstring
+from typing import NamedTuple, Optional
+
+import dateutil.parser
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+REPORT_FIELDS = frozenset([
+    'id',
+    'number',
+    'type',
+    'state',
+    'status',
+    'status_message',
+    'started_at',
+    'finished_at',
+    'duration',
+    'build_url',
+    'branch',
+    'message',
+    'compare_url',
+    'committed_at',
+    'author_name',
+    'pull_request',
+    'pull_request_number',
+    'pull_request_title',
+    'repository',
+])
+
+JSON_BACKENDS = ['orjson', 'ujson', 'json']
+# fields too large for stdlib scanner, with fast backend payload is decoded by it instead
+BULKY_FIELDS = frozenset(['matrix'])
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+decoder = json.JSONDecoder()
+
+ISO_DATETIME = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?'
+    r'(?:(Z)|([+-])(\d{2}):?(\d{2}))?$'
+)
+
+
+def get_json_loads(backend: str = None):
+    """
+    Return `loads` of the json backend, 'auto' picks the fastest installed one.
+    """
+    backend = backend or settings.JSON_BACKEND
+    names = JSON_BACKENDS if backend == 'auto' else [backend]
+    for name in names:
+        try:
+            return importlib.import_module(name).loads
+        except ImportError:
+            continue
+    raise ImportError(f"json backend {backend} is not installed")
+
+
+json_loads = get_json_loads()
+
+
+def extract_fields(text: str, fields=REPORT_FIELDS) -> dict:
+    """
+    Decode only `fields` of the top level json object.
+    """
+    stop_at = BULKY_FIELDS if json_loads is not json.loads else frozenset()
+    try:
+        data = scan_fields(text, fields, stop_at)
+    except (ValueError, IndexError):
+        data = None
+    if data is None:
+        data = json_loads(text)
+        if not isinstance(data, dict):
+            raise ValueError("payload is not an object")
+        data = {key: value for key, value in data.items() if key in fields}
+    return data
+
+
+def scan_fields(text: str, fields, stop_at=frozenset()) -> Optional[dict]:
+    """
+    Decode `fields` of the top level object with stdlib scanner.
+    Return None if some field from `stop_at` has to be decoded before all `fields` are found.
+    """
+    pos = WHITESPACE.match(text, 0).end()
+    if text[pos] != '{':
+        raise ValueError("payload is not an object")
+    pos += 1
+    result = {}
+    remaining = set(fields)
+    while remaining:
+        pos = WHITESPACE.match(text, pos).end()
+        if text[pos] == '}':
+            break
+        if text[pos] != '"':
+            raise ValueError(f"expected key at {pos}")
+        key, pos = scanstring(text, pos + 1)
+        if key in stop_at and key not in remaining:
+            return None
+        pos = WHITESPACE.match(text, pos).end()
+        if text[pos] != ':':
+            raise ValueError(f"expected ':' at {pos}")
+        pos = WHITESPACE.match(text, pos + 1).end()
+        value, pos = decoder.raw_decode(text, pos)
+        if key in remaining:
+            result[key] = value
+            remaining.discard(key)
+        pos = WHITESPACE.match(text, pos).end()
+        if text[pos] == ',':
+            pos += 1
+        elif text[pos] != '}':
+            raise ValueError(f"expected ',' or '}}' at {pos}")
+    return result
+
+
+@lru_cache(maxsize=64)
+def get_timezone(sign: str, hours: str, minutes: str) -> timezone:
+    offset = timedelta(hours=int(hours), minutes=int(minutes))
+    return timezone(-offset if sign == '-' else offset)
+
+
+def parse_iso_datetime(value: str) -> datetime:
+    """
+    Parse strict `YYYY-MM-DDTHH:MM:SS[.ffffff][Z|+HH:MM]` that travis sends.
+    Raise ValueError for anything else.
+    """
+    match = ISO_DATETIME.match(value)
+    if match is None:
+        raise ValueError(f"not an iso datetime: {value}")
+    year, month, day, hour, minute, second, fraction, utc, sign, tz_hours, tz_minutes = match.groups()
+    if utc:
+        tzinfo = timezone.utc
+    elif sign:
+        tzinfo = get_timezone(sign, tz_hours, tz_minutes)
+    else:
+        tzinfo = None
+    return datetime(
+        int(year), int(month), int(day),
+        int(hour), int(minute), int(second),
+        int(fraction.ljust(6, '0')) if fraction else 0,
+        tzinfo=tzinfo,
+    )
+
+
+def parse_date(value) -> Optional[datetime]:
+    """
+    Parse date of notification, fast path for travis format and dateutil for anything else.
+    Missing and unparsable dates are None.
+    """
+    if not value:
+        return None
+    try:
+        return parse_iso_datetime(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return dateutil.parser.parse(value)
+    except (TypeError, ValueError, OverflowError):
+        logger.warning(f"can't parse date: {value!r}")
+        return None
+
+
+class Repository(NamedTuple):
+    id: Optional[int] = None
+    name: Optional[str] = None
+    owner_name: Optional[str] = None
+    url: Optional[str] = None
+
+    @property
+    def slug(self):
+        return f"{self.owner_name}/{self.name}"
+
+
+class BuildEvent(NamedTuple):
+    """
+    Fields of travis notification used by reports, with dates already parsed.
+    Immutable and slotted, so it is shared by all formatters of the notification.
+    """
+    id: Optional[int] = None
+    number: Optional[str] = None
+    type: Optional[str] = None
+    state: Optional[str] = None
+    status: Optional[int] = None
+    status_message: Optional[str] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    duration: Optional[int] = None
+    build_url: Optional[str] = None
+    branch: Optional[str] = None
+    message: str = ''
+    compare_url: Optional[str] = None
+    committed_at: Optional[datetime] = None
+    author_name: Optional[str] = None
+    pull_request: bool = False
+    pull_request_number: Optional[int] = None
+    pull_request_title: Optional[str] = None
+    repository: Repository = Repository()
+
+    @classmethod
+    def from_payload(cls, data: dict) -> 'BuildEvent':
+        fields = {key: data[key] for key in cls._fields if key in data}
+        for field in ['started_at', 'finished_at', 'committed_at']:
+            fields[field] = parse_date(fields.get(field))
+        repository = data.get('repository') or {}
+        fields['repository'] = Repository(**{
+            key: repository[key] for key in Repository._fields if key in repository
+        })
+        fields['message'] = fields.get('message') or ''
+        return cls(**fields)
+
+    @property
+    def multiline(self):
+        return '\n' in self.message
+
+    @property
+    def repository_id(self):
+        return self.repository.id
@@ -0,0 +1,197 @@
+import cProfile
+import glob
+import json
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signing import BadSignature, TimestampSigner
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+# signed header is accepted for this many seconds after it was issued
+SIGNATURE_MAX_AGE = 3600
+
+
+def get_signer():
+    return TimestampSigner(key=settings.PROFILING_SECRET, salt='core.profiling')
+
+
+def get_safe_path(request) -> str:
+    """
+    Path of request with bot token of telegram webhook url redacted.
+    """
+    token = settings.TELEGRAM_BOT_TOKEN
+    return request.path.replace(token, '<token>') if token else request.path
+
+
+def sign_profile_request() -> str:
+    """
+    Value of `X-Profile` header that forces profiling of request.
+    """
+    return get_signer().sign('profile')
+
+
+class QueryLog:
+    """
+    Database execute wrapper that records every query of a request.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({'sql': sql, 'time': time.perf_counter() - start})
+
+
+class Profile:
+    """
+    Profiler, allocations tracer and query log of single request.
+    """
+
+    def __init__(self, top=None):
+        self.top = settings.PROFILING_TOP if top is None else top
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.profiler = cProfile.Profile()
+        self.queries = QueryLog()
+        self.snapshot = None
+        self.peak_memory = None
+        self.duration = None
+
+    def run(self, func, *args, **kwargs):
+        # tracemalloc may be already enabled with `-X tracemalloc`
+        trace = not tracemalloc.is_tracing()
+        if trace:
+            tracemalloc.start()
+        else:
+            tracemalloc.clear_traces()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(connection.execute_wrapper(self.queries))
+                self.profiler.enable()
+                stack.callback(self.profiler.disable)
+                return func(*args, **kwargs)
+        finally:
+            self.duration = time.perf_counter() - start
+            self.snapshot = tracemalloc.take_snapshot()
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            if trace:
+                tracemalloc.stop()
+
+    def get_allocations(self) -> list:
+        stats = self.snapshot.statistics('lineno')[:self.top]
+        return [
+            {'location': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+            for stat in stats
+        ]
+
+    def save(self, directory: str, **info):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.id)
+        self.profiler.dump_stats(f'{path}.prof')
+        data = {
+            'id': self.id,
+            'created_at': time.time(),
+            'duration': self.duration,
+            'peak_memory': self.peak_memory,
+            'allocations': self.get_allocations(),
+            'queries': self.queries.queries,
+            **info,
+        }
+        with open(f'{path}.json', 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+def list_profiles(directory: str) -> list:
+    """
+    Summaries of saved profiles, the newest first.
+    """
+    profiles = []
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning(f"failed to read profile {path}: {e}")
+    return sorted(profiles, key=lambda profile: profile['created_at'], reverse=True)
+
+
+def rotate_profiles(directory: str, keep: int):
+    for profile in list_profiles(directory)[keep:]:
+        for ext in ('json', 'prof'):
+            try:
+                os.remove(os.path.join(directory, f"{profile['id']}.{ext}"))
+            except FileNotFoundError:
+                pass
+
+
+class ProfilingMiddleware:
+    """
+    Profile views from PROFILING_VIEWS when request has `X-Profile` header signed with
+    PROFILING_SECRET (see `manage.py profiles --sign`) or is picked by PROFILING_SAMPLE_RATE.
+    Profiles are saved in PROFILING_DIR, only last PROFILING_KEEP of them are kept.
+    Middleware is removed from the stack when profiling is not configured.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_DIR or not (settings.PROFILING_SECRET or settings.PROFILING_SAMPLE_RATE):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.views = set(settings.PROFILING_VIEWS)
+        # tracemalloc and query log are process-wide, profile one request at a time
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def is_requested(self, request) -> bool:
+        value = request.META.get(PROFILE_HEADER)
+        if not value or not settings.PROFILING_SECRET:
+            return False
+        try:
+            get_signer().unsign(value, max_age=SIGNATURE_MAX_AGE)
+        except BadSignature:
+            logger.warning("bad profiling header signature")
+            return False
+        return True
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_name = request.resolver_match.view_name
+        if view_name not in self.views:
+            return None
+        if not (self.is_requested(request) or random.random() < settings.PROFILING_SAMPLE_RATE):
+            return None
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            profile = Profile()
+            response = profile.run(view_func, request, *view_args, **view_kwargs)
+            try:
+                profile.save(
+                    settings.PROFILING_DIR,
+                    view=view_name,
+                    method=request.method,
+                    path=get_safe_path(request),
+                    status=response.status_code,
+                )
+                rotate_profiles(settings.PROFILING_DIR, settings.PROFILING_KEEP)
+            except OSError as e:
+                logger.warning(f"failed to save profile: {e}")
+        finally:
+            self._lock.release()
+        response['X-Profile-Id'] = profile.id
+        return response
@@ -0,0 +1,175 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+from functools import partial
+
+from django.conf import settings
+from telegram import Bot
+from telegram.error import RetryAfter
+
+from core.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Tokens may go negative - callers reserve their slot
+    in the queue and wait for it instead of polling.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0, now: float = 0.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        with self._lock:
+            self._refill(now)
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def reserve(self, now: float, max_wait: float = None):
+        """
+        Take one token. Return time to wait before it may be used,
+        or None without taking token if it is longer than max_wait.
+        """
+        with self._lock:
+            self._refill(now)
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def release(self):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, delay: float, now: float):
+        """
+        Don't give out tokens for the next `delay` seconds.
+        """
+        with self._lock:
+            self._refill(now)
+            self.tokens = min(self.tokens, 1 - delay * self.rate)
+
+
+class SendScheduler:
+    """
+    Paces messages sent by the bot according to telegram limits:
+    global messages per second and messages per second in every chat.
+    Waits out `RetryAfter` errors up to `max_wait` seconds, longer waits are
+    raised to the caller as `RetryAfter`.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        global_rate: float = None,
+        chat_rate: float = None,
+        max_wait: float = None,
+        retries: int = None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.bot = bot
+        self.global_rate = settings.TELEGRAM_GLOBAL_RATE if global_rate is None else global_rate
+        self.chat_rate = settings.TELEGRAM_CHAT_RATE if chat_rate is None else chat_rate
+        self.max_wait = settings.TELEGRAM_MAX_SEND_WAIT if max_wait is None else max_wait
+        self.retries = settings.TELEGRAM_SEND_RETRIES if retries is None else retries
+        self.clock = clock
+        self.sleep = sleep
+        self.reset()
+
+    def reset(self):
+        self.global_bucket = TokenBucket(self.global_rate, 1.0, self.clock())
+        self.chat_buckets = LRUCache(maxsize=10000)
+
+    def get_chat_bucket(self, chat_id) -> TokenBucket:
+        return self.chat_buckets.get_or_set(
+            str(chat_id),
+            lambda: TokenBucket(self.chat_rate, 1.0, self.clock()),
+        )
+
+    def acquire(self, chat_id):
+        now = self.clock()
+        chat_bucket = self.get_chat_bucket(chat_id)
+        chat_wait = chat_bucket.reserve(now, self.max_wait)
+        if chat_wait is None:
+            raise RetryAfter(math.ceil(chat_bucket.wait_time(now)))
+        global_wait = self.global_bucket.reserve(now, self.max_wait)
+        if global_wait is None:
+            chat_bucket.release()
+            raise RetryAfter(math.ceil(self.global_bucket.wait_time(now)))
+        wait = max(chat_wait, global_wait)
+        if wait > 0:
+            self.sleep(wait)
+
+    def call(self, chat_id, func):
+        """
+        Call bot method that posts to chat when limits allow.
+        """
+        for attempt in range(self.retries + 1):
+            self.acquire(chat_id)
+            try:
+                return func()
+            except RetryAfter as e:
+                if attempt == self.retries or e.retry_after > self.max_wait:
+                    raise
+                logger.debug(f"flood control in chat {chat_id}, retry in {e.retry_after}s")
+                self.get_chat_bucket(chat_id).pause(e.retry_after, self.clock())
+
+    def send_message(self, chat_id, text: str, **kwargs):
+        return self.call(chat_id, partial(self.bot.send_message, chat_id, text, **kwargs))
+
+    def edit_message_text(self, chat_id, message_id, text: str, **kwargs):
+        return self.call(chat_id, partial(
+            self.bot.edit_message_text,
+            text,
+            chat_id=chat_id,
+            message_id=message_id,
+            **kwargs,
+        ))
+
+
+class SlidingWindowLimiter:
+    """
+    Allows at most `limit` hits of every key within last `window` seconds.
+    Keeps timestamps of recent hits of recently seen keys only.
+    """
+
+    def __init__(self, limit: int, window: float, maxsize=10000, clock=time.monotonic):
+        self.limit = limit
+        self.window = window
+        self.clock = clock
+        self.hits = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.limit and self.window)
+
+    def allow(self, key) -> bool:
+        if not self.enabled:
+            return True
+        now = self.clock()
+        hits = self.hits.get_or_set(key, deque)
+        with self._lock:
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+            if len(hits) >= self.limit:
+                return False
+            hits.append(now)
+            return True
+
+    def clear(self):
+        self.hits.clear()
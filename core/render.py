@@ -0,0 +1,87 @@
+"""
+Renderers of build report. All of them produce the same text as `templates/report.html`,
+which stays the reference for the report format.
+"""
+from functools import lru_cache
+
+from django.conf import settings
+from django.template.loader import get_template, render_to_string
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+from django.utils.timezone import template_localtime
+
+from core.payload import BuildEvent
+from core.templatetags.core import duration, md, md_entity
+
+
+def render_template(build: BuildEvent) -> str:
+    return render_to_string('report.html', context={'build': build})
+
+
+@lru_cache(maxsize=1)
+def get_report_template():
+    return get_template('report.html')
+
+
+def render_compiled(build: BuildEvent) -> str:
+    """
+    Render template that is looked up and compiled only once.
+    """
+    return get_report_template().render({'build': build})
+
+
+def text(value) -> str:
+    # what django does with {{ value }}
+    return conditional_escape(localize(value))
+
+
+def date(value) -> str:
+    # what django does with {{ value|date:'Y/m/d H:i:s' }}
+    if value is None:
+        return ''
+    d = template_localtime(value)
+    return f"{d.year}/{d.month:02d}/{d.day:02d} {d.hour:02d}:{d.minute:02d}:{d.second:02d}"
+
+
+def render_python(build: BuildEvent) -> str:
+    """
+    Format report without template engine.
+    """
+    success = build.status == 0
+    repository = build.repository
+    pull_request = ''
+    if build.pull_request:
+        pull_request = (
+            f"\n*Pull Request #{text(build.pull_request_number)}:* {md(build.pull_request_title)}"
+        )
+    message = md(build.message)
+    if build.multiline:
+        message = '\n' + message
+    return (
+        f"\n{'✅' if success else '❌'} "
+        f"*{md_entity(repository.owner_name)}/{md_entity(repository.name)}*\n"
+        f"\n"
+        f"Build #{text(build.number)} {'completed successfully' if success else 'failed'}\n"
+        f"Status: {md(build.status_message)}\n"
+        f"\n"
+        f"*Branch:* {md(build.branch)}{pull_request}\n"
+        f"*Author:* {md(build.author_name)}\n"
+        f"*Message:* {message}\n"
+        f"\n"
+        f"---\n"
+        f"\n"
+        f"Duration: {conditional_escape(duration(build.duration))}\n"
+        f"Started: {date(build.started_at)}\n"
+        f"Finished: {date(build.finished_at)}\n"
+    )
+
+
+RENDERERS = {
+    'template': render_template,
+    'compiled': render_compiled,
+    'python': render_python,
+}
+
+
+def get_renderer(name: str = None):
+    return RENDERERS[name or settings.REPORT_RENDERER]
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ConfigServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for travis config api. Serves `/<name>/config` for each key in `keys`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        self.keys = {}
+        self.status = 200
+        self.delay = 0.0
+        self.hits = []
+        super().__init__(('127.0.0.1', 0), ConfigHandler)
+
+    def url(self, name):
+        return f'http://127.0.0.1:{self.server_port}/{name}/config'
+
+
+class ConfigHandler(BaseHTTPRequestHandler):
+    server: ConfigServer
+
+    def do_GET(self):
+        name = self.path.strip('/').split('/')[0]
+        self.server.hits.append(name)
+        time.sleep(self.server.delay)
+        if self.server.status != 200 or name not in self.server.keys:
+            self.send_response(self.server.status if self.server.status != 200 else 404)
+            self.end_headers()
+            return
+        body = json.dumps({
+            'config': {'notifications': {'webhook': {'public_key': self.server.keys[name]}}},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class BotApiServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for telegram bot api. Result of method is taken from `results`,
+    callables are called with request params, default result is `True`.
+    Calls are recorded as (method, params, client port).
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        self.results = {}
+        self.calls = []
+        super().__init__(('127.0.0.1', 0), BotApiHandler)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/bot'
+
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    server: BotApiServer
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't wait for ack between them on kept alive connection
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_api_call({})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.handle_api_call(json.loads(body) if body else {})
+
+    def handle_api_call(self, params):
+        method = self.path.rsplit('/', 1)[-1]
+        self.server.calls.append((method, params, self.client_address[1]))
+        result = self.server.results.get(method, True)
+        if callable(result):
+            result = result(params)
+        if isinstance(result, dict) and 'ok' in result:
+            status, data = result.get('error_code', 200), result
+        else:
+            status, data = 200, {'ok': True, 'result': result}
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve(server):
+    """
+    Run server in background thread while in context.
+    """
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
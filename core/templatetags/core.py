@@ -1,10 +1,32 @@
 from django import template
+from django.utils.safestring import mark_safe
+from telegram.utils.helpers import escape_markdown
+
+from core.markup import strip_entity
 
 register = template.Library()
 
 
 @register.filter
 def duration(d: int):
+    if d is None:
+        return '-'
     m = d // 60
     s = d % 60
     return f"{m}:{s:0d}"
+
+
+@register.filter
+def md(value):
+    """
+    Escape markdown in text outside of entities.
+    """
+    return mark_safe(escape_markdown(str(value)))
+
+
+@register.filter
+def md_entity(value, char='*'):
+    """
+    Make text safe to use inside of entity wrapped in `char`.
+    """
+    return mark_safe(strip_entity(str(value), char))
@@ -2,11 +2,19 @@ import base64
 import hashlib
 import hmac
 import json
-from time import time
+import os
+import random
+import signal
+import threading
+import tracemalloc
+from datetime import datetime, timedelta
+from time import time, sleep, monotonic, perf_counter
 from unittest.mock import Mock
 
 import pytest
+import dateutil.parser
 import requests
+from dateutil.tz import tzoffset, tzutc
 from OpenSSL.crypto import (
     sign,
     load_privatekey,
@@ -19,22 +27,73 @@ from OpenSSL.crypto import (
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.http import HttpRequest, HttpResponse
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
 from django.urls import reverse
-from telegram import Bot, Update, TelegramError
-from telegram.error import BadRequest
+from django.utils import timezone
+from telegram import Bot, Chat, Message, Update, TelegramError
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 
 import core.bot
 import core.utils
-from core.bot import command_start, command_webhook, bot, dispatcher
+import core.views
+from core.background import BackgroundTasks, background
+from core.bench import Replay, generate_corpus, load_corpus, percentile, summarize
+from core.cache import LRUCache
+from core.chats import known_chats
+from core.dedup import deduplicator
+from core.markup import MAX_MESSAGE_LENGTH, check_markdown
+from core.buildindex import build_messages, BuildMessageIndex
+from core.management.commands.runbot import Command as RunBotCommand
+from core.filters import ChatFilter, chat_filters
+from core.models import BuildMessage, BuildStatus, ChatGroup, DedupClaim, FilterRule, KnownChat, OutboxMessage
+from core.profiling import ProfilingMiddleware, list_profiles, sign_profile_request
+from core.payload import (
+    REPORT_FIELDS,
+    BuildEvent,
+    Repository,
+    extract_fields,
+    get_json_loads,
+    parse_date,
+    parse_iso_datetime,
+)
+from core.outbox import claim_batch, process_batch
+from core.transitions import build_statuses
+from core.ratelimit import SendScheduler, SlidingWindowLimiter, TokenBucket
+from core.render import get_renderer, render_template
+from core.bot import (
+    command_start,
+    command_webhook,
+    update_filters,
+    bot,
+    dispatcher,
+    InstrumentedRequest,
+    get_bot_username,
+    get_inline_reply,
+    update_workers,
+)
+from core.metrics import (
+    Histogram,
+    MetricsRegistry,
+    report_outcomes,
+    stage_latency,
+    telegram_latency,
+)
 from core.utils import (
     get_tg_auth_payload,
     get_user,
     render_index,
     TravisSignatureChecker,
+    PublicKeyCache,
+    RenderedFile,
+    load_certificate,
     send_report,
     validate_tg_auth_data,
     format_build_report,
     format_simple_report,
+    format_digest,
 )
 
 User = get_user_model()
@@ -61,6 +120,19 @@ def generate_signature(pem_private_key, content):
     return signature
 
 
+def create_command_update(command: str, chat_id=1111):
+    return {
+        'update_id': 1,
+        'message': {
+            'message_id': 1,
+            'date': 1565092779,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': command,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}],
+        },
+    }
+
+
 def create_travis_payload():
     return json.dumps({
         'number': 13,
@@ -107,6 +179,38 @@ class TestUtils:
         assert user.first_name == 'b'
         assert User.objects.count() == 1
 
+    def test_get_user_new_password(self):
+        user = get_user({'id': '1234', 'first_name': 'name', 'auth_date': '1565087891'})
+        user.refresh_from_db()
+        assert not user.has_usable_password()
+        assert user.auth_date == datetime(2019, 8, 6, 10, 38, 11, tzinfo=tzutc())
+
+    def test_get_user_queries(self, django_assert_num_queries):
+        if connection.vendor != 'sqlite':
+            pytest.skip('query counts of select and insert in savepoint are checked on sqlite')
+        data = {'id': '1234', 'first_name': 'a', 'auth_date': '1565087891'}
+        # select, then insert inside of savepoint
+        with django_assert_num_queries(4):
+            get_user(data)
+        with django_assert_num_queries(1):
+            get_user(data)
+        with django_assert_num_queries(2) as context:
+            get_user({**data, 'first_name': 'b'})
+        update = context.captured_queries[-1]['sql']
+        assert 'first_name' in update
+        assert 'last_name' not in update
+        assert User.objects.get(username='1234').first_name == 'b'
+
+    def test_get_user_queries_postgres(self, django_assert_num_queries):
+        if connection.vendor != 'postgresql':
+            pytest.skip('upsert with returning is used only on postgres')
+        data = {'id': '1234', 'first_name': 'a'}
+        for fields in [data, data, {**data, 'first_name': 'b'}]:
+            with django_assert_num_queries(1):
+                user = get_user(fields)
+        assert user.first_name == 'b'
+        assert User.objects.count() == 1
+
     def test_validate_tg_auth_data_no_hash(self):
         assert not validate_tg_auth_data({})
 
@@ -199,45 +303,1669 @@ class TestUtils:
         assert not tsc.validate(req)
 
 
+class TestPublicKeyCache:
+    def create_cache(self, server, **kwargs):
+        params = {'ttl': 60, 'refresh_ahead': 10, 'retry_delay': 5, 'timeout': 1.0, **kwargs}
+        return PublicKeyCache(urls=[server.url('org'), server.url('com')], **params)
+
+    def wait_for(self, predicate, timeout=2.0):
+        deadline = time() + timeout
+        while time() < deadline:
+            if predicate():
+                return True
+            sleep(0.01)
+        return False
+
+    def test_hit_miss(self, config_server):
+        config_server.keys = {'org': 'org-key', 'com': 'com-key'}
+        cache = self.create_cache(config_server)
+        assert cache.get() == ['org-key', 'com-key']
+        assert cache.get() == ['org-key', 'com-key']
+        assert cache.get() == ['org-key', 'com-key']
+        assert (cache.hits, cache.misses) == (2, 1)
+        assert sorted(config_server.hits) == ['com', 'org']
+
+    def test_expired(self, config_server, mocker):
+        config_server.keys = {'org': 'org-key', 'com': 'com-key'}
+        cache = self.create_cache(config_server)
+        cache.get()
+        config_server.keys = {'org': 'new-org-key', 'com': 'new-com-key'}
+        mocker.patch('core.utils.time.monotonic', return_value=monotonic() + 120)
+        assert cache.get() == ['new-org-key', 'new-com-key']
+        assert cache.misses == 2
+
+    def test_background_refresh(self, config_server, mocker):
+        config_server.keys = {'org': 'org-key', 'com': 'com-key'}
+        cache = self.create_cache(config_server)
+        cache.get()
+        config_server.keys = {'org': 'new-org-key', 'com': 'new-com-key'}
+        mocker.patch('core.utils.time.monotonic', return_value=monotonic() + 55)
+        # old keys are served while refresh is running
+        assert cache.get() == ['org-key', 'com-key']
+        assert cache.hits == 1
+        assert self.wait_for(lambda: cache.get() == ['new-org-key', 'new-com-key'])
+        assert len(config_server.hits) == 4
+
+    def test_refresh_fail_keeps_last_good_key(self, config_server, mocker):
+        config_server.keys = {'org': 'org-key', 'com': 'com-key'}
+        cache = self.create_cache(config_server)
+        cache.get()
+        config_server.status = 500
+        mocker.patch('core.utils.time.monotonic', return_value=monotonic() + 120)
+        assert cache.get() == ['org-key', 'com-key']
+        # failed refresh is not repeated until retry delay passes
+        assert cache.get() == ['org-key', 'com-key']
+        assert len(config_server.hits) == 4
+
+    def test_partial_fail(self, config_server, mocker):
+        config_server.keys = {'com': 'com-key'}
+        cache = self.create_cache(config_server)
+        assert cache.get() == [None, 'com-key']
+        config_server.keys = {'org': 'org-key', 'com': 'com-key'}
+        assert cache.get() == [None, 'com-key']
+        # missing key is fetched again after retry delay, not after ttl
+        mocker.patch('core.utils.time.monotonic', return_value=monotonic() + 6)
+        assert self.wait_for(lambda: cache.get() == ['org-key', 'com-key'])
+
+    def test_all_fail(self, config_server):
+        config_server.status = 500
+        cache = self.create_cache(config_server)
+        assert cache.get() == [None, None]
+        assert cache.get() == [None, None]
+        assert cache.misses == 2
+
+    def test_parallel_fetch(self, config_server):
+        config_server.keys = {'org': 'org-key', 'com': 'com-key'}
+        config_server.delay = 0.3
+        cache = self.create_cache(config_server)
+        start = monotonic()
+        assert cache.get() == ['org-key', 'com-key']
+        assert monotonic() - start < 0.55
+
+    def test_concurrent_misses_fetch_once(self, config_server):
+        config_server.keys = {'org': 'org-key', 'com': 'com-key'}
+        config_server.delay = 0.1
+        cache = self.create_cache(config_server)
+        threads = [threading.Thread(target=cache.get) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(config_server.hits) == 2
+
+    def test_checker_uses_cache(self, config_server):
+        pub, pri = generate_keys()
+        config_server.keys = {'org': pub.decode()}
+        payload = '{"foo": "bar"}'
+        req = HttpRequest()
+        req.POST['payload'] = payload
+        req.META['HTTP_SIGNATURE'] = base64.b64encode(generate_signature(pri, payload))
+        tsc = TravisSignatureChecker(self.create_cache(config_server))
+        assert tsc.validate(req)
+        assert tsc.validate(req)
+        assert len(config_server.hits) == 2
+
+
+class TestSignatureFastPath:
+    def create_request(self, private_key, payload='{"foo": "bar"}'):
+        req = HttpRequest()
+        req.POST['payload'] = payload
+        req.META['HTTP_SIGNATURE'] = base64.b64encode(generate_signature(private_key, payload))
+        return req
+
+    def test_load_certificate_cached(self):
+        pub, _ = generate_keys()
+        assert load_certificate(pub) is load_certificate(pub)
+
+    def test_remember_repo_key(self, mocker):
+        org_pub, _ = generate_keys()
+        com_pub, com_pri = generate_keys()
+        tsc = TravisSignatureChecker()
+        mocker.patch.object(tsc, 'gen_public_key', return_value=[org_pub, com_pub])
+        mocker.spy(tsc, 'check_authorized')
+
+        assert tsc.validate(self.create_request(com_pri), repository_id=1)
+        assert tsc.check_authorized.call_count == 2
+
+        assert tsc.validate(self.create_request(com_pri), repository_id=1)
+        assert tsc.check_authorized.call_count == 3
+        assert tsc.check_authorized.call_args[0][1] == com_pub
+
+    def test_remembered_key_rotated(self, mocker):
+        org_pub, org_pri = generate_keys()
+        com_pub, com_pri = generate_keys()
+        tsc = TravisSignatureChecker()
+        mocker.patch.object(tsc, 'gen_public_key', return_value=[org_pub, com_pub])
+        assert tsc.validate(self.create_request(com_pri), repository_id=1)
+        # repo moved to another endpoint
+        assert tsc.validate(self.create_request(org_pri), repository_id=1)
+        new_pub, new_pri = generate_keys()
+        tsc.gen_public_key.return_value = [new_pub]
+        assert tsc.validate(self.create_request(new_pri), repository_id=1)
+
+    @pytest.mark.benchmark
+    def test_benchmark(self, mocker):
+        org_pub, _ = generate_keys()
+        com_pub, com_pri = generate_keys()
+        requests = [self.create_request(com_pri, f'{{"number": "{i}"}}') for i in range(200)]
+        verify = mocker.spy(core.utils, 'verify')
+
+        def validate_all(remember):
+            tsc = TravisSignatureChecker()
+            mocker.patch.object(tsc, 'gen_public_key', return_value=[org_pub, com_pub])
+            tsc.validate(requests[0], repository_id=1)
+            verify.reset_mock()
+            start = perf_counter()
+            for req in requests:
+                assert tsc.validate(req, repository_id=1 if remember else None)
+            return perf_counter() - start
+
+        cold_time = validate_all(remember=False)
+        assert verify.call_count == 2 * len(requests)
+        steady_time = validate_all(remember=True)
+        # one rsa verify per request once repo key is remembered
+        assert verify.call_count == len(requests)
+        assert steady_time < cold_time
+
+    @pytest.mark.django_db
+    def test_send_report_passes_repository_id(self, mocker, settings):
+        settings.CHECK_SIGNATURE = True
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+        req = HttpRequest()
+        req.POST['payload'] = json.dumps({**json.loads(create_travis_payload()), 'repository': {'id': 7}})
+        send_report(req, chat_id='1111')
+        assert TravisSignatureChecker.validate.call_args[0][1] == 7
+
+    def test_send_report_bad_payload(self):
+        req = HttpRequest()
+        req.POST['payload'] = '{bad json'
+        res = send_report(req, chat_id='1111')
+        assert res.status_code == 400
+
+
+class TestLRUCache:
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert 'b' not in cache
+        assert 'a' in cache
+        assert len(cache) == 2
+
+    def test_ttl(self, mocker):
+        cache = LRUCache(ttl=10)
+        cache.set('a', 1)
+        mocker.patch('core.cache.time.monotonic', return_value=monotonic() + 20)
+        assert cache.get('a') is None
+        assert len(cache) == 0
+
+    def test_pop(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        assert cache.pop('a') == 1
+        assert cache.pop('a', 2) == 2
+
+
+@pytest.mark.django_db
+class TestOutbox:
+    @pytest.fixture(autouse=True)
+    def outbox_settings(self, settings):
+        settings.OUTBOX_ENABLED = True
+        settings.OUTBOX_MAX_ATTEMPTS = 3
+
+    def create_message(self, **kwargs):
+        fields = {
+            'chat_id': '1111',
+            'text': 'text',
+            'simple_text': 'simple text',
+            'build_url': 'example.com',
+            'compare_url': 'example.com',
+            **kwargs,
+        }
+        return OutboxMessage.objects.create(**fields)
+
+    def test_send_report_enqueues(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+        req = HttpRequest()
+        req.POST['payload'] = create_travis_payload()
+        res = send_report(req, chat_id='1111')
+        assert res.status_code == 202
+        assert Bot.send_message.call_count == 0
+        message = OutboxMessage.objects.get()
+        assert message.chat_id == '1111'
+        assert message.status == OutboxMessage.PENDING
+        assert 'build' in message.text.lower()
+
+    def test_process_batch(self):
+        message = self.create_message()
+        assert process_batch() == 1
+        message.refresh_from_db()
+        assert message.status == OutboxMessage.SENT
+        assert message.attempts == 1
+        assert Bot.send_message.call_args[0][1] == 'text'
+        assert process_batch() == 0
+
+    def test_fallback_to_simple(self, mocker):
+        mocker.patch.object(Bot, 'send_message', side_effect=[BadRequest('force error'), None])
+        message = self.create_message()
+        process_batch()
+        message.refresh_from_db()
+        assert message.status == OutboxMessage.SENT
+        assert Bot.send_message.call_args[0][1] == 'simple text'
+
+    def test_bad_request_is_dead(self, mocker):
+        mocker.patch.object(Bot, 'send_message', side_effect=BadRequest('force error'))
+        message = self.create_message()
+        process_batch()
+        message.refresh_from_db()
+        assert message.status == OutboxMessage.DEAD
+        assert 'force error' in message.last_error
+
+    def test_retry_with_backoff(self, mocker):
+        mocker.patch.object(Bot, 'send_message', side_effect=NetworkError('force error'))
+        message = self.create_message()
+        process_batch()
+        message.refresh_from_db()
+        assert message.status == OutboxMessage.PENDING
+        assert message.attempts == 1
+        assert message.next_attempt_at > timezone.now()
+        # not due yet
+        assert process_batch() == 0
+
+    def test_retry_after(self, mocker):
+        mocker.patch.object(Bot, 'send_message', side_effect=RetryAfter(30))
+        message = self.create_message()
+        process_batch()
+        message.refresh_from_db()
+        delay = (message.next_attempt_at - timezone.now()).total_seconds()
+        assert 25 < delay <= 30
+
+    def test_dead_after_max_attempts(self, mocker):
+        mocker.patch.object(Bot, 'send_message', side_effect=NetworkError('force error'))
+        message = self.create_message()
+        for _ in range(3):
+            OutboxMessage.objects.update(next_attempt_at=timezone.now())
+            process_batch()
+        message.refresh_from_db()
+        assert message.status == OutboxMessage.DEAD
+        assert message.attempts == 3
+
+    def test_unexpected_error_is_retried(self, mocker):
+        mocker.patch.object(Bot, 'send_message', side_effect=[KeyError('boom'), None])
+        message = self.create_message()
+        process_batch()
+        message.refresh_from_db()
+        assert message.status == OutboxMessage.PENDING
+        assert 'boom' in message.last_error
+        OutboxMessage.objects.update(next_attempt_at=timezone.now())
+        process_batch()
+        message.refresh_from_db()
+        assert message.status == OutboxMessage.SENT
+
+    def test_command_survives_error(self, mocker):
+        def process_batch(*args):
+            if batch.call_count == 1:
+                raise DatabaseError('gone')
+            # loop is still running, stop it as on deploy
+            os.kill(os.getpid(), signal.SIGTERM)
+            return 0
+
+        batch = mocker.patch('core.management.commands.runoutbox.process_batch', side_effect=process_batch)
+        stderr = Mock()
+        call_command('runoutbox', '--poll-interval', '0', stdout=Mock(), stderr=stderr)
+        assert batch.call_count == 2
+        assert 'gone' in stderr.write.call_args[0][0]
+
+    def test_claim_is_exclusive(self):
+        for _ in range(5):
+            self.create_message()
+        first = claim_batch(3, 'first')
+        second = claim_batch(3, 'second')
+        assert len(first) == 3
+        assert len(second) == 2
+        assert not {m.id for m in first} & {m.id for m in second}
+        assert claim_batch(3, 'third') == []
+
+    def test_reclaim_expired_lock(self):
+        self.create_message()
+        assert len(claim_batch(worker_id='crashed')) == 1
+        OutboxMessage.objects.update(locked_until=timezone.now())
+        assert len(claim_batch(worker_id='other')) == 1
+
+    def test_command(self):
+        for _ in range(3):
+            self.create_message()
+        call_command('runoutbox', '--once', '--batch-size', '2')
+        assert OutboxMessage.objects.filter(status=OutboxMessage.SENT).count() == 3
+
+
+@pytest.mark.django_db
+class TestCoalesce:
+    @pytest.fixture(autouse=True)
+    def coalesce_settings(self, settings, mocker):
+        settings.OUTBOX_ENABLED = True
+        settings.REPORT_COALESCE_WINDOW = 30
+        settings.REPORT_COALESCE_MAX = 3
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+
+    def send(self, chat_id='1111', number=13):
+        req = HttpRequest()
+        req.POST['payload'] = json.dumps({
+            **json.loads(create_travis_payload()),
+            'number': number,
+            'repository': {'owner_name': 'owner', 'name': 'repo'},
+            'branch': 'master',
+            'status': 0,
+        })
+        return send_report(req, chat_id=chat_id)
+
+    def test_window(self):
+        self.send(number=1)
+        self.send(number=2)
+        self.send(chat_id='2222', number=3)
+        first, second, other = OutboxMessage.objects.order_by('id')
+        assert first.next_attempt_at > timezone.now()
+        assert first.next_attempt_at == second.next_attempt_at
+        assert process_batch() == 0
+
+        OutboxMessage.objects.update(next_attempt_at=timezone.now())
+        assert process_batch() == 3
+        assert Bot.send_message.call_count == 2
+        texts = [c[0][1] for c in Bot.send_message.call_args_list]
+        digest = next(t for t in texts if '#1' in t)
+        assert '#2' in digest
+        assert '2 builds' in digest
+        assert not OutboxMessage.objects.exclude(status=OutboxMessage.SENT).exists()
+
+    def test_size_cap_flushes(self):
+        for i in range(3):
+            self.send(number=i)
+        assert process_batch() == 3
+        assert Bot.send_message.call_count == 1
+        assert '3 builds' in Bot.send_message.call_args[0][1]
+
+    def test_new_window_after_flush(self):
+        self.send()
+        OutboxMessage.objects.update(next_attempt_at=timezone.now())
+        process_batch()
+        self.send()
+        message = OutboxMessage.objects.get(status=OutboxMessage.PENDING)
+        assert message.next_attempt_at > timezone.now()
+
+    def test_disabled(self, settings):
+        settings.REPORT_COALESCE_WINDOW = 0
+        self.send(number=1)
+        self.send(number=2)
+        assert process_batch() == 2
+        # same chat in one batch, but reports are not digested
+        assert Bot.send_message.call_count == 2
+        texts = [c[0][1] for c in Bot.send_message.call_args_list]
+        assert not any('2 builds' in text for text in texts)
+
+    def test_digest_fallback(self, mocker):
+        mocker.patch.object(Bot, 'send_message', side_effect=[BadRequest('force error'), None])
+        for i in range(3):
+            self.send(number=i)
+        process_batch()
+        assert json.loads(Bot.send_message.call_args[0][1].strip('`\n'))
+
+    def test_format_digest(self):
+        text = format_digest([
+            {'repository': 'a/b', 'number': 1, 'status': 0, 'status_message': 'Passed',
+             'branch': 'master', 'build_url': 'https://example.com/1'},
+            {'repository': 'a/c', 'number': 2, 'status': 1, 'status_message': 'Failed',
+             'branch': 'dev', 'build_url': 'https://example.com/2'},
+        ])
+        lines = [line for line in text.splitlines() if line]
+        assert len(lines) == 3
+        assert lines[1].startswith('✅') and 'a/b' in lines[1]
+        assert lines[2].startswith('❌') and '(https://example.com/2)' in lines[2]
+
+
+class TestTransport:
+    def test_latency_histogram(self, bot_api_server):
+        telegram_latency.reset()
+        request = InstrumentedRequest(con_pool_size=2)
+        for _ in range(3):
+            request.post(f'{bot_api_server.url}000000:0000000000/sendMessage', {'chat_id': 1})
+        request.get(f'{bot_api_server.url}000000:0000000000/getMe')
+        stats = telegram_latency.snapshot()
+        assert stats['sendMessage']['count'] == 3
+        assert stats['getMe']['count'] == 1
+
+    def test_keep_alive(self, bot_api_server):
+        request = InstrumentedRequest(con_pool_size=2)
+        for _ in range(5):
+            request.post(f'{bot_api_server.url}000000:0000000000/sendMessage', {'chat_id': 1})
+        ports = {port for _, _, port in bot_api_server.calls}
+        assert len(ports) == 1
+
+    def test_bot_uses_instrumented_request(self):
+        assert isinstance(bot.request, InstrumentedRequest)
+        assert bot.request.con_pool_size == settings.TELEGRAM_CON_POOL_SIZE
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 2))
+        for value in (0.5, 1.5, 3):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        assert snapshot['buckets'] == {1: 1, 2: 1, float('inf'): 1}
+        assert snapshot['count'] == 3
+        assert snapshot['sum'] == 5
+
+    def test_render_prometheus(self):
+        registry = MetricsRegistry()
+        requests_total = registry.counter('requests_total', "Requests.", label='code')
+        latency = registry.histogram('latency_seconds', "Latency.", label='stage', buckets=(1, 2))
+        requests_total.inc('200', 2)
+        for value in (0.5, 1.5, 3):
+            latency.labels('send').observe(value)
+        assert registry.render().splitlines() == [
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{code="200"} 2',
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{stage="send",le="1.0"} 1',
+            'latency_seconds_bucket{stage="send",le="2.0"} 2',
+            'latency_seconds_bucket{stage="send",le="+Inf"} 3',
+            'latency_seconds_sum{stage="send"} 5.0',
+            'latency_seconds_count{stage="send"} 3',
+        ]
+
+    def test_metrics_of_processes_are_summed(self, tmpdir):
+        def create_registry():
+            registry = MetricsRegistry(str(tmpdir), flush_interval=60)
+            registry.counter('requests_total', "Requests.", label='code')
+            registry.histogram('latency_seconds', "Latency.", label='stage', buckets=(1,))
+            return registry
+
+        worker = create_registry()
+        worker.families['requests_total'][1].inc('200', 3)
+        worker.families['latency_seconds'][1].labels('send').observe(2)
+        # flushed by another process
+        worker.flush()
+        os.rename(worker.get_path(), worker.get_path(pid=1))
+        current = create_registry()
+        current.families['requests_total'][1].inc('200')
+        current.families['requests_total'][1].inc('400')
+        data = current.collect()
+        assert data['requests_total'] == {'200': 4, '400': 1}
+        assert data['latency_seconds'] == {'send': {'counts': [0, 1], 'sum': 2}}
+
+    def test_flusher(self, tmpdir):
+        registry = MetricsRegistry(str(tmpdir), flush_interval=0.01)
+        registry.counter('requests_total', "Requests.").inc('200')
+        sleep(0.1)
+        with open(registry.get_path()) as f:
+            assert json.load(f) == {'requests_total': {'200': 1}}
+        # stop flushing
+        registry._flusher_pid = registry.directory = None
+
+    def test_username_from_settings(self, mocker):
+        mocker.spy(Bot, 'get_me')
+        assert get_bot_username() == 'test_bot'
+        assert Bot.get_me.call_count == 0
+
+    def test_username_warm_up(self, settings, mocker):
+        settings.TELEGRAM_BOT_USERNAME = None
+        mocker.patch.object(bot, 'bot', None)
+        event = threading.Event()
+        mocker.patch.object(Bot, 'get_me', side_effect=lambda: event.set())
+        # doesn't wait for telegram
+        assert get_bot_username() is None
+        assert event.wait(1)
+        bot.bot = Mock(username='from_api')
+        assert get_bot_username() == 'from_api'
+
+
+@pytest.mark.django_db
+class TestDeduplication:
+    def create_request(self, build_id=1, state='passed'):
+        req = HttpRequest()
+        req.POST['payload'] = json.dumps({
+            **json.loads(create_travis_payload()),
+            'id': build_id,
+            'state': state,
+        })
+        return req
+
+    def test_duplicate(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+        mocker.spy(core.utils, 'format_build_report')
+        assert send_report(self.create_request(), chat_id='1111').status_code == 200
+        res = send_report(self.create_request(), chat_id='1111')
+        assert res.status_code == 200
+        assert res.content == b'duplicate'
+        assert Bot.send_message.call_count == 1
+        assert TravisSignatureChecker.validate.call_count == 1
+        assert core.utils.format_build_report.call_count == 1
+
+    def test_different_state_or_chat(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+        send_report(self.create_request(state='started'), chat_id='1111')
+        send_report(self.create_request(state='passed'), chat_id='1111')
+        send_report(self.create_request(state='passed'), chat_id='2222')
+        send_report(self.create_request(build_id=2), chat_id='1111')
+        assert Bot.send_message.call_count == 4
+
+    def test_other_worker(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+        send_report(self.create_request(), chat_id='1111')
+        # another process has empty local cache
+        deduplicator.clear()
+        res = send_report(self.create_request(), chat_id='1111')
+        assert res.content == b'duplicate'
+        assert Bot.send_message.call_count == 1
+
+    def test_forged_duplicate_not_remembered(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=False)
+        assert send_report(self.create_request(), chat_id='1111').status_code == 400
+        TravisSignatureChecker.validate.return_value = True
+        assert send_report(self.create_request(), chat_id='1111').status_code == 200
+        assert Bot.send_message.call_count == 1
+
+    def test_failed_delivery_released(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+        mocker.patch.object(Bot, 'send_message', side_effect=BadRequest('force error'))
+        assert send_report(self.create_request(), chat_id='1111').status_code == 400
+        Bot.send_message.side_effect = NetworkError('force error')
+        with pytest.raises(NetworkError):
+            send_report(self.create_request(), chat_id='1111')
+        Bot.send_message.side_effect = None
+        assert send_report(self.create_request(), chat_id='1111').status_code == 200
+
+    def test_claim_expires(self, mocker):
+        assert DedupClaim.objects.claim('key', 60)
+        assert not DedupClaim.objects.claim('key', 60)
+        mocker.patch('core.models.timezone.now', return_value=timezone.now() + timedelta(seconds=61))
+        # expired claim is taken over
+        assert DedupClaim.objects.claim('key', 60)
+        assert not DedupClaim.objects.claim('key', 60)
+        assert DedupClaim.objects.purge() == 0
+
+    def test_purge(self, mocker):
+        deduplicator.claim('old')
+        mocker.patch('core.models.timezone.now', return_value=timezone.now() + timedelta(seconds=deduplicator.ttl))
+        mocker.patch.object(deduplicator, 'purged_at', monotonic() - deduplicator.purge_interval)
+        deduplicator.claim('new')
+        assert list(DedupClaim.objects.values_list('key', flat=True)) == ['new']
+
+    def test_flood_wait_released(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+        mocker.patch.object(Bot, 'send_message', side_effect=RetryAfter(60))
+        # not a server error, travis retry gets through
+        res = send_report(self.create_request(), chat_id='1111')
+        assert res.status_code == 503
+        assert res['Retry-After'] == '60'
+        Bot.send_message.side_effect = None
+        assert send_report(self.create_request(), chat_id='1111').status_code == 200
+
+    def test_disabled(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+        mocker.patch.object(deduplicator, 'ttl', 0)
+        send_report(self.create_request(), chat_id='1111')
+        send_report(self.create_request(), chat_id='1111')
+        assert Bot.send_message.call_count == 2
+
+
+@pytest.mark.django_db
+class TestGroupHook:
+    @pytest.fixture(autouse=True)
+    def valid_signature(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+
+    def post(self, name='team'):
+        url = reverse('core:group_hook', kwargs={'name': name})
+        return self.client.post(url, {'payload': create_travis_payload()})
+
+    def test_get_chat_ids(self):
+        group = ChatGroup(name='team', chat_ids='1, 2\n3  1')
+        assert group.get_chat_ids() == ['1', '2', '3']
+
+    def test_fan_out(self, mocker):
+        ChatGroup.objects.create(name='team', chat_ids='1 2 3')
+        mocker.spy(core.utils, 'format_build_report')
+        mocker.spy(core.utils, 'check_signature')
+        res = self.post()
+        assert res.status_code == 200
+        assert res.json()['results'] == {c: {'status': 'sent'} for c in ['1', '2', '3']}
+        assert sorted(c[0][0] for c in Bot.send_message.call_args_list) == ['1', '2', '3']
+        assert core.utils.format_build_report.call_count == 1
+        assert core.utils.check_signature.call_count == 1
+
+    def test_parallel(self, mocker):
+        ChatGroup.objects.create(name='team', chat_ids='1 2 3 4')
+        mocker.patch.object(Bot, 'send_message', side_effect=lambda *args, **kwargs: sleep(0.2))
+        start = monotonic()
+        assert self.post().status_code == 200
+        assert monotonic() - start < 0.6
+
+    def test_one_chat_fails(self, mocker):
+        ChatGroup.objects.create(name='team', chat_ids='1 2 3')
+
+        def send_message(chat_id, *args, **kwargs):
+            if chat_id == '2':
+                raise NetworkError('force error')
+
+        mocker.patch.object(Bot, 'send_message', side_effect=send_message)
+        res = self.post()
+        assert res.status_code == 200
+        results = res.json()['results']
+        assert results['1'] == results['3'] == {'status': 'sent'}
+        assert results['2']['status'] == 'failed'
+
+    def test_all_fail(self, mocker):
+        ChatGroup.objects.create(name='team', chat_ids='1 2')
+        mocker.patch.object(Bot, 'send_message', side_effect=NetworkError('force error'))
+        assert self.post().status_code == 400
+
+    def test_duplicate(self):
+        ChatGroup.objects.create(name='team', chat_ids='1 2')
+        url = reverse('core:group_hook', kwargs={'name': 'team'})
+        payload = json.dumps({**json.loads(create_travis_payload()), 'id': 5, 'state': 'passed'})
+        self.client.post(url, {'payload': payload})
+        res = self.client.post(url, {'payload': payload})
+        assert res.json()['results'] == {c: {'status': 'duplicate'} for c in ['1', '2']}
+        assert Bot.send_message.call_count == 2
+
+    def test_outbox(self, settings):
+        settings.OUTBOX_ENABLED = True
+        ChatGroup.objects.create(name='team', chat_ids='1 2')
+        res = self.post()
+        assert res.status_code == 202
+        assert OutboxMessage.objects.count() == 2
+        assert Bot.send_message.call_count == 0
+
+    def test_unknown_group(self):
+        assert self.post('unknown').status_code == 404
+
+    def test_get(self):
+        res = self.client.get(reverse('core:group_hook', kwargs={'name': 'team'}))
+        assert res.status_code == 302
+
+
+def create_filtered_build(**kwargs):
+    fields = dict(
+        status=1,
+        status_message='Broken',
+        branch='master',
+        type='push',
+        author_name='Ivan',
+        repository=Repository(name='repo', owner_name='owner'),
+    )
+    return BuildEvent(**{**fields, **kwargs})
+
+
+@pytest.mark.django_db
+class TestFilters:
+    @pytest.fixture(autouse=True)
+    def valid_signature(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+
+    def create_filter(self, *rules):
+        return ChatFilter([FilterRule(field=field, pattern=pattern) for field, pattern in rules])
+
+    def test_empty(self):
+        assert chat_filters.matches('1', create_filtered_build())
+
+    def test_status(self):
+        chat_filter = self.create_filter(('status', 'failure'))
+        assert chat_filter.matches(create_filtered_build())
+        assert not chat_filter.matches(create_filtered_build(status=0, status_message='Passed'))
+        assert self.create_filter(('status', 'fix*')).matches(create_filtered_build(status_message='Fixed'))
+
+    def test_branch_glob(self):
+        chat_filter = self.create_filter(('branch', 'release/*'), ('branch', 'master'))
+        assert chat_filter.matches(create_filtered_build())
+        assert chat_filter.matches(create_filtered_build(branch='release/1.0'))
+        assert not chat_filter.matches(create_filtered_build(branch='Master'))
+        assert not chat_filter.matches(create_filtered_build(branch='dev'))
+
+    def test_all_fields(self):
+        chat_filter = self.create_filter(
+            ('repo', 'OWNER/*'),
+            ('event', 'pr'),
+            ('author', 'ivan'),
+        )
+        assert chat_filter.matches(create_filtered_build(type='pull_request'))
+        assert not chat_filter.matches(create_filtered_build(type='push'))
+        assert not chat_filter.matches(create_filtered_build(
+            type='pull_request',
+            repository=Repository(name='repo', owner_name='other'),
+        ))
+
+    def test_cached(self, django_assert_num_queries):
+        FilterRule.objects.create(chat_id='1', field='branch', pattern='master')
+        with django_assert_num_queries(1):
+            assert chat_filters.matches('1', create_filtered_build())
+            assert not chat_filters.matches('1', create_filtered_build(branch='dev'))
+
+    def test_invalidated_on_change(self):
+        rule = FilterRule.objects.create(chat_id='1', field='branch', pattern='master')
+        assert not chat_filters.matches('1', create_filtered_build(branch='dev'))
+        rule.pattern = 'dev'
+        rule.save()
+        assert chat_filters.matches('1', create_filtered_build(branch='dev'))
+        rule.delete()
+        assert chat_filters.matches('1', create_filtered_build(branch='other'))
+
+    def test_filtered_report_is_not_rendered(self, mocker):
+        FilterRule.objects.create(chat_id='1', field='branch', pattern='release/*')
+        mocker.spy(core.utils, 'format_build_report')
+        mocker.spy(core.utils, 'check_signature')
+        url = reverse('core:hook', kwargs={'chat_id': '1'})
+        res = self.client.post(url, {'payload': create_travis_payload()})
+        assert res.status_code == 200
+        assert res.content == b'filtered'
+        assert core.utils.format_build_report.call_count == 0
+        assert core.utils.check_signature.call_count == 0
+        assert Bot.send_message.call_count == 0
+
+    def test_group(self):
+        ChatGroup.objects.create(name='team', chat_ids='1 2')
+        FilterRule.objects.create(chat_id='2', field='branch', pattern='release/*')
+        url = reverse('core:group_hook', kwargs={'name': 'team'})
+        res = self.client.post(url, {'payload': create_travis_payload()})
+        assert res.json()['results'] == {'1': {'status': 'sent'}, '2': {'status': 'filtered'}}
+        assert Bot.send_message.call_count == 1
+
+    def test_commands(self, settings):
+        settings.FILTER_MAX_RULES = 2
+        assert 'No filters' in update_filters('1', [])
+        assert 'Unknown field' in update_filters('1', ['add', 'color', 'red'])
+        assert '1. branch `master`' in update_filters('1', ['add', 'branch', 'master'])
+        assert '2. status `failure`' in update_filters('1', ['add', 'Status', 'failure'])
+        assert "more than 2" in update_filters('1', ['add', 'author', 'ivan'])
+        assert not chat_filters.matches('1', create_filtered_build(branch='dev'))
+        assert 'No filter with number' in update_filters('1', ['del', '5'])
+        assert '1. status `failure`' in update_filters('1', ['del', '1'])
+        assert chat_filters.matches('1', create_filtered_build(branch='dev'))
+        assert 'No filters' in update_filters('1', ['clear'])
+        assert FilterRule.objects.count() == 0
+        assert '/filter add' in update_filters('1', ['unknown'])
+
+    def test_command_handler(self):
+        update = create_command_update('/filter add branch master', chat_id=1111)
+        dispatcher.process_update(Update.de_json(update, bot))
+        assert FilterRule.objects.get().chat_id == '1111'
+        assert '1. branch' in Bot.send_message.call_args[0][1]
+
+
+def create_finished_build(number, status=0, minute=0, **kwargs):
+    fields = dict(
+        number=str(number),
+        status=status,
+        finished_at=datetime(2019, 8, 4, 0, minute, tzinfo=tzutc()),
+        branch='master',
+        repository=Repository(id=7),
+    )
+    return BuildEvent(**{**fields, **kwargs})
+
+
+@pytest.mark.django_db
+class TestTransitions:
+    @pytest.fixture(autouse=True)
+    def valid_signature(self, mocker, settings):
+        settings.REPORT_TRANSITIONS_ONLY = True
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+
+    def report(self, chat_id, build):
+        # transition is stored once report is delivered
+        transition = build_statuses.is_transition(chat_id, build)
+        if transition:
+            build_statuses.advance(chat_id, build)
+        return transition
+
+    def test_sequence(self):
+        assert self.report('1', create_finished_build(1, status=1))
+        assert self.report('1', create_finished_build(2))
+        assert not self.report('1', create_finished_build(3))
+        assert self.report('1', create_finished_build(5, status=1))
+        # finished after #5
+        assert not self.report('1', create_finished_build(4, minute=10))
+        assert self.report('1', create_finished_build(5, minute=10))
+        status = BuildStatus.objects.get()
+        assert status.passed and status.build_number == 5
+
+    def test_first_build(self):
+        assert not self.report('1', create_finished_build(1))
+        assert self.report('2', create_finished_build(1, status=1))
+        assert self.report('1', create_finished_build(1, status=1, minute=1))
+
+    def test_not_finished(self):
+        assert not self.report('1', create_finished_build(1, status=None))
+        assert not self.report('1', create_finished_build(1, status=1, state='canceled'))
+        assert BuildStatus.objects.count() == 0
+
+    def test_branches(self):
+        assert self.report('1', create_finished_build(1, status=1))
+        assert self.report('1', create_finished_build(2, status=1, branch='dev'))
+        pr = create_finished_build(3, pull_request=True, pull_request_number=4)
+        assert not self.report('1', pr)
+        assert self.report('1', create_finished_build(4))
+        assert BuildStatus.objects.count() == 3
+
+    def test_stale_build_skips_database(self, django_assert_num_queries):
+        build_statuses.is_transition('1', create_finished_build(2))
+        with django_assert_num_queries(0):
+            assert not build_statuses.is_transition('1', create_finished_build(1, status=1))
+            assert not build_statuses.is_transition('1', create_finished_build(2))
+
+    def test_stale_build_in_database(self):
+        self.report('1', create_finished_build(2, status=1))
+        build_statuses.clear()
+        assert not build_statuses.is_transition('1', create_finished_build(1))
+        assert not BuildStatus.objects.get().passed
+
+    def test_view(self):
+        url = reverse('core:hook', kwargs={'chat_id': '1'})
+        payload = json.loads(create_travis_payload())
+        contents = []
+        for number, status in [(1, 1), (2, 1), (3, 0)]:
+            data = {**payload, 'id': number, 'number': number, 'status': status, 'repository': {'id': 7}}
+            contents.append(self.client.post(url, {'payload': json.dumps(data)}).content)
+        assert contents[1] == b'unchanged'
+        assert b'unchanged' not in (contents[0], contents[2])
+        assert Bot.send_message.call_count == 2
+
+    def test_group(self):
+        ChatGroup.objects.create(name='team', chat_ids='1 2')
+        build_statuses.is_transition('2', create_finished_build(1))
+        url = reverse('core:group_hook', kwargs={'name': 'team'})
+        data = {**json.loads(create_travis_payload()), 'number': 2, 'status': 0, 'repository': {'id': 7}}
+        res = self.client.post(url, {'payload': json.dumps(data)})
+        assert res.json()['results'] == {'1': {'status': 'unchanged'}, '2': {'status': 'unchanged'}}
+        data['status'] = 1
+        res = self.client.post(url, {'payload': json.dumps({**data, 'number': 3})})
+        assert res.json()['results'] == {'1': {'status': 'sent'}, '2': {'status': 'sent'}}
+
+    def test_failed_delivery_retried(self, mocker):
+        build = create_finished_build(1, status=1)
+        assert build_statuses.is_transition('1', build)
+        # not delivered, still a transition
+        assert build_statuses.is_transition('1', build)
+        assert not BuildStatus.objects.exists()
+
+        url = reverse('core:hook', kwargs={'chat_id': '1'})
+        payload = json.loads(create_travis_payload())
+        data = {**payload, 'id': 2, 'number': 2, 'status': 1, 'repository': {'id': 7}}
+        mocker.patch.object(Bot, 'send_message', side_effect=TimedOut())
+        with pytest.raises(TimedOut):
+            self.client.post(url, {'payload': json.dumps(data)})
+        Bot.send_message.side_effect = None
+        # travis retry
+        res = self.client.post(url, {'payload': json.dumps(data)})
+        assert res.content != b'unchanged'
+        assert Bot.send_message.call_count == 2
+        assert not BuildStatus.objects.get(repository_id=7).passed
+        assert self.client.post(url, {'payload': json.dumps({**data, 'id': 3, 'number': 3})}).content == b'unchanged'
+
+    def test_group_failed_delivery_retried(self, mocker):
+        ChatGroup.objects.create(name='team', chat_ids='1 2')
+        url = reverse('core:group_hook', kwargs={'name': 'team'})
+        data = {**json.loads(create_travis_payload()), 'number': 2, 'status': 1, 'repository': {'id': 7}}
+
+        def send_message(chat_id, *args, **kwargs):
+            if chat_id == '2':
+                raise TimedOut()
+            return Message(1, None, datetime.now(), Chat(chat_id, 'private'))
+
+        mocker.patch.object(Bot, 'send_message', side_effect=send_message)
+        res = self.client.post(url, {'payload': json.dumps(data)})
+        assert res.json()['results']['2']['status'] == 'failed'
+        Bot.send_message.side_effect = None
+        res = self.client.post(url, {'payload': json.dumps(data)})
+        results = res.json()['results']
+        assert results['1']['status'] != 'sent'
+        assert results['2']['status'] == 'sent'
+
+
+@pytest.mark.django_db
+class TestEditBuildMessage:
+    @pytest.fixture(autouse=True)
+    def valid_signature(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+
+    def create_request(self, state, build_id=10):
+        req = HttpRequest()
+        req.POST['payload'] = json.dumps({
+            **json.loads(create_travis_payload()),
+            'id': build_id,
+            'state': state,
+            'repository': {'id': 5, 'owner_name': 'owner', 'name': 'repo'},
+        })
+        return req
+
+    def test_edit(self):
+        send_report(self.create_request('started'), chat_id='1111')
+        row = BuildMessage.objects.get()
+        assert (row.chat_id, row.repository_id, row.build_id) == ('1111', 5, 10)
+
+        send_report(self.create_request('passed'), chat_id='1111')
+        assert Bot.send_message.call_count == 1
+        assert Bot.edit_message_text.call_count == 1
+        kwargs = Bot.edit_message_text.call_args[1]
+        assert kwargs['chat_id'] == '1111'
+        assert kwargs['message_id'] == row.message_id
+
+    def test_other_build_or_chat(self):
+        send_report(self.create_request('started'), chat_id='1111')
+        send_report(self.create_request('started', build_id=11), chat_id='1111')
+        send_report(self.create_request('started'), chat_id='2222')
+        assert Bot.send_message.call_count == 3
+        assert Bot.edit_message_text.call_count == 0
+
+    def test_message_gone(self, mocker):
+        send_report(self.create_request('started'), chat_id='1111')
+        old_id = BuildMessage.objects.get().message_id
+        mocker.patch.object(Bot, 'edit_message_text', side_effect=BadRequest('Message to edit not found'))
+        assert send_report(self.create_request('passed'), chat_id='1111').status_code == 200
+        assert Bot.send_message.call_count == 2
+        assert BuildMessage.objects.get().message_id != old_id
+
+    def test_not_modified(self, mocker):
+        send_report(self.create_request('started'), chat_id='1111')
+        mocker.patch.object(Bot, 'edit_message_text', side_effect=BadRequest('Message is not modified'))
+        assert send_report(self.create_request('passed'), chat_id='1111').status_code == 200
+        assert Bot.send_message.call_count == 1
+
+    def test_edit_falls_back_to_simple(self, mocker):
+        send_report(self.create_request('started'), chat_id='1111')
+        mocker.patch.object(Bot, 'edit_message_text', side_effect=[BadRequest("Can't parse entities"), None])
+        send_report(self.create_request('passed'), chat_id='1111')
+        assert Bot.edit_message_text.call_count == 2
+        assert Bot.send_message.call_count == 1
+
+    def test_group(self):
+        ChatGroup.objects.create(name='team', chat_ids='1 2')
+        url = reverse('core:group_hook', kwargs={'name': 'team'})
+        self.client.post(url, {'payload': self.create_request('started').POST['payload']})
+        self.client.post(url, {'payload': self.create_request('passed').POST['payload']})
+        assert Bot.send_message.call_count == 2
+        assert Bot.edit_message_text.call_count == 2
+
+    def test_outbox(self, settings):
+        settings.OUTBOX_ENABLED = True
+        send_report(self.create_request('started'), chat_id='1111')
+        process_batch()
+        send_report(self.create_request('passed'), chat_id='1111')
+        process_batch()
+        assert Bot.send_message.call_count == 1
+        assert Bot.edit_message_text.call_count == 1
+
+    def test_index_cache(self, django_assert_num_queries):
+        index = BuildMessageIndex(ttl=60)
+        index.set('1', 2, 3, 4)
+        with django_assert_num_queries(0):
+            assert index.get('1', 2, 3) == 4
+        index.clear()
+        with django_assert_num_queries(1):
+            assert index.get('1', 2, 3) == 4
+            assert index.get('1', 2, 3) == 4
+
+    def test_index_expire(self):
+        index = BuildMessageIndex(ttl=60, expire_every=2)
+        index.set('1', 1, 1, 1)
+        BuildMessage.objects.update(updated_at=timezone.now() - timedelta(seconds=120))
+        index.clear()
+        assert index.get('1', 1, 1) is None
+        index.set('1', 1, 2, 2)
+        assert list(BuildMessage.objects.values_list('build_id', flat=True)) == [2]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeBot:
+    """
+    Records time of sent messages, raises RetryAfter for chats listed in `flood`.
+    """
+
+    def __init__(self, clock, flood=None):
+        self.clock = clock
+        self.flood = dict(flood or {})
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        if self.flood.get(chat_id):
+            raise RetryAfter(self.flood.pop(chat_id))
+        self.sent.append((self.clock(), chat_id))
+
+
+class TestSendScheduler:
+    def create_scheduler(self, bot, clock, **kwargs):
+        params = {'global_rate': 30, 'chat_rate': 1, 'max_wait': 60, 'retries': 2, **kwargs}
+        return SendScheduler(bot, clock=clock, sleep=clock.sleep, **params)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+        assert bucket.reserve(0) == 0
+        assert bucket.reserve(0) == 0
+        assert bucket.reserve(0) == 0.5
+        assert bucket.reserve(0) == 1.0
+        assert bucket.reserve(0, max_wait=1) is None
+        assert bucket.reserve(2) == 0
+
+    def test_load(self):
+        clock = FakeClock()
+        bot = FakeBot(clock)
+        scheduler = self.create_scheduler(bot, clock)
+        chats = [str(i) for i in range(300)]
+        for _ in range(3):
+            for chat_id in chats:
+                scheduler.send_message(chat_id, 'text')
+        assert len(bot.sent) == 900
+
+        times = [t for t, _ in bot.sent]
+        # never more than 30 messages in any second
+        for i, t in enumerate(times):
+            in_window = [x for x in times[i:i + 70] if x < t + 1]
+            assert len(in_window) <= 31
+        # at least a second between messages in the same chat
+        last = {}
+        for t, chat_id in bot.sent:
+            if chat_id in last:
+                assert t - last[chat_id] >= 1
+            last[chat_id] = t
+        # but overall throughput is close to global limit
+        assert times[-1] < 900 / 30 + 1
+
+    def test_retry_after(self):
+        clock = FakeClock()
+        bot = FakeBot(clock, flood={'1': 5})
+        scheduler = self.create_scheduler(bot, clock)
+        scheduler.send_message('1', 'text')
+        assert bot.sent == [(5.0, '1')]
+
+    def test_retry_after_too_long(self):
+        clock = FakeClock()
+        bot = FakeBot(clock, flood={'1': 100})
+        scheduler = self.create_scheduler(bot, clock)
+        with pytest.raises(RetryAfter):
+            scheduler.send_message('1', 'text')
+        assert clock.now == 0
+
+    def test_max_wait(self):
+        clock = FakeClock()
+        bot = FakeBot(clock)
+        scheduler = self.create_scheduler(bot, clock, max_wait=1.5)
+        scheduler.send_message('1', 'text')
+        scheduler.send_message('1', 'text')
+        with pytest.raises(RetryAfter):
+            # third message would have to wait 2 seconds
+            scheduler.chat_buckets.get('1').tokens -= 1
+            scheduler.send_message('1', 'text')
+        assert len(bot.sent) == 2
+
+    def test_threads(self):
+        bot = Mock()
+        scheduler = SendScheduler(bot, global_rate=200, chat_rate=100, max_wait=5, retries=0)
+        threads = [
+            threading.Thread(target=scheduler.send_message, args=(str(i % 10), 'text'))
+            for i in range(100)
+        ]
+        start = monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert bot.send_message.call_count == 100
+        # 100 messages at 200/s
+        assert monotonic() - start < 1
+
+
+@pytest.mark.django_db
+class TestHookGuards:
+    def post(self, chat_id='1111'):
+        url = reverse('core:hook', kwargs={'chat_id': chat_id})
+        return self.client.post(url, {'payload': create_travis_payload()})
+
+    @pytest.fixture(autouse=True)
+    def valid_signature(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+
+    def test_unknown_chat_allowed_by_default(self):
+        assert self.post().status_code == 200
+
+    def test_strict_unknown_chat(self, settings, mocker):
+        settings.STRICT_CHATS = True
+        mocker.spy(core.views, 'send_report')
+        assert self.post().status_code == 404
+        assert core.views.send_report.call_count == 0
+        assert TravisSignatureChecker.validate.call_count == 0
+
+    def test_strict_registered_chat(self, settings):
+        settings.STRICT_CHATS = True
+        dispatcher.process_update(Update.de_json(create_command_update('/webhook'), bot))
+        assert KnownChat.objects.filter(chat_id='1111').exists()
+        assert self.post().status_code == 200
+
+    def test_registered_by_other_process(self, django_assert_num_queries):
+        assert not known_chats.is_known('1111')
+        KnownChat.objects.create(chat_id='1111')
+        known_chats.clear()
+        with django_assert_num_queries(1):
+            assert known_chats.is_known('1111')
+        # known chats are cached until next reload, unknown ones only for a few seconds
+        with django_assert_num_queries(1):
+            assert not known_chats.is_known('2222')
+            assert not known_chats.is_known('2222')
+        KnownChat.objects.create(chat_id='2222')
+        known_chats.misses.clear()
+        with django_assert_num_queries(1):
+            assert known_chats.is_known('2222')
+        with django_assert_num_queries(0):
+            assert known_chats.is_known('2222')
+
+    def test_lookup_not_under_lock(self, mocker):
+        lookup_started = threading.Event()
+        release_lookup = threading.Event()
+        released = []
+
+        def slow_exists(*args):
+            lookup_started.set()
+            released.append(release_lookup.wait(5))
+            return False
+
+        mocker.patch('django.db.models.query.QuerySet.exists', slow_exists)
+        known_chats.load()
+        known_chats.lookups.set('3333', True)
+        thread = threading.Thread(target=known_chats.is_known, args=('2222',))
+        thread.start()
+        try:
+            assert lookup_started.wait(5)
+            # cached chat is answered while other lookup waits for database
+            assert known_chats.is_known('3333')
+        finally:
+            release_lookup.set()
+            thread.join()
+        assert released == [True]
+
+    def test_register_once(self, django_assert_num_queries):
+        known_chats.register('1111')
+        with django_assert_num_queries(0):
+            known_chats.register('1111')
+        assert KnownChat.objects.count() == 1
+
+    def test_flood(self, mocker):
+        mocker.patch.object(core.views, 'hook_limiter', SlidingWindowLimiter(limit=2, window=60))
+        mocker.spy(core.views, 'send_report')
+        assert self.post().status_code == 200
+        assert self.post().status_code == 200
+        assert self.post().status_code == 429
+        assert self.post('2222').status_code == 200
+        assert core.views.send_report.call_count == 3
+
+    def test_sliding_window(self):
+        clock = FakeClock()
+        limiter = SlidingWindowLimiter(limit=2, window=10, clock=clock)
+        assert limiter.allow('a')
+        clock.now += 5
+        assert limiter.allow('a')
+        assert not limiter.allow('a')
+        clock.now += 5
+        # first hit left the window
+        assert limiter.allow('a')
+        assert not limiter.allow('a')
+        assert SlidingWindowLimiter(limit=0, window=10).allow('a')
+
+
+@pytest.mark.django_db
+class TestRunBot:
+    @pytest.fixture(autouse=True)
+    def api(self, bot_api_server, mocker):
+        mocker.patch.object(bot, 'base_url', f'{bot_api_server.url}{settings.TELEGRAM_BOT_TOKEN}')
+        self.updates = [create_command_update('/start', chat_id=i)['message'] for i in range(1, 4)]
+        bot_api_server.results['getUpdates'] = self.get_updates
+        return bot_api_server
+
+    def get_updates(self, params):
+        # bot api client sends numbers as strings
+        offset = int(params.get('offset') or 1)
+        return [
+            {'update_id': i, 'message': message}
+            for i, message in enumerate(self.updates, start=1)
+            if i >= offset
+        ]
+
+    def get_update_calls(self, server):
+        return [params for method, params, _ in server.calls if method == 'getUpdates']
+
+    def test_once(self, api):
+        call_command('runbot', once=True, timeout=0, stdout=Mock())
+        assert sorted(c[0][0] for c in Bot.send_message.call_args_list) == [1, 2, 3]
+        assert api.calls[0][0] == 'deleteWebhook'
+        params = self.get_update_calls(api)[0]
+        assert params['allowed_updates'] == ['message']
+
+    def test_offset_persisted(self, api):
+        call_command('runbot', once=True, timeout=0, stdout=Mock())
+        call_command('runbot', once=True, timeout=0, stdout=Mock())
+        assert [params.get('offset') for params in self.get_update_calls(api)] == [None, '4']
+        assert Bot.send_message.call_count == 3
+
+    def test_offset_not_culled(self, api):
+        call_command('runbot', once=True, timeout=0, stdout=Mock())
+        cache = caches[settings.BOT_OFFSET_CACHE]
+        # more keys than default MAX_ENTRIES, culling would drop the smallest key, offset, first
+        cache.set_many({f'dedup:{i}': i for i in range(400)}, timeout=None)
+        call_command('runbot', once=True, timeout=0, stdout=Mock())
+        assert [params.get('offset') for params in self.get_update_calls(api)] == [None, '4']
+
+    def test_concurrent_workers(self, api, mocker):
+        mocker.patch.object(Bot, 'send_message', side_effect=lambda *args, **kwargs: sleep(0.2))
+        start = monotonic()
+        call_command('runbot', once=True, timeout=0, workers=3, stdout=Mock())
+        assert Bot.send_message.call_count == 3
+        assert monotonic() - start < 0.5
+
+    def test_graceful_shutdown(self, api, mocker):
+        command = RunBotCommand()
+        calls = []
+
+        def get_updates(params):
+            calls.append(params)
+            if len(calls) == 2:
+                command.stop()
+            return self.get_updates(params)
+
+        api.results['getUpdates'] = get_updates
+        mocker.patch.object(Bot, 'send_message', side_effect=lambda *args, **kwargs: sleep(0.1))
+        call_command(command, timeout=0, stdout=Mock())
+        # stops after second poll, queued updates are processed before exit
+        assert len(calls) == 2
+        assert Bot.send_message.call_count == 3
+
+    def test_api_error(self, api):
+        command = RunBotCommand()
+
+        def get_updates(params):
+            command.stop()
+            return {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+
+        api.results['getUpdates'] = get_updates
+        call_command(command, timeout=0, retry_delay=0, stdout=Mock(), stderr=Mock())
+        assert Bot.send_message.call_count == 0
+
+
 @pytest.mark.usefixtures('create_notification_payload')
 class TestFormatReport:
     def test_basic(self):
         payload = self.create_notification_payload(status=0)
-        res = format_build_report(payload)
+        res = format_build_report(BuildEvent.from_payload(payload))
         print(res)
         assert 'success' in res
 
     def test_error(self):
         payload = self.create_notification_payload(status=1)
-        res = format_build_report(payload)
+        res = format_build_report(BuildEvent.from_payload(payload))
         print(res)
         assert 'failed' in res
 
     def test_multiline(self):
         payload = self.create_notification_payload(multiline_message=True)
-        res = format_build_report(payload)
+        res = format_build_report(BuildEvent.from_payload(payload))
         print(res)
 
     def test_pull_request(self):
         payload = self.create_notification_payload(pull_request=True)
-        res = format_build_report(payload)
+        res = format_build_report(BuildEvent.from_payload(payload))
         assert 'pull request' in res.lower()
         print(res)
 
+    def test_payload_not_changed(self):
+        payload = self.create_notification_payload()
+        original = json.loads(json.dumps(payload))
+        build = BuildEvent.from_payload(payload)
+        format_build_report(build)
+        format_simple_report(build)
+        assert payload == original
+
+    def test_build_event(self):
+        payload = self.create_notification_payload(multiline_message=True)
+        build = BuildEvent.from_payload(payload)
+        assert build.finished_at == datetime(2019, 8, 6, 10, 38, 11, tzinfo=tzutc())
+        assert build.repository.slug == 'lapolinar/docs-travis-ci-com'
+        assert build.repository_id == 15948437
+        assert build.multiline
+        assert not hasattr(build, '__dict__')
+
     def test_simple(self):
-        res = format_simple_report({
-            'repository': {},
-            'number': 13,
-            'status_message': 'Passed',
-            'author_name': 'user',
-            'message': 'commit',
-            'duration': 10,
-        })
+        res = format_simple_report(BuildEvent(
+            number='13',
+            status_message='Passed',
+            author_name='user',
+            message='commit',
+            duration=10,
+        ))
         res = res.strip('`\n')
         # check that there is valid objects
         assert json.loads(res)
 
 
+COMMIT_MESSAGES = [
+    'Update deployments.yml',
+    'fix_snake_case_names in utils',
+    'Merge pull request #42 from some_user/feature_branch\n\nAdd *bold* thing',
+    'WIP: *do not merge',
+    'use `foo()` instead of ``bar``',
+    'wrap code:\n```python\nprint("hi")\n```\nand unclosed ```',
+    'see [docs](https://example.com/a_b) and [broken link',
+    'fix [WIP] tag_',
+    'escape \\ backslashes \\_ and \\*',
+    'emoji 🚀🔥 and *nested _markers* here_',
+    'html <b>tags</b> & "quotes" \'single\'',
+    'trailing backslash \\',
+    'x' * 5000,
+    '*_`[' * 1500,
+    'line\n' * 2000,
+]
+
+
+class TestMarkup:
+    @pytest.mark.parametrize('text', [
+        'plain text',
+        '*bold* _italic_ `code` [link](https://example.com)',
+        '```\npre\n```',
+        'escaped \\* \\_ \\` \\[',
+    ])
+    def test_valid(self, text):
+        assert check_markdown(text)
+
+    @pytest.mark.parametrize('text', [
+        '*bold',
+        'snake_case',
+        'unclosed `code',
+        '```\nunclosed pre',
+        '[text without url]',
+        '[text](url',
+    ])
+    def test_invalid(self, text):
+        assert not check_markdown(text)
+
+
+@pytest.mark.usefixtures('create_notification_payload')
+class TestMessyCommits:
+    @pytest.mark.parametrize('message', COMMIT_MESSAGES)
+    def test_report(self, message):
+        payload = self.create_notification_payload(pull_request=True)
+        payload['message'] = message
+        payload['branch'] = 'feature_*branch'
+        payload['pull_request_title'] = '[WIP] *fix* `thing'
+        payload['author_name'] = 'under_score'
+        text = format_build_report(BuildEvent.from_payload(payload))
+        assert check_markdown(text)
+        assert len(text) <= MAX_MESSAGE_LENGTH
+
+    @pytest.mark.parametrize('message', COMMIT_MESSAGES)
+    def test_simple_report(self, message):
+        payload = self.create_notification_payload()
+        payload['message'] = message
+        text = format_simple_report(BuildEvent.from_payload(payload))
+        assert check_markdown(text)
+        assert len(text) <= MAX_MESSAGE_LENGTH
+        assert json.loads(text[3:-3])
+
+    def test_long_message_truncated(self):
+        payload = self.create_notification_payload()
+        payload['message'] = 'x' * 5000 + 'end'
+        text = format_build_report(BuildEvent.from_payload(payload))
+        assert '…' in text
+        assert 'end' not in text
+        assert 'Finished:' in text
+
+    @pytest.mark.django_db
+    def test_single_send(self, mocker):
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+        report_outcomes.reset()
+        for message in COMMIT_MESSAGES:
+            req = HttpRequest()
+            req.POST['payload'] = json.dumps({**json.loads(create_travis_payload()), 'message': message})
+            assert send_report(req, chat_id='1111').status_code == 200
+        assert Bot.send_message.call_count == len(COMMIT_MESSAGES)
+        assert report_outcomes.snapshot() == {'sent': len(COMMIT_MESSAGES)}
+
+    @pytest.mark.django_db
+    def test_fallback_counter(self, mocker):
+        mocker.patch.object(Bot, 'send_message', side_effect=[BadRequest('force error'), None])
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+        report_outcomes.reset()
+        req = HttpRequest()
+        req.POST['payload'] = create_travis_payload()
+        send_report(req, chat_id='1111')
+        assert report_outcomes.snapshot() == {'fallback': 1, 'sent': 1}
+
+
+@pytest.mark.usefixtures('create_notification_payload')
+class TestPayloadExtraction:
+    @pytest.fixture(autouse=True)
+    def stdlib_backend(self, mocker):
+        # results don't depend on installed json libraries
+        mocker.patch('core.payload.json_loads', json.loads)
+
+    def create_text(self, jobs=1):
+        payload = self.create_notification_payload()
+        payload.pop('multiline')
+        payload['matrix'] = payload['matrix'] * jobs
+        return json.dumps(payload)
+
+    def test_extract(self):
+        text = self.create_text()
+        data = extract_fields(text)
+        full = json.loads(text)
+        assert data == {key: value for key, value in full.items() if key in REPORT_FIELDS}
+        assert 'config' not in data
+        assert 'matrix' not in data
+
+    def test_matrix_not_decoded(self):
+        text = self.create_text()
+        start = text.index('"matrix":')
+        # everything after needed fields is ignored
+        data = extract_fields(text[:start] + '"matrix": [broken')
+        assert data['repository']['name'] == 'docs-travis-ci-com'
+
+    def test_whitespace_and_missing_fields(self):
+        data = extract_fields(' { "number" : "1" ,\n "config": {"a": [1, {"b": "}"}]}, "other": null } ')
+        assert data == {'number': '1'}
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            extract_fields('{"number": 1, "message": "a"')
+        with pytest.raises(ValueError):
+            extract_fields('[1, 2]')
+
+    def test_json_backend(self):
+        assert get_json_loads('json') is json.loads
+        assert get_json_loads('auto')('{"a": 1}') == {'a': 1}
+        with pytest.raises(ImportError):
+            get_json_loads('no_such_json')
+
+    def test_fast_backend(self, mocker):
+        text = self.create_text()
+        scanned = extract_fields(text)
+        loads = mocker.patch('core.payload.json_loads', side_effect=json.loads)
+        # real payloads are scanned, `matrix` goes last
+        assert extract_fields(text) == scanned
+        assert loads.call_count == 0
+        payload = json.loads(text)
+        reordered = json.dumps({'matrix': payload.pop('matrix'), **payload})
+        assert extract_fields(reordered) == scanned
+        loads.assert_called_once_with(reordered)
+
+    def measure(self, func, text, repeat=5):
+        tracemalloc.start()
+        func(text)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = perf_counter()
+        for _ in range(repeat):
+            func(text)
+        return (perf_counter() - start) / max(repeat, 1), peak
+
+    def test_peak_memory(self):
+        text = self.create_text(jobs=500)
+        _, full_peak = self.measure(json.loads, text, repeat=0)
+        _, lean_peak = self.measure(extract_fields, text, repeat=0)
+        assert lean_peak * 10 < full_peak
+
+    @pytest.mark.benchmark
+    def test_benchmark(self):
+        text = self.create_text(jobs=500)
+        full_time, _ = self.measure(json.loads, text)
+        lean_time, _ = self.measure(extract_fields, text)
+        assert lean_time < full_time
+
+
+def random_datetimes(count=500, seed=13):
+    rnd = random.Random(seed)
+    zones = [None, tzutc()] + [
+        tzoffset(None, rnd.randrange(-14 * 3600, 14 * 3600 + 1, 15 * 60))
+        for _ in range(20)
+    ]
+    for _ in range(count):
+        yield datetime(
+            rnd.randint(1970, 2100),
+            rnd.randint(1, 12),
+            rnd.randint(1, 28),
+            rnd.randint(0, 23),
+            rnd.randint(0, 59),
+            rnd.randint(0, 59),
+            rnd.choice([0, rnd.randint(0, 999999)]),
+            tzinfo=rnd.choice(zones),
+        )
+
+
+def format_travis_date(value: datetime):
+    text = value.isoformat()
+    return text[:-6] + 'Z' if value.utcoffset() == timedelta(0) else text
+
+
+@pytest.mark.usefixtures('create_notification_payload')
+class TestDateParsing:
+    def test_travis_format(self):
+        value = parse_iso_datetime('2019-08-06T10:38:11Z')
+        assert value == datetime(2019, 8, 6, 10, 38, 11, tzinfo=tzutc())
+        assert value.utcoffset() == timedelta(0)
+
+    @pytest.mark.parametrize('text', [
+        '2019-08-06T10:38:11+03:00',
+        '2019-08-06T10:38:11-0930',
+        '2019-08-06T10:38:11.5Z',
+        '2019-08-06T10:38:11.123456+00:00',
+        '2019-08-06T10:38:11',
+    ])
+    def test_same_as_dateutil(self, text):
+        value = parse_iso_datetime(text)
+        expected = dateutil.parser.parse(text)
+        assert value == expected
+        assert value.utcoffset() == expected.utcoffset()
+
+    def test_round_trip(self):
+        for value in random_datetimes():
+            for text in [value.isoformat(), format_travis_date(value)]:
+                parsed = parse_iso_datetime(text)
+                assert parsed == value, text
+                assert parsed.utcoffset() == value.utcoffset(), text
+                assert parse_date(text) == value
+
+    @pytest.mark.parametrize('text', [
+        'Tue, 6 Aug 2019 10:38:11 GMT',
+        '2019-08-06 10:38:11',
+        '2019-08-06',
+        '20190806T103811Z',
+    ])
+    def test_fallback(self, text):
+        with pytest.raises(ValueError):
+            parse_iso_datetime(text)
+        assert parse_date(text) == dateutil.parser.parse(text)
+
+    @pytest.mark.parametrize('value', [None, '', 'not a date', '2019-13-45T10:38:11Z', 123])
+    def test_invalid(self, value):
+        assert parse_date(value) is None
+
+    def test_null_dates(self):
+        payload = self.create_notification_payload()
+        payload.update(started_at=None, finished_at=None, committed_at=None, duration=None)
+        build = BuildEvent.from_payload(payload)
+        assert build.started_at is None
+        text = format_build_report(build)
+        assert 'Finished:' in text
+        assert check_markdown(text)
+        assert format_simple_report(build)
+
+    @pytest.mark.benchmark
+    def test_benchmark(self):
+        texts = [format_travis_date(value) for value in random_datetimes(count=2000)]
+        start = perf_counter()
+        for text in texts:
+            dateutil.parser.parse(text)
+        dateutil_time = perf_counter() - start
+        start = perf_counter()
+        for text in texts:
+            parse_date(text)
+        fast_time = perf_counter() - start
+        assert fast_time * 5 < dateutil_time
+
+
+def create_report_builds(payload: dict):
+    build = BuildEvent.from_payload(payload)
+    yield build
+    yield build._replace(status=0, status_message='Passed')
+    yield build._replace(pull_request=True, pull_request_number=13, pull_request_title='[WIP] *fix*')
+    yield build._replace(pull_request=True, pull_request_number=None, pull_request_title=None)
+    yield build._replace(number='<1&2>', branch=None, author_name=None, duration=None)
+    yield build._replace(started_at=None, finished_at=parse_date('2019-08-06T23:38:11-05:30'))
+    yield build._replace(repository=build.repository._replace(name='under_score*', owner_name=None))
+    for message in COMMIT_MESSAGES:
+        yield build._replace(message=message)
+
+
+@pytest.mark.usefixtures('create_notification_payload')
+class TestReportRenderers:
+    @pytest.mark.parametrize('name', ['compiled', 'python'])
+    def test_same_as_template(self, name):
+        render = get_renderer(name)
+        payload = self.create_notification_payload()
+        for build in create_report_builds(payload):
+            assert render(build) == render_template(build)
+
+    @pytest.mark.parametrize('name', ['template', 'compiled', 'python'])
+    def test_format_build_report(self, settings, name):
+        settings.REPORT_RENDERER = name
+        payload = self.create_notification_payload()
+        payload['message'] = 'x' * 5000 + 'end'
+        text = format_build_report(BuildEvent.from_payload(payload))
+        assert '…' in text
+        assert len(text) <= MAX_MESSAGE_LENGTH
+
+    @pytest.mark.benchmark
+    def test_benchmark(self):
+        builds = [
+            BuildEvent.from_payload(self.create_notification_payload(**options))
+            for options in [{'status': 0}, {'status': 1}, {'pull_request': True}, {'multiline_message': True}]
+        ] * 250
+        rates = {}
+        for name in ['template', 'compiled', 'python']:
+            render = get_renderer(name)
+            render(builds[0])
+            start = perf_counter()
+            for build in builds:
+                render(build)
+            rates[name] = len(builds) / (perf_counter() - start)
+        assert rates['python'] > rates['template'] * 2
+
+
 @pytest.mark.django_db
 class TestViews:
     def test_index_view(self):
@@ -245,6 +1973,41 @@ class TestViews:
         res = self.client.get(url)
         assert 'usage' in res.content.decode().lower()
 
+    def test_index_view_not_modified(self):
+        url = reverse('core:index')
+        res = self.client.get(url)
+        assert res['ETag'] and res['Last-Modified']
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=res['ETag'])
+        assert res.status_code == 304
+        assert not res.content
+        res = self.client.get(url, HTTP_IF_MODIFIED_SINCE=res['Last-Modified'])
+        assert res.status_code == 304
+        res = self.client.get(url, HTTP_IF_NONE_MATCH='"other"')
+        assert res.status_code == 200
+
+    def test_index_view_template_changed(self, mocker, tmpdir):
+        template = tmpdir.join('index.html')
+        template.write('')
+        mocker.patch.object(core.utils, 'INDEX_TEMPLATE', str(template))
+        url = reverse('core:index')
+        res = self.client.get(url)
+        # deploy changed the template, but not readme
+        mtime = template.mtime() + 3600
+        os.utime(str(template), (mtime, mtime))
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=res['ETag'], HTTP_IF_MODIFIED_SINCE=res['Last-Modified'])
+        assert res.status_code == 200
+
+    def test_user_hook_view_etag(self):
+        index = self.client.get(reverse('core:index'))
+        user = self.create_user(username='1234')
+        self.client.force_login(user)
+        url = reverse('core:hook', kwargs={'chat_id': '1234'})
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=index['ETag'])
+        assert res.status_code == 200
+        assert res['ETag'] != index['ETag']
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=res['ETag'])
+        assert res.status_code == 304
+
     def test_index_view_auth(self):
         user = self.create_user()
         self.client.force_login(user)
@@ -270,6 +2033,28 @@ class TestViews:
         assert res.status_code == 200
         assert User.objects.get(username=data['id'])
 
+    def test_login_success_view_slow_telegram(self, mocker):
+        sent = threading.Event()
+        release = threading.Event()
+
+        def send_message(*args, **kwargs):
+            release.wait(5)
+            sent.set()
+
+        mocker.patch.object(Bot, 'send_message', side_effect=send_message)
+        data = {'id': '1234', 'first_name': 'name'}
+        payload = get_tg_auth_payload(data)
+        secret_key = hashlib.sha256(settings.TELEGRAM_BOT_TOKEN.encode()).digest()
+        hash = hmac.new(secret_key, payload.encode(), digestmod=hashlib.sha256).hexdigest()
+
+        res = self.client.get(reverse('core:login_success'), {'hash': hash, **data})
+        assert res.status_code == 302
+        assert not sent.is_set()
+        release.set()
+        background.shutdown()
+        assert sent.is_set()
+        assert Bot.send_message.call_args[0][0] == '1234'
+
     def test_user_hook_view_another_user(self):
         self.create_user(username='1234')
 
@@ -325,6 +2110,30 @@ class TestViews:
         user.refresh_from_db()
         assert user.is_active
 
+    def test_metrics_view(self, settings, mocker):
+        url = reverse('core:metrics')
+        assert self.client.get(url).status_code == 404
+        settings.METRICS_TOKEN = 'token'
+        assert self.client.get(url).status_code == 401
+        assert self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code == 401
+
+        mocker.patch.object(TravisSignatureChecker, 'gen_public_key', return_value=['key'])
+        mocker.patch.object(TravisSignatureChecker, 'check_authorized')
+        stage_latency.reset()
+        self.client.post(
+            reverse('core:hook', kwargs={'chat_id': '1111'}),
+            {'payload': create_travis_payload()},
+            HTTP_SIGNATURE=base64.b64encode(b'signature'),
+        )
+        res = self.client.get(url, HTTP_AUTHORIZATION='Bearer token')
+        assert res.status_code == 200
+        assert res['Content-Type'].startswith('text/plain; version=0.0.4')
+        text = res.content.decode()
+        assert 'webhook_requests_total{code="200"}' in text
+        for stage in ('parse', 'key_fetch', 'render', 'send'):
+            assert f'webhook_stage_seconds_count{{stage="{stage}"}} 1' in text
+        assert 'report_outcomes_total{outcome="sent"}' in text
+
     def test_bot_webhook_view_404(self):
         url = reverse('core:webhook')
         res = self.client.get(url)
@@ -335,6 +2144,210 @@ class TestViews:
         res = self.client.post(url, {'update_id': '1234'}, content_type='application/json')
         assert res.status_code == 200
 
+    def test_bot_webhook_view_acknowledged_first(self, mocker):
+        release = threading.Event()
+        mocker.patch.object(Bot, 'send_message', side_effect=lambda *args, **kwargs: release.wait(5))
+        url = reverse('core:webhook')
+        res = self.client.post(url, create_command_update('/start'), content_type='application/json')
+        assert res.status_code == 200
+        release.set()
+        update_workers.shutdown()
+        assert Bot.send_message.call_args[0][0] == 1111
+
+    def test_bot_webhook_view_no_workers(self, settings):
+        settings.BOT_UPDATE_WORKERS = 0
+        url = reverse('core:webhook')
+        self.client.post(url, create_command_update('/start'), content_type='application/json')
+        assert Bot.send_message.call_count == 1
+
+    def test_bot_webhook_view_inline_reply(self, settings):
+        settings.BOT_INLINE_REPLIES = True
+        url = reverse('core:webhook')
+        res = self.client.post(url, create_command_update('/webhook'), content_type='application/json')
+        reply = res.json()
+        assert reply['method'] == 'sendMessage'
+        assert reply['chat_id'] == 1111
+        assert settings.APP_URL in reply['text']
+        assert reply['parse_mode'] == 'Markdown'
+        assert KnownChat.objects.filter(chat_id='1111').exists()
+        update_workers.shutdown()
+        assert Bot.send_message.call_count == 0
+
+    @pytest.mark.parametrize('text', ['/start@test_bot', '/HELP', '/hook now'])
+    def test_inline_reply(self, text):
+        assert get_inline_reply(Update.de_json(create_command_update(text), bot))
+
+    @pytest.mark.parametrize('text', ['/start@other_bot', '/unknown', 'start', '/', '/ ', '/ start'])
+    def test_no_inline_reply(self, text):
+        assert get_inline_reply(Update.de_json(create_command_update(text), bot)) is None
+
+
+@pytest.mark.django_db
+class TestProfiling:
+    @pytest.fixture(autouse=True)
+    def profiling(self, settings, mocker, tmpdir):
+        settings.PROFILING_DIR = str(tmpdir)
+        settings.PROFILING_SECRET = 'secret'
+        mocker.patch.object(TravisSignatureChecker, 'validate', return_value=True)
+
+    def post(self, **headers):
+        url = reverse('core:hook', kwargs={'chat_id': '1111'})
+        return self.client.post(url, {'payload': create_travis_payload()}, **headers)
+
+    def test_disabled(self, settings):
+        settings.PROFILING_DIR = None
+        with pytest.raises(MiddlewareNotUsed):
+            ProfilingMiddleware(lambda request: HttpResponse())
+        settings.PROFILING_DIR = '/tmp'
+        settings.PROFILING_SECRET = None
+        with pytest.raises(MiddlewareNotUsed):
+            ProfilingMiddleware(lambda request: HttpResponse())
+
+    def test_signed_header(self):
+        res = self.post(HTTP_X_PROFILE=sign_profile_request())
+        assert res.status_code == 200
+        profiles = list_profiles(settings.PROFILING_DIR)
+        assert [profile['id'] for profile in profiles] == [res['X-Profile-Id']]
+        profile = profiles[0]
+        assert profile['view'] == 'core:hook'
+        assert profile['status'] == 200
+        assert profile['queries'] and profile['allocations']
+        assert profile['peak_memory'] > 0
+        assert os.path.exists(os.path.join(settings.PROFILING_DIR, f"{profile['id']}.prof"))
+
+    def test_not_requested(self):
+        assert 'X-Profile-Id' not in self.post()
+        assert 'X-Profile-Id' not in self.post(HTTP_X_PROFILE='profile:forged:signature')
+        assert not list_profiles(settings.PROFILING_DIR)
+
+    def test_sampling(self, settings):
+        settings.PROFILING_SECRET = None
+        settings.PROFILING_SAMPLE_RATE = 1.0
+        assert 'X-Profile-Id' in self.post()
+        # only webhook views are profiled
+        assert 'X-Profile-Id' not in self.client.get(reverse('core:index'))
+
+    def test_bot_token_not_saved(self, settings):
+        settings.PROFILING_SECRET = None
+        settings.PROFILING_SAMPLE_RATE = 1.0
+        settings.BOT_UPDATE_WORKERS = 0
+        url = reverse('core:webhook')
+        res = self.client.post(url, json.dumps(create_command_update('/help')), 'application/json')
+        assert 'X-Profile-Id' in res
+        path = os.path.join(settings.PROFILING_DIR, f"{res['X-Profile-Id']}.json")
+        with open(path) as f:
+            text = f.read()
+        assert settings.TELEGRAM_BOT_TOKEN not in text
+        assert json.loads(text)['path'] == '/webhook/<token>'
+
+    def test_rotation(self, settings):
+        settings.PROFILING_KEEP = 2
+        ids = [self.post(HTTP_X_PROFILE=sign_profile_request())['X-Profile-Id'] for _ in range(3)]
+        assert {profile['id'] for profile in list_profiles(settings.PROFILING_DIR)} == set(ids[1:])
+        assert len(os.listdir(settings.PROFILING_DIR)) == 4
+
+    def test_command(self, capsys):
+        profile_id = self.post(HTTP_X_PROFILE=sign_profile_request())['X-Profile-Id']
+        call_command('profiles')
+        assert profile_id in capsys.readouterr().out
+        call_command('profiles', profile_id, limit=5)
+        out = capsys.readouterr().out
+        assert 'function calls' in out
+        assert 'Top allocations:' in out
+        assert 'queries in' in out
+        call_command('profiles', sign=True)
+        assert self.post(HTTP_X_PROFILE=capsys.readouterr().out.strip()).has_header('X-Profile-Id')
+
+
+class TestBench:
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile([5], 95) == 5
+        assert summarize([0.001, 0.002, 0.003]) == {
+            'count': 3, 'mean': 2, 'p50': 2, 'p95': 3, 'p99': 3, 'max': 3,
+        }
+
+    def test_corpus(self, tmpdir):
+        path = str(tmpdir.join('corpus.jsonl'))
+        call_command('bench', path, generate=True, size=50, seed=1)
+        corpus = load_corpus(path)
+        assert corpus == generate_corpus(50, seed=1)
+        assert {entry['view'] for entry in corpus} == {'hook', 'group_hook', 'webhook'}
+
+    def test_bad_corpus(self, tmpdir):
+        path = tmpdir.join('corpus.jsonl')
+        path.write('{"view": "index"}\n')
+        with pytest.raises(CommandError):
+            call_command('bench', str(path))
+
+    @pytest.mark.django_db(transaction=True)
+    def test_replay(self, mocker):
+        # requests go to stub bot api
+        mocker.stopall()
+        bot_user = bot.bot
+        results = Replay(generate_corpus(30), repeat=2, warmup=5, trace_memory=True).run()
+        assert results['requests'] == 60
+        assert results['throughput'] > 0
+        assert sum(view['latency_ms']['count'] for view in results['views'].values()) == 60
+        hook = results['views']['hook']
+        assert set(hook['status_codes']) == {'200'}
+        assert hook['queries']['max'] > 0
+        assert {'parse', 'key_fetch', 'verify', 'render', 'send'} <= set(results['stages'])
+        assert results['telegram']['sendMessage']['count'] > 0
+        assert results['memory']['peak_traced_kib'] > 0
+        json.dumps(results)
+        # settings and singletons are restored
+        assert not stage_latency.keep_samples
+        assert bot.bot is bot_user
+
+
+class TestBackgroundTasks:
+    def test_bounded_queue(self):
+        release = threading.Event()
+        done = []
+        tasks = BackgroundTasks(workers=1, queue_size=1)
+        assert tasks.submit(release.wait, 5)
+        assert tasks.submit(done.append, 1)
+        assert not tasks.submit(done.append, 2)
+        release.set()
+        tasks.shutdown()
+        assert done == [1]
+        # slots are released when tasks finish
+        assert tasks.submit(done.append, 3)
+        tasks.shutdown()
+        assert done == [1, 3]
+
+    def test_errors_logged(self, mocker):
+        tasks = BackgroundTasks(workers=1, queue_size=1)
+        logger = mocker.patch('core.background.logger')
+        tasks.submit(mocker.Mock(side_effect=TelegramError('boom'), __name__='send'))
+        tasks.shutdown()
+        assert logger.exception.call_count == 1
+
+
+class TestRenderedFile:
+    def test_rendered_once(self, tmp_path, mocker):
+        path = tmp_path / 'README.md'
+        path.write_text('# title')
+        render_func = mocker.Mock(side_effect=lambda text: text.upper())
+        page = RenderedFile(str(path), render_func)
+        assert page.get().html == '# TITLE'
+        assert page.get() is page.get()
+        assert render_func.call_count == 1
+
+    def test_mtime_invalidation(self, tmp_path):
+        path = tmp_path / 'README.md'
+        path.write_text('old')
+        page = RenderedFile(str(path), str.upper)
+        old = page.get()
+        path.write_text('new')
+        os.utime(str(path), (old.mtime + 10, old.mtime + 10))
+        new = page.get()
+        assert new.html == 'NEW'
+        assert new.digest != old.digest
+
 
 class TestBot:
     def create_update(self, text=None, command=None):
@@ -371,12 +2384,14 @@ class TestBot:
         command_start(Mock(), Mock())
         assert Bot.send_message.call_count == 1
 
+    @pytest.mark.django_db
     def test_command_webhook(self, mocker):
         mocker.patch.object(Bot, 'send_message')
         mocker.spy(Bot, 'send_message')
         update = self.create_update('foo')
         command_webhook(update, Mock())
         assert settings.APP_URL in Bot.send_message.call_args[0][1]
+        assert known_chats.is_known(update.effective_message.chat_id)
 
     def test_error(self, mocker):
         mocker.patch.object(Bot, 'send_message', side_effect=TelegramError('error'))
@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.utils import timezone
+
+from core.cache import LRUCache
+from core.models import BuildStatus
+from core.payload import BuildEvent
+
+
+class BuildStatusIndex:
+    """
+    Last known status of (chat_id, repository id, branch). Build is a transition if it is newer
+    than the stored one and its status differs, the first build of a branch only if it failed.
+    Builds are ordered by number and then by finish time, so restarted builds replace
+    earlier runs and late notifications about older builds are ignored.
+    Recently seen branches are kept in memory to drop stale builds without database.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.local = LRUCache(maxsize=maxsize)
+
+    @property
+    def enabled(self):
+        return settings.REPORT_TRANSITIONS_ONLY
+
+    @staticmethod
+    def get_branch(build: BuildEvent) -> str:
+        # pull requests don't change status of their target branch
+        if build.pull_request:
+            return f"#{build.pull_request_number}"
+        return build.branch or ''
+
+    @staticmethod
+    def get_order(build: BuildEvent) -> tuple:
+        number = int(build.number) if str(build.number).isdigit() else 0
+        return number, build.finished_at or timezone.now()
+
+    def get_key(self, chat_id, build: BuildEvent) -> tuple:
+        return str(chat_id), build.repository_id, self.get_branch(build)
+
+    def is_transition(self, chat_id, build: BuildEvent) -> bool:
+        """
+        Check build against last known status. Newer build with the same status is stored
+        right away, transition is stored with `advance` only after it was delivered,
+        so travis retry of failed delivery is still a transition.
+        Unfinished and canceled builds are not transitions and are not stored.
+        """
+        if build.status is None or build.state == 'canceled':
+            return False
+        if build.repository_id is None:
+            return True
+        key = self.get_key(chat_id, build)
+        order = self.get_order(build)
+        cached = self.local.get(key)
+        if cached is not None and order <= cached:
+            return False
+        passed = build.status == 0
+        stored = BuildStatus.objects.filter(
+            chat_id=key[0],
+            repository_id=key[1],
+            branch=key[2],
+        ).values_list('passed', 'build_number', 'finished_at').first()
+        if stored is None:
+            if passed:
+                self.advance(chat_id, build)
+            return not passed
+        previous, *stored_order = stored
+        if order <= tuple(stored_order):
+            # database has newer build than memory
+            self.local.set(key, tuple(stored_order))
+            return False
+        if previous != passed:
+            return True
+        self.advance(chat_id, build)
+        return False
+
+    def advance(self, chat_id, build: BuildEvent) -> bool:
+        """
+        Store status of build unless newer build is already stored.
+        """
+        if build.repository_id is None:
+            return False
+        key = self.get_key(chat_id, build)
+        order = self.get_order(build)
+        applied, _ = BuildStatus.objects.advance(*key, build.status == 0, *order)
+        if applied:
+            self.local.set(key, order)
+        else:
+            self.local.pop(key)
+        return applied
+
+    def clear(self):
+        self.local.clear()
+
+
+build_statuses = BuildStatusIndex()
@@ -10,5 +10,7 @@ urlpatterns = [
     path('logout', views.logout_view, name='logout'),
     path('u/<str:chat_id>', views.hook_view, name='hook'),
     path('u/<str:chat_id>/force', views.deprecated_forced_hook_view, name='forced'),
+    path('g/<slug:name>', views.group_hook_view, name='group_hook'),
+    path('metrics', views.metrics_view, name='metrics'),
     path(f'webhook/{settings.TELEGRAM_BOT_TOKEN}', views.bot_webhook_view, name='webhook'),
 ]
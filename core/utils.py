@@ -3,41 +3,121 @@ import hashlib
 import hmac
 import json
 import logging
-from datetime import datetime
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
 
-import dateutil.parser
 import requests
 from OpenSSL.crypto import verify, load_publickey, FILETYPE_PEM, X509
 from OpenSSL.crypto import Error as SignatureError
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse
 from django.shortcuts import render
 from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django.utils.safestring import mark_safe
 from markdown import markdown
-from telegram import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.error import BadRequest
+from telegram import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton, Message
+from telegram.error import BadRequest, RetryAfter, TelegramError
 
-from core.bot import bot
+from core.bot import get_bot_username, scheduler
+from core.buildindex import build_messages
+from core.cache import LRUCache
+from core.dedup import deduplicator
+from core.filters import chat_filters
+from core.metrics import report_outcomes, stage_latency
+from core.markup import MAX_MESSAGE_LENGTH, check_markdown, truncate
+from core.models import OutboxMessage
+from core.payload import BuildEvent, extract_fields
+from core.render import get_renderer
+from core.transitions import build_statuses
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
 
+class RenderedFile:
+    """
+    Rendered contents of a file, rendered again only when file's mtime changes.
+    """
+    State = namedtuple('State', ['mtime', 'html', 'digest'])
+
+    def __init__(self, path: str, render_func):
+        self.path = path
+        self.render_func = render_func
+        self.state = None
+        self._lock = threading.Lock()
+
+    def get(self) -> State:
+        mtime = os.stat(self.path).st_mtime
+        state = self.state
+        if state is None or state.mtime != mtime:
+            with self._lock:
+                state = self.state
+                if state is None or state.mtime != mtime:
+                    state = self.state = self.load(mtime)
+        return state
+
+    def load(self, mtime: float) -> State:
+        with open(self.path, 'r') as f:
+            text = f.read()
+        html = mark_safe(self.render_func(text))
+        return self.State(mtime, html, hashlib.md5(html.encode()).hexdigest())
+
+
+readme = RenderedFile(
+    os.path.join(settings.BASE_DIR, 'README.md'),
+    lambda text: markdown(text, extensions=['fenced_code']),
+)
+INDEX_TEMPLATE = os.path.join(settings.BASE_DIR, 'templates', 'index.html')
+
+
+def get_index_etag(request, page, template_mtime: float, bot_username, extra_context: dict):
+    # page differs for users, hosts (webhook url) and before bot username is known,
+    # template mtime changes with deploys that don't touch readme
+    user = getattr(request, 'user', None)
+    key = ':'.join(map(str, [
+        page.digest,
+        template_mtime,
+        bot_username,
+        user and user.pk,
+        request.scheme,
+        request.META.get('HTTP_HOST'),
+        request.path,
+        sorted(extra_context.items()),
+    ]))
+    return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+
 def render_index(request, **extra_context):
-    with open('README.md', 'r') as f:
-        readme = markdown(f.read(), extensions=['fenced_code'])
-    readme = mark_safe(readme)
-    return render(
-        request,
-        'index.html',
-        context={
-            'readme': readme,
-            'bot_username': bot.username,
-            **extra_context,
-        }
-    )
+    page = readme.get()
+    bot_username = get_bot_username()
+    template_mtime = os.stat(INDEX_TEMPLATE).st_mtime
+    etag = get_index_etag(request, page, template_mtime, bot_username, extra_context)
+    last_modified = int(max(page.mtime, template_mtime))
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = render(
+            request,
+            'index.html',
+            context={
+                'readme': page.html,
+                'bot_username': bot_username,
+                **extra_context,
+            }
+        )
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # always revalidate, page changes on login and logout
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 def get_tg_auth_payload(data: dict):
@@ -58,92 +138,472 @@ def validate_tg_auth_data(data: dict):
 
 
 def get_user(data: dict):
-    # can't user update_or_create because user must be create with specific method
-    defaults = {
+    username = data['id']
+    fields = {
         'first_name': data.get('first_name'),
         'last_name': data.get('last_name', ''),
         'photo_url': data.get('photo_url'),
         'is_active': True,
     }
     if 'auth_date' in data:
-        defaults['auth_date'] = datetime.fromtimestamp(int(data['auth_date']))
-    try:
-        user = User.objects.get(username=data['id'])
-        for key, value in defaults.items():
-            setattr(user, key, value)
-        user.save()
-    except User.DoesNotExist:
-        user = User.objects.create_user(username=data['id'], **defaults)
-    return user
-
-
-def format_build_report(data: dict):
-    for field in ['started_at', 'finished_at', 'committed_at']:
-        data[field] = dateutil.parser.parse(data[field])
-    data['multiline'] = '\n' in data['message']
-    data['message'] = mark_safe(data['message'])
-    return render_to_string('report.html', context=data)
-
-
-def format_simple_report(data: dict):
-    sub = {}
-    for key in ['repository', 'number', 'status_message', 'author_name', 'message', 'duration']:
-        sub[key] = data[key]
+        fields['auth_date'] = datetime.fromtimestamp(int(data['auth_date']), tz=timezone.utc)
+    return User.objects.upsert(username, **fields)
+
+
+def format_build_report(build: BuildEvent):
+    render = get_renderer()
+    with stage_latency.time('render'):
+        text = render(build)
+        overflow = len(text) - MAX_MESSAGE_LENGTH
+        if overflow > 0:
+            # every char of message takes at least one char in report
+            message = truncate(build.message, len(build.message) - overflow - 1)
+            text = render(build._replace(message=message))
+    return text
+
+
+def format_simple_report(build: BuildEvent):
+    sub = {
+        'repository': dict(build.repository._asdict()),
+        'number': build.number,
+        'status_message': build.status_message,
+        'author_name': build.author_name,
+        'message': build.message,
+        'duration': build.duration,
+    }
     text = json.dumps(sub, indent=2, ensure_ascii=False)
+    # backticks would close code block
+    text = text.replace('`', "'")
+    overflow = len(text) + 8 - MAX_MESSAGE_LENGTH
+    if overflow > 0:
+        sub['message'] = truncate(str(sub['message']), len(str(sub['message'])) - overflow - 1)
+        text = json.dumps(sub, indent=2, ensure_ascii=False).replace('`', "'")
     return f'```\n{text}\n```'
 
 
+def format_build_summary(build: BuildEvent):
+    return {
+        'repository': build.repository.slug,
+        'number': build.number,
+        'status': build.status,
+        'status_message': build.status_message,
+        'branch': build.branch,
+        'build_url': build.build_url,
+        'repository_id': build.repository_id,
+        'build_id': build.id,
+    }
+
+
+def format_digest(summaries: list):
+    return render_to_string('digest.html', context={'reports': summaries})
+
+
+def format_simple_digest(summaries: list):
+    text = json.dumps(summaries, indent=2, ensure_ascii=False)
+    return f'```\n{text}\n```'
+
+
+def load_payload(request: HttpRequest):
+    """
+    Return parsed travis notification or None if there is no valid payload.
+    """
+    if 'payload' not in request.POST:
+        return None
+    try:
+        with stage_latency.time('parse'):
+            return BuildEvent.from_payload(extract_fields(request.POST['payload']))
+    except ValueError:
+        return None
+
+
+def check_signature(request: HttpRequest, build: BuildEvent) -> bool:
+    if not settings.CHECK_SIGNATURE:
+        return True
+    tsc = TravisSignatureChecker()
+    return tsc.validate(request, build.repository_id)
+
+
 def send_report(request: HttpRequest, chat_id):
     if 'payload' not in request.POST:
         return HttpResponse('no payload', status=400)
 
-    tsc = TravisSignatureChecker()
-    if settings.CHECK_SIGNATURE and not tsc.validate(request):
+    build = load_payload(request)
+    if build is None:
+        return HttpResponse('bad payload', status=400)
+
+    if not chat_filters.matches(chat_id, build):
+        return HttpResponse('filtered')
+
+    dedup_key = deduplicator.get_key(chat_id, build) if deduplicator.enabled else None
+    if dedup_key and deduplicator.seen(dedup_key):
+        return HttpResponse('duplicate')
+
+    if not check_signature(request, build):
         return HttpResponse('bad signature', status=400)
 
-    data = json.loads(request.POST['payload'])
-    text = format_build_report(data)
+    # claim only verified notifications, so forged ones can't suppress real ones
+    if dedup_key and not deduplicator.claim(dedup_key):
+        return HttpResponse('duplicate')
+    if build_statuses.enabled and not build_statuses.is_transition(chat_id, build):
+        return HttpResponse('unchanged')
     try:
-        bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            parse_mode=ParseMode.MARKDOWN,
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup.from_row([
-                InlineKeyboardButton('details', url=data['build_url']),
-                InlineKeyboardButton('diff', url=data['compare_url']),
-            ])
-        )
-    except BadRequest:
-        pass
-    else:
-        return HttpResponse(text, 'text/markdown')
+        response = deliver_build_report(chat_id, build)
+    except Exception:
+        if dedup_key:
+            deduplicator.release(dedup_key)
+        raise
+    if response.status_code >= 400:
+        if dedup_key:
+            deduplicator.release(dedup_key)
+    elif build_statuses.enabled:
+        # transition is remembered only once it was delivered
+        build_statuses.advance(chat_id, build)
+    return response
+
 
+def send_group_report(request: HttpRequest, chat_ids: list):
+    """
+    Verify, parse and render notification once and deliver it to all chats concurrently.
+    Respond with delivery result for every chat.
+    """
+    if 'payload' not in request.POST:
+        return HttpResponse('no payload', status=400)
+
+    build = load_payload(request)
+    if build is None:
+        return HttpResponse('bad payload', status=400)
+
+    if not check_signature(request, build):
+        return HttpResponse('bad signature', status=400)
+
+    results = {}
+    targets = []
+    for chat_id in chat_ids:
+        if not chat_filters.matches(chat_id, build):
+            results[chat_id] = {'status': 'filtered'}
+            continue
+        dedup_key = deduplicator.get_key(chat_id, build) if deduplicator.enabled else None
+        if dedup_key and not deduplicator.claim(dedup_key):
+            results[chat_id] = {'status': 'duplicate'}
+        elif build_statuses.enabled and not build_statuses.is_transition(chat_id, build):
+            results[chat_id] = {'status': 'unchanged'}
+        else:
+            targets.append((chat_id, dedup_key))
+
+    if not targets:
+        return JsonResponse({'results': results})
+
+    text = format_build_report(build)
+    if settings.OUTBOX_ENABLED:
+        for chat_id, _ in targets:
+            enqueue_report(chat_id, build, text)
+            results[chat_id] = {'status': 'queued'}
+            if build_statuses.enabled:
+                build_statuses.advance(chat_id, build)
+        return JsonResponse({'results': results}, status=202)
+
+    get_simple_text = lru_cache(maxsize=1)(lambda: format_simple_report(build))
+    build_key = get_build_key(build.repository_id, build.id)
+    # database is used only from request thread
+    message_ids = {
+        chat_id: build_messages.get(chat_id, *build_key) if build_key else None
+        for chat_id, _ in targets
+    }
+
+    def deliver(chat_id):
+        try:
+            _, message_id = deliver_report(
+                chat_id,
+                text,
+                get_simple_text,
+                build.build_url,
+                build.compare_url,
+                message_ids[chat_id],
+            )
+        except TelegramError as e:
+            logger.debug(f"failed to notify chat {chat_id}: {e}")
+            return {'status': 'failed', 'error': str(e)}, None
+        return {'status': 'sent'}, message_id
+
+    workers = min(len(targets), settings.FANOUT_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        delivered = executor.map(deliver, [chat_id for chat_id, _ in targets])
+        for (chat_id, dedup_key), (result, message_id) in zip(targets, delivered):
+            results[chat_id] = result
+            if result['status'] == 'failed':
+                if dedup_key:
+                    deduplicator.release(dedup_key)
+            elif build_statuses.enabled:
+                build_statuses.advance(chat_id, build)
+            if build_key and message_id is not None:
+                build_messages.set(chat_id, *build_key, message_id)
+
+    ok = any(result['status'] != 'failed' for result in results.values())
+    return JsonResponse({'results': results}, status=200 if ok else 400)
+
+
+def enqueue_report(chat_id, build: BuildEvent, text: str):
+    return OutboxMessage.objects.enqueue(
+        chat_id=chat_id,
+        text=text,
+        simple_text=format_simple_report(build),
+        build_url=build.build_url,
+        compare_url=build.compare_url,
+        summary=json.dumps(format_build_summary(build)),
+    )
+
+
+def deliver_build_report(chat_id, build: BuildEvent):
+    text = format_build_report(build)
+    if settings.OUTBOX_ENABLED:
+        enqueue_report(chat_id, build, text)
+        return HttpResponse(text, 'text/markdown', status=202)
+
+    build_key = get_build_key(build.repository_id, build.id)
+    message_id = build_messages.get(chat_id, *build_key) if build_key else None
     try:
-        text = format_simple_report(data)
-        bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            parse_mode=ParseMode.MARKDOWN,
-            disable_web_page_preview=True,
-            reply_markup=InlineKeyboardMarkup.from_row([
-                InlineKeyboardButton('details', url=data['build_url']),
-                InlineKeyboardButton('diff', url=data['compare_url']),
-            ])
+        text, message_id = deliver_report(
+            chat_id,
+            text,
+            lambda: format_simple_report(build),
+            build.build_url,
+            build.compare_url,
+            message_id,
         )
     except BadRequest as e:
         return HttpResponse(str(e), status=400)
+    except RetryAfter as e:
+        # flood wait is longer than request may block
+        response = HttpResponse(str(e), status=503)
+        response['Retry-After'] = str(math.ceil(e.retry_after))
+        return response
+    if build_key and message_id is not None:
+        build_messages.set(chat_id, *build_key, message_id)
     return HttpResponse(text, 'text/markdown')
 
 
+def send_report_message(chat_id, text: str, build_url: str, compare_url: str, message_id=None):
+    reply_markup = None
+    if build_url:
+        reply_markup = InlineKeyboardMarkup.from_row([
+            InlineKeyboardButton('details', url=build_url),
+            InlineKeyboardButton('diff', url=compare_url),
+        ])
+    params = dict(
+        parse_mode=ParseMode.MARKDOWN,
+        disable_web_page_preview=True,
+        reply_markup=reply_markup,
+    )
+    if message_id is None:
+        message = scheduler.send_message(chat_id, text, **params)
+    else:
+        message = scheduler.edit_message_text(chat_id, message_id, text, **params)
+    return message.message_id if isinstance(message, Message) else message_id
+
+
+def is_edit_error(error: BadRequest):
+    message = str(error).lower()
+    return any(e in message for e in [
+        'message to edit not found',
+        "message can't be edited",
+        'message is not modified',
+    ])
+
+
+def post_report(chat_id, text: str, get_simple_text, build_url: str, compare_url: str, message_id=None):
+    """
+    Send or edit report and fall back to simple report if it is invalid or telegram rejects it.
+    Return text and id of the message, raise BadRequest if both reports were rejected.
+    """
+    if len(text) <= MAX_MESSAGE_LENGTH and check_markdown(text):
+        try:
+            return text, send_report_message(chat_id, text, build_url, compare_url, message_id)
+        except BadRequest as e:
+            if message_id is not None and is_edit_error(e):
+                raise
+            report_outcomes.inc('fallback')
+            logger.warning(f"telegram rejected report: {e}")
+    else:
+        report_outcomes.inc('local_fallback')
+    text = get_simple_text()
+    return text, send_report_message(chat_id, text, build_url, compare_url, message_id)
+
+
+def deliver_report(chat_id, text: str, get_simple_text, build_url: str, compare_url: str, message_id=None):
+    """
+    Post report as a new message or by editing message with `message_id`.
+    New message is sent if old one can't be edited.
+    Return text and id of the message.
+    """
+    with stage_latency.time('send'):
+        try:
+            result = post_or_edit_report(chat_id, text, get_simple_text, build_url, compare_url, message_id)
+        except BadRequest:
+            report_outcomes.inc('bad_request')
+            raise
+        except TelegramError:
+            report_outcomes.inc('failed')
+            raise
+    report_outcomes.inc('sent')
+    return result
+
+
+def post_or_edit_report(chat_id, text: str, get_simple_text, build_url: str, compare_url: str, message_id=None):
+    if message_id is not None:
+        try:
+            return post_report(chat_id, text, get_simple_text, build_url, compare_url, message_id)
+        except BadRequest as e:
+            if not is_edit_error(e):
+                raise
+            if 'not modified' in str(e).lower():
+                return text, message_id
+            logger.debug(f"can't edit message {message_id} in chat {chat_id}: {e}")
+    return post_report(chat_id, text, get_simple_text, build_url, compare_url)
+
+
+def get_build_key(repository_id, build_id):
+    if not build_messages.enabled or repository_id is None or build_id is None:
+        return None
+    return repository_id, build_id
+
+
+class PublicKeyCache:
+    """
+    Process-wide cache of travis webhook public keys.
+
+    Keys are fetched from all config urls concurrently. Fresh keys are served from memory,
+    keys that are about to expire are served from memory while refresh runs in background,
+    expired keys are refreshed before being returned. Last successfully fetched key for
+    each url is kept if refresh fails.
+    """
+
+    def __init__(self, urls=None, ttl=None, refresh_ahead=None, retry_delay=None, timeout=None):
+        self.urls = list(urls or settings.TRAVIS_CONFIG_URLS)
+        self.ttl = settings.TRAVIS_KEY_TTL if ttl is None else ttl
+        self.refresh_ahead = (
+            settings.TRAVIS_KEY_REFRESH_AHEAD if refresh_ahead is None else refresh_ahead
+        )
+        self.retry_delay = settings.TRAVIS_KEY_RETRY_DELAY if retry_delay is None else retry_delay
+        self.timeout = settings.TRAVIS_KEY_TIMEOUT if timeout is None else timeout
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._refresh_at = 0.0
+            self._expires_at = 0.0
+            self._refreshed_at = None
+            self.hits = 0
+            self.misses = 0
+
+    def get(self) -> list:
+        """
+        Return list of public keys in order of config urls. Key is None if it was never fetched.
+        """
+        now = time.monotonic()
+        with self._lock:
+            fresh = bool(self._keys) and now < self._expires_at
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            stale = fresh and now >= self._refresh_at
+        if not fresh:
+            self.refresh()
+        elif stale:
+            self.refresh_in_background()
+        with self._lock:
+            return [self._keys.get(url) for url in self.urls]
+
+    def refresh(self):
+        started = time.monotonic()
+        # only one refresh at a time, concurrent callers wait for it and reuse its result
+        with self._refresh_lock:
+            if self._refreshed_at is not None and self._refreshed_at >= started:
+                return
+            with ThreadPoolExecutor(max_workers=len(self.urls)) as executor:
+                keys = list(executor.map(self.fetch_key, self.urls))
+            now = time.monotonic()
+            with self._lock:
+                self._refreshed_at = now
+                fetched = False
+                for url, key in zip(self.urls, keys):
+                    if key:
+                        self._keys[url] = key
+                        fetched = True
+                if fetched:
+                    self._expires_at = now + self.ttl
+                    self._refresh_at = self._expires_at - self.refresh_ahead
+                    if any(url not in self._keys for url in self.urls):
+                        # keys of other urls are served, missing one is fetched again soon
+                        self._refresh_at = min(self._refresh_at, now + self.retry_delay)
+                elif self._keys:
+                    # keep serving last good keys and retry later
+                    self._expires_at = max(self._expires_at, now + self.retry_delay)
+                    self._refresh_at = now + self.retry_delay
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def target():
+            try:
+                self.refresh()
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=target, name='travis-keys-refresh', daemon=True).start()
+
+    def fetch_key(self, url):
+        try:
+            response = requests.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()['config']['notifications']['webhook']['public_key']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.debug(f"failed to fetch public key from {url}: {e}")
+            return None
+
+
+public_key_cache = PublicKeyCache()
+# repository id -> public key that signed its last notification
+signing_keys = LRUCache(maxsize=10000)
+
+
+@lru_cache(maxsize=16)
+def load_certificate(public_key) -> X509:
+    """
+    Convert the PEM encoded public key to a format palatable for pyOpenSSL.
+    Parsed keys are reused between requests.
+    """
+    certificate = X509()
+    certificate.set_pubkey(load_publickey(FILETYPE_PEM, public_key))
+    return certificate
+
+
 class TravisSignatureChecker:
-    def validate(self, request: HttpRequest) -> bool:
+    def __init__(self, key_cache: PublicKeyCache = None):
+        self.key_cache = key_cache or public_key_cache
+
+    def validate(self, request: HttpRequest, repository_id=None) -> bool:
         signature = self.get_signature(request)
         payload = request.POST['payload']
-        for public_key in self.gen_public_key():
-            if not public_key:
-                continue
+        with stage_latency.time('key_fetch'):
+            public_keys = [key for key in self.gen_public_key() if key]
+        # try key that signed previous notification of this repo first
+        preferred = signing_keys.get(repository_id) if repository_id is not None else None
+        if preferred in public_keys:
+            public_keys.remove(preferred)
+            public_keys.insert(0, preferred)
+        for public_key in public_keys:
             if self.validate_signature(signature, payload, public_key):
+                if repository_id is not None:
+                    signing_keys.set(repository_id, public_key)
                 return True
         logger.debug("problem with fetching public keys")
         return False
@@ -158,13 +618,10 @@ class TravisSignatureChecker:
 
     def check_authorized(self, signature, public_key, payload):
         """
-        Convert the PEM encoded public key to a format palatable for pyOpenSSL,
-        then verify the signature
+        Verify the signature with parsed and cached public key.
         """
-        pkey_public_key = load_publickey(FILETYPE_PEM, public_key)
-        certificate = X509()
-        certificate.set_pubkey(pkey_public_key)
-        verify(certificate, signature, payload, 'sha1')
+        with stage_latency.time('verify'):
+            verify(load_certificate(public_key), signature, payload, 'sha1')
 
     def get_signature(self, request):
         """
@@ -177,12 +634,4 @@ class TravisSignatureChecker:
         """
         Fetch public key for public and private repos.
         """
-        for url in ['https://api.travis-ci.org/config', 'https://api.travis-ci.com/config']:
-            try:
-                response = requests.get(url, timeout=10.0)
-                response.raise_for_status()
-            except requests.RequestException as e:
-                logger.debug(e)
-                yield None
-            else:
-                yield response.json()['config']['notifications']['webhook']['public_key']
+        yield from self.key_cache.get()
@@ -1,18 +1,31 @@
+import hmac
 import json
 import logging
 
 from django.conf import settings
 from django.contrib.auth import get_user_model, login, logout
-from django.http import HttpRequest, HttpResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.views.decorators.csrf import csrf_exempt
 from telegram import Update
 
-from core.bot import bot, dispatcher
-from core.utils import get_user, render_index, send_report, validate_tg_auth_data
+from core.background import background
+from core.bot import bot, get_inline_reply, handle_update, scheduler
+from core.chats import known_chats
+from core.metrics import metrics, webhook_requests
+from core.models import ChatGroup
+from core.ratelimit import SlidingWindowLimiter
+from core.utils import (
+    get_user,
+    render_index,
+    send_group_report,
+    send_report,
+    validate_tg_auth_data,
+)
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
+hook_limiter = SlidingWindowLimiter(settings.HOOK_RATE_LIMIT, settings.HOOK_RATE_WINDOW)
 
 
 def index_view(request: HttpRequest):
@@ -28,20 +41,48 @@ def login_success_view(request):
 
     user = get_user(data)
     login(request, user)
-    bot.send_message(chat_id=user.username, text=f"Successfully signed in on {settings.APP_URL}.")
+    known_chats.register(user.username)
+    text = f"Successfully signed in on {settings.APP_URL}."
+    background.submit(scheduler.send_message, user.username, text)
     return redirect('core:hook', chat_id=user.username)
 
 
+def check_hook(chat_id: str):
+    """
+    Reject webhook before payload is read: flood from single chat or unknown chat in strict mode.
+    """
+    if not hook_limiter.allow(chat_id):
+        return HttpResponse('too many requests', status=429)
+    if settings.STRICT_CHATS and not known_chats.is_known(chat_id):
+        return HttpResponse('unknown chat', status=404)
+    return None
+
+
+def count_request(response: HttpResponse):
+    webhook_requests.inc(str(response.status_code))
+    return response
+
+
 @csrf_exempt
 def hook_view(request: HttpRequest, chat_id: str):
     if request.method == 'POST':
-        return send_report(request, chat_id)
+        return count_request(check_hook(chat_id) or send_report(request, chat_id))
     user = User.objects.filter(username=chat_id, is_active=True).first()
     if user and user == request.user:
         return render_index(request)
     return redirect('core:index')
 
 
+@csrf_exempt
+def group_hook_view(request: HttpRequest, name: str):
+    if request.method == 'POST':
+        if not hook_limiter.allow(f'g/{name}'):
+            return count_request(HttpResponse('too many requests', status=429))
+        group = get_object_or_404(ChatGroup, name=name)
+        return count_request(send_group_report(request, group.get_chat_ids()))
+    return redirect('core:index')
+
+
 @csrf_exempt
 def deprecated_forced_hook_view(request: HttpRequest, chat_id: str):
     return hook_view(request, chat_id)
@@ -62,6 +103,19 @@ def bot_webhook_view(request: HttpRequest):
     if request.method == 'POST':
         data = json.loads(request.body)
         update = Update.de_json(data, bot)
-        dispatcher.process_update(update)
+        if settings.BOT_INLINE_REPLIES:
+            reply = get_inline_reply(update)
+            if reply:
+                return JsonResponse(reply)
+        handle_update(update)
         return HttpResponse('ok')
     return HttpResponse(status=404)
+
+
+def metrics_view(request: HttpRequest):
+    if not settings.METRICS_TOKEN:
+        return HttpResponse(status=404)
+    expected = f'Bearer {settings.METRICS_TOKEN}'.encode()
+    if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', '').encode(), expected):
+        return HttpResponse('unauthorized', status=401)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -4,4 +4,5 @@ set -e
 
 python manage.py collectstatic --noinput
 python manage.py migrate
+python manage.py createcachetable
 python manage.py setwebhook
@@ -9,5 +9,9 @@ if [[ ${1:-prod} == 'dev' ]]; then
     exec python manage.py runserver 0.0.0.0:${PORT}
 else
     echo "running PROD server..."
+    if [[ -n ${METRICS_DIR:-} ]]; then
+        # metrics of workers from previous run would stay in totals
+        rm -f "${METRICS_DIR}"/metrics_*.json
+    fi
     exec gunicorn config.wsgi --bind 0.0.0.0:${PORT}
 fi